@@ -28,7 +28,7 @@ optional arguments:
                         threshold for numeric values to be considered different. e.g. when threshold = 0.01 if left and right values are closer than 0,01 then consider the same. Mainly affects coloring of difference column for numeric values
   --open OPEN, -p OPEN  if true, open output file on completion using os.system. Output file path must resolve to a file. Adds quotes around file name so that paths with spaces can resolveon windows machines.
   --compare_type COMPARE_TYPE, -c COMPARE_TYPE
-                        if set to 'sorted', the comparison tool will attempt to line up each side based on the values of sort_column specified. 'default' is a cell-by-cell comparison.
+                        if set to 'sorted', the comparison tool will attempt to line up each side based on the values of sort_column specified. 'aligned' lines up rows by their content without a key, so inserted and deleted rows do not shift later rows. 'default' is a cell-by-cell comparison.
   --sort_column SORT_COLUMN, -s SORT_COLUMN
                         numeric offset (1-based) of column to use for sorting. To be used for a primary key. if compare type is 'sorted', this column will be used to sort and line up each sideE.g. 1 would be the first column.
   --sort_column_list SORT_COLUMN_LIST [SORT_COLUMN_LIST ...], -l SORT_COLUMN_LIST [SORT_COLUMN_LIST ...]
@@ -42,9 +42,14 @@ optional arguments:
 """
 import argparse
 import logging
+import multiprocessing
+import sys
 
+import xl_diff
 from xl_diff.validators import is_number
-from xl_diff import compare_files
+from xl_diff.convert import parse_schema
+from xl_diff.rules import parse_rules
+from xl_diff.sampling import get_sample_method
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)-15s %(message)s')
 
@@ -67,8 +72,30 @@ def run_from_command_line():
         has_header_flag = not args.no_header
     logging.info("Has Header: {}".format(has_header_flag))
     logging.info(f"sorting column: {sort_column_arg}")
-    compare_files(args.left, args.right, args.output, args.threshold, args.open, sort_column_arg, args.compare_type,
-                  has_header_flag, args.sheet_matching, args.summary)
+    try:
+        csv_schema = parse_schema(args.csv_types)
+        rules = parse_rules(args.rules)
+        sample_method = get_sample_method(args.sample, args.sample_method, sort_column_arg) if args.sample else None
+    except ValueError as e:
+        parser.error(str(e))
+    if args.sample and (args.check or args.watch is not None):
+        parser.error("sampling cannot be combined with --check or --watch")
+    if args.check:  # only check for differences.  no output file is written
+        differences = xl_diff.find_differences(args.left, args.right, args.threshold,
+                                       sort_column_arg if args.compare_type == "sorted" else None, has_header_flag,
+                                       args.sheet_matching, csv_schema, args.max_differences, rules)
+        logging.info("files are {}".format("different" if differences else "equal"))
+        sys.exit(1 if differences else 0)
+    if args.output is None:
+        parser.error("output file is required unless --check is set")
+    if args.watch is not None:  # compare again whenever one of the files changes, until Ctrl+C
+        xl_diff.watch_files(args.left, args.right, args.output, args.threshold, sort_column_arg, args.compare_type,
+                            has_header_flag, args.sheet_matching, rules, csv_schema, args.watch)
+        return
+    xl_diff.compare_files(args.left, args.right, args.output, args.threshold, args.open, sort_column_arg,
+                          args.compare_type, has_header_flag, args.sheet_matching, args.summary, csv_schema,
+                          args.memory_map, args.sample, sample_method, rules, args.workers, args.column_matching,
+                          args.work_dir, args.resume, args.compact)
 
 
 def compare_excel_configure_arg_parser():
@@ -85,9 +112,10 @@ def compare_excel_configure_arg_parser():
 
     parser.add_argument("right", help="Path to second file for comparison.  Can be CSV or XLSX.  In output file, " +
                                       " these values will be on right")  # second workbook file
-    parser.add_argument("output", help="Path to output file.  If file exists it will be overwritten.  " +
-                                       "It will contain copies of data from original " +
-                                       "files as well as the values side by side in a combined sheet.")  # output file
+    parser.add_argument("output", nargs="?", help="Path to output file.  If file exists it will be overwritten.  " +
+                                                  "It will contain copies of data from original " +
+                                                  "files as well as the values side by side in a combined sheet.  " +
+                                                  "Not needed with --check.")  # output file
     parser.add_argument("--threshold", '-t', type=float, default=0.001,
                         help="threshold for numeric values to be considered different.  e.g. when threshold = 0.01 " +
                              "if left and right values are closer than 0,01 then consider the same.  Mainly affects " +
@@ -99,7 +127,9 @@ def compare_excel_configure_arg_parser():
                                                                       "on windows machines.")  # open on finish
     parser.add_argument("--compare_type", '-c', default="default",  # sorted or cell-by-cell comparison
                         help="if set to 'sorted', the comparison tool will attempt to line up each side based on " +
-                             "the values of sort_column specified.  'default' is a cell-by-cell comparison.")
+                             "the values of sort_column specified.  'aligned' lines up rows by their content " +
+                             "without a key, so inserted and deleted rows do not shift later rows.  " +
+                             "'default' is a cell-by-cell comparison.")
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--sort_column", "-s", type=int, default=None,
                        help="numeric offset (1-based) of column to use for sorting.  " +
@@ -121,9 +151,57 @@ def compare_excel_configure_arg_parser():
     parser.add_argument("--summary", "-y", type=bool, default=True, help="if True, add a summary sheet to the output."
                                                                          "Summary module assumes every 3rd sheet in "
                                                                          "workbook contains comparison.")
+    parser.add_argument("--csv_types", "-T", nargs="+", default=None,
+                        help="space separated list of column=type pairs that override the column types inferred " +
+                             "for csv files.  Column is a 1-based index or header name.  Type is int, float, date " +
+                             "or str.  E.g. '-T 1=str Amount=float'")
+    parser.add_argument("--memory_map", "-k", action="store_true",
+                        help="if both files are csv and compare type is not 'sorted', memory-map the files and only " +
+                             "compare values of rows whose bytes differ.  Faster when most rows are identical.")
+    parser.add_argument("--sample", "-f", type=float, default=None,
+                        help="only compare this share of rows, between 0 and 1.  E.g. '-f 0.05' compares 5%% of " +
+                             "rows.  The summary estimates the difference rate of each column with a 95%% " +
+                             "confidence interval.")
+    parser.add_argument("--sample_method", "-F", default=None, choices=["key", "fraction"],
+                        help="'key' samples rows by a hash of the sort columns, so both sides sample the same keys.  " +
+                             "'fraction' samples one row in every 1 / sample rows by position.  Defaults to 'key' " +
+                             "if a sort column is supplied, otherwise 'fraction'.")
+    parser.add_argument("--rules", "-r", nargs="+", default=None,
+                        help="space separated list of column=rule pairs that change how a column is compared.  " +
+                             "Column is a 1-based index or header name.  Rule is abs:<tolerance>, " +
+                             "rel:<tolerance>, date:<format>, nocase, trim, nocase+trim or ignore.  " +
+                             "E.g. '-r Amount=abs:0.01 Rate=rel:0.001 Name=nocase 4=ignore'")
+    parser.add_argument("--check", "-q", action="store_true",
+                        help="only check if the files are equal.  Stops at the first difference above the threshold " +
+                             "and exits with code 0 if the files are equal or 1 if they differ.  No output file is " +
+                             "written.  A sheet found in only one file counts as a difference.")
+    parser.add_argument("--max_differences", "-N", type=int, default=1,
+                        help="with --check, stop after this many differences and log them.  Default 1.")
+    parser.add_argument("--column_matching", "-M", default="position", choices=["position", "name"],
+                        help="'name' matches columns by header name, so added or reordered columns do not shift the " +
+                             "comparison.  Columns only found in one file are listed in the summary.  'position' " +
+                             "compares the first column with the first column, and so on.")
+    parser.add_argument("--work_dir", "-W", default=None,
+                        help="directory for checkpoints.  Each compared sheet pair, or shard of rows with --workers, " +
+                             "is saved there as soon as it is done, so a run that fails can be resumed with --resume.")
+    parser.add_argument("--resume", "-R", action="store_true",
+                        help="with --work_dir, load the work saved by an earlier run of the same comparison instead " +
+                             "of comparing it again")
+    parser.add_argument("--workers", "-w", type=int, default=None,
+                        help="compare the rows of each sheet in shards using this many processes.  Useful for a " +
+                             "single sheet with millions of rows.  Sheets under 100,000 rows are compared in one " +
+                             "process.")
+    parser.add_argument("--compact", "-C", action="store_true",
+                        help="store Same and Different as 0 and 1 formatted to show the text, and store each " +
+                             "distinct text once.  Makes large outputs smaller and faster to save and open.")
+    parser.add_argument("--watch", "-i", type=float, nargs="?", const=1.0, default=None, metavar="SECONDS",
+                        help="keep running and compare again whenever one of the files changes, checking every " +
+                             "SECONDS (default 1).  Only changed sheets and rows are compared again, then the output " +
+                             "file is rewritten.  Stop with Ctrl+C.")
 
     return parser
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # large csv files are parsed in worker processes, also in frozen executables
     run_from_command_line()
@@ -0,0 +1,119 @@
+"""
+This module sends a job to a running comparison service (see compare_service) and prints its progress.  It only
+imports the standard library, so it starts quickly.
+
+The job type is compare, summary, sql_compare or sql_compare_file.  Its arguments are the keyword arguments of the
+library function that runs it (compare_files, write_summary_file, run_sql_comparison or process_file) as JSON.
+The token of the service is read from the token file the service wrote when it started.
+
+Example:
+    python compare_client.py compare -a "{\"left_path\": \"left.xlsx\", \"right_path\": \"right.xlsx\",
+                                          \"output_path\": \"output.xlsx\", \"compare_type\": \"sorted\",
+                                          \"sort_column\": 1}"
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import sys
+
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+TOKEN_FILE = os.path.join(os.path.expanduser("~"), ".xl_diff_service_token")
+TOKEN_HEADER = "X-Service-Token"
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a Unix socket
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def submit_job(job_type, job_args, host=SERVICE_HOST, port=SERVICE_PORT, socket_path=None, on_message=None,
+               token_file=TOKEN_FILE):
+    """
+    Send a job to the comparison service and wait for it to finish
+    :param job_type: compare, compare_multi, summary, sql_compare or sql_compare_file
+    :param job_args: dictionary of keyword arguments of the job
+    :param host: address of the service
+    :param port: port of the service
+    :param socket_path: if supplied, connect to the service on this Unix socket instead of a port
+    :param on_message: function called with each log message of the job as it runs (optional)
+    :param token_file: file with the token of the service, written by the service when it started
+    :return: dictionary with the status of the job ("ok" or "error") and its result or error
+    """
+    with open(token_file) as f:
+        token = f.read().strip()
+    connection = UnixHTTPConnection(socket_path) if socket_path else http.client.HTTPConnection(host, port)
+    try:
+        body = json.dumps({"type": job_type, "args": job_args})
+        connection.request("POST", "/jobs", body, {"Content-Type": "application/json", TOKEN_HEADER: token})
+        response = connection.getresponse()
+        if response.status != 200:
+            return {"status": "error", "error": "service returned {} {}".format(response.status, response.reason)}
+        result = {"status": "error", "error": "service closed the connection before the job finished"}
+        for line in response:  # one JSON message per line, streamed while the job runs
+            message = json.loads(line)
+            if "status" in message:
+                result = message
+            elif on_message is not None:
+                on_message(message)
+        return result
+    finally:
+        connection.close()
+
+
+def run_from_command_line():
+    parser = compare_client_configure_arg_parser()
+    args = parser.parse_args()
+    if args.args_file:
+        with open(args.args_file) as f:
+            job_args = json.load(f)
+    else:
+        job_args = json.loads(args.args or "{}")
+
+    result = submit_job(args.job_type, job_args, args.host, args.port, args.socket,
+                        on_message=lambda m: print(m["message"], file=sys.stderr, flush=True),
+                        token_file=args.token_file)
+    if result["status"] != "ok":
+        print(result["error"], file=sys.stderr)
+        sys.exit(1)
+    if result.get("result") is not None:
+        print(result["result"])
+
+
+def compare_client_configure_arg_parser():
+    """
+    instantiates and configures an ArgumentParser class object.  Each argument is a mandatory or optional parameter
+    that can be invoked from the command line.
+    :return: argument parser object
+    """
+    parser = argparse.ArgumentParser(description="Send a job to a running comparison service and print its progress.")
+    parser.add_argument("job_type", choices=["compare", "compare_multi", "summary", "sql_compare", "sql_compare_file"],
+                        help="type of job")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--args", "-a", default=None,
+                       help="keyword arguments of the job as a JSON object, e.g. "
+                            + "{\"left_path\": \"left.xlsx\", \"right_path\": \"right.xlsx\", "
+                            + "\"output_path\": \"output.xlsx\"}")
+    group.add_argument("--args_file", "-f", default=None, help="path to a JSON file with the arguments of the job")
+    parser.add_argument("--host", "-H", default=SERVICE_HOST, help="address of the service")
+    parser.add_argument("--port", "-P", type=int, default=SERVICE_PORT, help="port of the service")
+    parser.add_argument("--socket", "-u", default=None, help="connect to the service on this Unix socket")
+    parser.add_argument("--token_file", "-k", default=TOKEN_FILE,
+                        help="file with the token of the service.  Defaults to .xl_diff_service_token in the home " +
+                             "folder.")
+    return parser
+
+
+if __name__ == "__main__":
+    run_from_command_line()
@@ -0,0 +1,92 @@
+"""
+This module compares the same report from several environments (e.g. dev, uat and prod) in one pass.  Every file is
+loaded once, rows are lined up by key across all files in a single merge, and one output file shows the values of
+every file side by side with a difference column for every pair of files.  The summary counts the differences of
+every column and pair of files.
+
+Example:
+    python compare_multi.py dev/report.xlsx uat/report.xlsx prod/report.xlsx output.xlsx -c sorted -s 1
+"""
+import argparse
+import logging
+import multiprocessing
+
+import xl_diff
+from xl_diff.convert import parse_schema
+from xl_diff.rules import parse_rules
+
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)-15s %(message)s')
+
+
+def run_from_command_line():
+    """
+    Parse command line arguments and run comparison of several excel / CSV files
+    :return: None
+    """
+    parser = compare_multi_configure_arg_parser()
+    args = parser.parse_args()
+    sort_column_arg = args.sort_column if args.sort_column else args.sort_column_list
+    if args.compare_type == "sorted" and sort_column_arg is None:
+        parser.error("sort column or sort column list must be supplied if compare type is sorted")
+    if len(args.files) < 2:
+        parser.error("at least two files are needed for a comparison")
+    if args.labels is not None and len(args.labels) != len(args.files):
+        parser.error("supply one label per file")
+    try:
+        csv_schema = parse_schema(args.csv_types)
+        rules = parse_rules(args.rules)
+    except ValueError as e:
+        parser.error(str(e))
+    xl_diff.compare_files_multi(args.files, args.output, args.labels, args.threshold, sort_column_arg,
+                                args.compare_type, not args.no_header, args.sheet_matching, args.summary, csv_schema,
+                                rules, args.open)
+
+
+def compare_multi_configure_arg_parser():
+    """
+    instantiates and configures an ArgumentParser class object.  Each argument is a mandatory or optional parameter
+    that can be invoked from the command line.
+    :return: argument parser object
+    """
+    parser = argparse.ArgumentParser(description="Compare the same report from several Excel (XLSX) or CSV files in " +
+                                                 "one pass.  Create a new excel file with the values of every file " +
+                                                 "side by side along with the differences of every pair of files.")
+    parser.add_argument("files", nargs="+", help="Paths of the files to compare, e.g. the dev, uat and prod " +
+                                                 "versions of a report.  Can be CSV or XLSX.")
+    parser.add_argument("output", help="Path to output file.  If file exists it will be overwritten.")
+    parser.add_argument("--labels", "-L", nargs="+", default=None,
+                        help="short name of each file, used in sheet names and the summary.  E.g. '-L dev uat prod'.  " +
+                             "Defaults to the file names, or the folder names if the file names are the same.")
+    parser.add_argument("--threshold", '-t', type=float, default=0.001,
+                        help="threshold for numeric values to be considered different.  e.g. when threshold = 0.01 " +
+                             "if values are closer than 0,01 then consider the same.")
+    parser.add_argument("--open", '-p', type=bool, default=False, help="if true, open output file on completion " +
+                                                                       "using os.system.")
+    parser.add_argument("--compare_type", '-c', default="default", choices=["default", "sorted"],
+                        help="if set to 'sorted', rows of every file are lined up by the values of the sort " +
+                             "columns.  'default' is a cell-by-cell comparison.")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--sort_column", "-s", type=int, default=None,
+                       help="numeric offset (1-based) of column to use for sorting.  To be used for a primary key.")
+    group.add_argument("--sort_column_list", "-l", nargs="+", type=int, default=None,
+                       help="space separated list of numbers for columns to use for sorting.  E.g. '-l 1 2' would " +
+                            "be both the first and second columns.")
+    parser.add_argument("--no_header", "-d", action="store_true",
+                        help="if sheets do not have headers, set this flag so headers can be excluded from comparison")
+    parser.add_argument("--sheet_matching", "-m", default="order", choices=["name", "order"],
+                        help="If name, only sheets found in every file are compared.  If order, sheets are " +
+                             "compared in order.  E.g. 1st sheet vs 1st sheet.")
+    parser.add_argument("--summary", "-y", type=bool, default=True, help="if True, add a summary sheet to the output")
+    parser.add_argument("--csv_types", "-T", nargs="+", default=None,
+                        help="space separated list of column=type pairs that override the column types inferred " +
+                             "for csv files.  E.g. '-T 1=str Amount=float'")
+    parser.add_argument("--rules", "-r", nargs="+", default=None,
+                        help="space separated list of column=rule pairs that change how a column is compared.  " +
+                             "Rule is abs:<tolerance>, rel:<tolerance>, date:<format>, nocase, trim, nocase+trim " +
+                             "or ignore.  E.g. '-r Amount=abs:0.01 Name=nocase 4=ignore'")
+    return parser
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()  # large csv files are parsed in worker processes, also in frozen executables
+    run_from_command_line()
@@ -0,0 +1,44 @@
+"""
+This module starts a long-lived comparison service.  Comparisons sent to the service by compare_client run in this
+process, so they do not pay for interpreter start, imports and ODBC driver load on every run.
+
+Example:
+    python compare_service.py -P 8765 -x 600
+"""
+import argparse
+import logging
+from xl_diff.service import serve, SERVICE_HOST, SERVICE_PORT, TOKEN_FILE
+
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)-15s %(message)s')
+
+
+def run_from_command_line():
+    parser = compare_service_configure_arg_parser()
+    args = parser.parse_args()
+    serve(args.host, args.port, args.socket, args.cache_ttl, args.cache_dir, args.token_file)
+
+
+def compare_service_configure_arg_parser():
+    """
+    instantiates and configures an ArgumentParser class object.  Each argument is a mandatory or optional parameter
+    that can be invoked from the command line.
+    :return: argument parser object
+    """
+    parser = argparse.ArgumentParser(description="Run a comparison service that accepts compare, summary and sql "
+                                                 "compare jobs from compare_client.")
+    parser.add_argument("--host", "-H", default=SERVICE_HOST,
+                        help="address to listen on.  Defaults to localhost, so only local clients can send jobs.")
+    parser.add_argument("--port", "-P", type=int, default=SERVICE_PORT, help="port to listen on")
+    parser.add_argument("--socket", "-u", default=None,
+                        help="listen on this Unix socket instead of a port (not available on Windows)")
+    parser.add_argument("--cache_ttl", "-x", type=int, default=None,
+                        help="cache query results for this many seconds.  The cache is shared by every job.")
+    parser.add_argument("--cache_dir", "-X", default=None, help="directory for cached query results")
+    parser.add_argument("--token_file", "-k", default=TOKEN_FILE,
+                        help="file the token of the service is written to.  Only the current user can read it, and " +
+                             "clients must send the token.  Defaults to .xl_diff_service_token in the home folder.")
+    return parser
+
+
+if __name__ == "__main__":
+    run_from_command_line()
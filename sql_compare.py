@@ -8,10 +8,13 @@ This module is intended to be called as an entry point from the command line
 """
 import argparse
 
-from xl_diff import run_sql_comparison
+import xl_diff
 import logging
 
 from xl_diff.validators import is_number
+from xl_diff.rules import parse_rules
+from xl_diff.sampling import get_sample_method
+from xl_diff.sql_text import has_order_by
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)-15s %(message)s')
 
@@ -35,10 +38,23 @@ def run_from_command_line():
     logging.info("Has Header: {}".format(has_header_flag))
     logging.info(f"sorting column: {sort_column_arg}")
 
+    try:
+        rules = parse_rules(args.rules)
+        sample_method = get_sample_method(args.sample, args.sample_method, sort_column_arg) if args.sample else None
+    except ValueError as e:
+        parser.error(str(e))
+    if args.sample and (args.pipelined or args.pushdown or args.reconcile):
+        parser.error("sampling cannot be combined with --pipelined, --pushdown or --reconcile")
+    if args.pipelined and args.compare_type == "sorted" and not all(has_order_by(q) for q in (args.query,
+                                                                                            args.query_right) if q):
+        parser.error("a sorted --pipelined comparison needs an ORDER BY at the end of both queries")
+
     # perform comparison
-    run_sql_comparison(args.left, args.right, args.output, args.query, args.query_right, args.left_file, args.right_file
-                       , args.threshold, args.open, sort_column_arg, args.compare_type, has_header_flag,
-                       args.sheet_matching, args.summary, args.multithreaded)
+    xl_diff.run_sql_comparison(args.left, args.right, args.output, args.query, args.query_right, args.left_file,
+                               args.right_file, args.threshold, args.open, sort_column_arg, args.compare_type,
+                               has_header_flag, args.sheet_matching, args.summary, args.multithreaded, args.timeout,
+                               args.pipelined, args.pushdown, args.reconcile, args.hash_expression,
+                               sample_fraction=args.sample, sample_method=sample_method, rules=rules)
 
 
 def sql_compare_configure_arg_parser():
@@ -69,7 +85,9 @@ def sql_compare_configure_arg_parser():
                              "on windows machines.")  # open on finish
     parser.add_argument("--compare_type", '-c', default="default",  # sorted or cell-by-cell comparison
                         help="if set to 'sorted', the comparison tool will attempt to line up each side based on " +
-                             "the values of sort_column specified.  'default' is a cell-by-cell comparison.")
+                             "the values of sort_column specified.  'aligned' lines up rows by their content " +
+                             "without a key, so inserted and deleted rows do not shift later rows.  " +
+                             "'default' is a cell-by-cell comparison.")
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--sort_column", "-s", type=int, default=None,
                        help="numeric offset (1-based) of column to use for sorting.  " +
@@ -90,6 +108,34 @@ def sql_compare_configure_arg_parser():
                              "workbook contains comparison.")
     parser.add_argument("--multithreaded", "-M", action="store_true",
                         help="run both sql commands at the same time using multithreading")
+    parser.add_argument("--timeout", "-T", type=int, default=None,
+                        help="query timeout in seconds.  A query that runs longer is cancelled.")
+    parser.add_argument("--pipelined", "-P", action="store_true",
+                        help="compare rows while both queries are still fetching.  With compare type 'sorted' rows are " +
+                             "matched by key and both queries must end with an ORDER BY, otherwise by position.  " +
+                             "Left and right results are only saved in the output file.")
+    parser.add_argument("--pushdown", "-D", action="store_true",
+                        help="compute the difference on the server with EXCEPT and only fetch rows that differ.  " +
+                             "Both connection strings must point to the same server.  Needs a sort column.")
+    parser.add_argument("--reconcile", "-H", action="store_true",
+                        help="compare row counts and hashes of key ranges on each server first and only fetch the " +
+                             "ranges that differ.  The first sort column must hold integers.")
+    parser.add_argument("--hash_expression", "-E", default="CHECKSUM_AGG(BINARY_CHECKSUM(*))",
+                        help="aggregate SQL expression used to hash key ranges with --reconcile.  The default works " +
+                             "on SQL Server.")
+    parser.add_argument("--rules", "-r", nargs="+", default=None,
+                        help="space separated list of column=rule pairs that change how a column is compared.  " +
+                             "Column is a 1-based index or header name.  Rule is abs:<tolerance>, " +
+                             "rel:<tolerance>, date:<format>, nocase, trim, nocase+trim or ignore.  " +
+                             "E.g. '-r Amount=abs:0.01 Rate=rel:0.001 Name=nocase 4=ignore'")
+    parser.add_argument("--sample", "-f", type=float, default=None,
+                        help="only compare this share of rows, between 0 and 1.  E.g. '-f 0.05' compares 5%% of " +
+                             "rows.  The summary estimates the difference rate of each column with a 95%% " +
+                             "confidence interval.")
+    parser.add_argument("--sample_method", "-F", default=None, choices=["key", "fraction"],
+                        help="'key' samples rows by a hash of the sort columns, so both sides sample the same keys.  " +
+                             "'fraction' samples one row in every 1 / sample rows by position.  Defaults to 'key' " +
+                             "if a sort column is supplied, otherwise 'fraction'.")
 
     return parser
 
@@ -4,7 +4,7 @@ a separate comparison will be run
 """
 import argparse
 import logging
-from xl_diff.sql_compare_file import process_file
+import xl_diff
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)-15s %(message)s')
 
@@ -23,9 +23,13 @@ def run_from_command_line():
     logging.info("Input file: {}".format(input_file))
     logging.info("Multithreading off: {}".format(args.multithreading_off))
     logging.info("Compare only: {}".format(args.compare_only))
+    logging.info("Asynchronous: {}".format(args.asynchronous))
 
     multithreaded = not args.multithreading_off #invert the boolean
-    process_file(has_header_flag, input_file, multithreaded=multithreaded, compare_only=args.compare_only)
+    xl_diff.process_file(has_header_flag, input_file, multithreaded=multithreaded, compare_only=args.compare_only,
+                         asynchronous=args.asynchronous, timeout=args.timeout, max_concurrent=args.max_concurrent,
+                         cache_ttl=args.cache_ttl, cache_dir=args.cache_dir, work_dir=args.work_dir,
+                         resume=args.resume)
 
 
 def sql_compare_file_configure_arg_parser():
@@ -59,6 +63,9 @@ def sql_compare_file_configure_arg_parser():
     Has Header              -   When true, skips the first row when sorting
     Sheet Matching          -   When true, attempts to match sheets by name.  Otherwise, uses order.
     Add Summary             -   When true, adds a summary page with count of differences by column
+    Column Rules            -   (optional) semicolon-separated column=rule pairs, e.g. "Amount=abs:0.01;Name=nocase".
+                                Rule is abs:<tolerance>, rel:<tolerance>, date:<format>, nocase, trim, nocase+trim
+                                or ignore
                         """)
 
     parser.add_argument("--no_header", "-d", action="store_true",  # inidicates first column is not a header
@@ -68,6 +75,24 @@ def sql_compare_file_configure_arg_parser():
                         help="if flag is present, do not run both sql commands at the same time via multithreading")
     parser.add_argument("--compare_only", "-C", action="store_true",
                         help="if flag is present, do not run sql.  Only perform the comparison.")
+    parser.add_argument("--asynchronous", "-A", action="store_true",
+                        help="if flag is present, process lines concurrently.  Queries of later lines run while "
+                             + "earlier lines are compared.  Each line must use its own left, right and output files.")
+    parser.add_argument("--timeout", "-t", type=int, default=None,
+                        help="query timeout in seconds.  A query that runs longer is cancelled and its line fails.")
+    parser.add_argument("--max_concurrent", "-n", type=int, default=4,
+                        help="maximum number of lines processed at the same time with --asynchronous")
+    parser.add_argument("--cache_ttl", "-x", type=int, default=None,
+                        help="cache query results for this many seconds.  A query repeated on the same connection, "
+                             + "e.g. the same left query on every line, only runs once.")
+    parser.add_argument("--cache_dir", "-X", default=None,
+                        help="directory for cached query results.  Results saved there by an earlier run are used "
+                             + "until they expire.  Without it, results are only cached while the file is processed.")
+    parser.add_argument("--work_dir", "-W", default=None,
+                        help="directory for checkpoints.  Each finished line is saved there, so a run that fails "
+                             + "can be resumed with --resume.")
+    parser.add_argument("--resume", "-R", action="store_true",
+                        help="with --work_dir, skip lines finished by an earlier run of the same job file")
 
     return parser
 
@@ -24,7 +24,7 @@ import argparse
 import os
 import logging
 
-from xl_diff import write_summary_file
+import xl_diff
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)-15s %(message)s')
 
@@ -68,6 +68,6 @@ if __name__ == "__main__":
     logging.info(f"input path {in_path}")
     logging.info(f"output path {out_path}")
 
-    write_summary_file(in_path, out_path)
+    xl_diff.write_summary_file(in_path, out_path)
     if args.open:
         os.system(out_path)
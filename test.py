@@ -1,21 +1,51 @@
 """
 This module contains unit tests for the comparison library
 """
+import asyncio
+import http.client
 import re
+import subprocess
+import sys
+import threading
 import unittest
-from datetime import datetime
+import zipfile
+from unittest import mock
+from datetime import datetime, date, timedelta
+from decimal import Decimal
 
 import openpyxl as xl
+from openpyxl.styles import PatternFill
 import csv
 from itertools import zip_longest
 from xl_diff import compare_files, SqlCompare, SummaryNode, summarize_differences, write_summary_file, is_number, \
-    is_date, ValueNode, make_sorted_sheet, sort_values, SqlToXl, process_file,convert_csv_to_excel
+    is_date, ValueNode, make_sorted_sheet, sort_values, SqlToXl, process_file,convert_csv_to_excel, files_are_equal, \
+    find_differences
+from xl_diff.backends import load_workbook, save_workbook
+from xl_diff.convert import infer_column_types, get_converters, convert_row
+from xl_diff.parallel_csv import read_csv_rows_parallel
+from xl_diff.parallel_xlsx import write_xlsx_parallel
+from xl_diff.result_cache import ResultCache, normalize_sql
+from xl_diff.summary import wilson_interval, get_nodes_for_workbook_path
+from xl_diff.rules import make_comparator, parse_rules
+from xl_diff.compare import compare_sheet
+from xl_diff.rowmap import RowMap
+from xl_diff.sampling import get_sample_method
+from xl_diff.equality import iter_row_pairs
+from xl_diff.sharded import compare_sheet_sharded
+from xl_diff.alignment import align_sequences, align_rows, row_hash
+from xl_diff.service import make_service
+from xl_diff.sql_compare_file import check_job_files, read_job_file
+from xl_diff.watch import WatchSession
+from xl_diff.multiway import compare_files_multi, merge_sorted_keys
+from xl_diff.sql_text import has_order_by, strip_query
 from dateutil.parser import parse
 import os
 
 from sql_compare import sql_compare_configure_arg_parser
 from compare import compare_excel_configure_arg_parser
 from sql_compare_file import sql_compare_file_configure_arg_parser
+from compare_client import submit_job
+from compare_multi import compare_multi_configure_arg_parser
 
 # logging.basicConfig(level=logging.DEBUG, format='%(asctime)-15s %(message)s')
 
@@ -35,6 +65,8 @@ TESTS_OUTPUT2_XLSX = r"tests\output2.xlsx"
 TESTS_RIGHT2_CSV = r"tests\right2.csv"
 
 TESTS_LEFT_CSV = r"tests\left.csv"
+TESTS_JOBS_TXT = r"tests\jobs.txt"
+TESTS_SERVICE_TOKEN = r"tests\service_token.txt"
 
 TESTS_OUTPUT_XLSX = r"tests\output.xlsx"
 
@@ -50,6 +82,35 @@ TEST_DB_RIGHT_MULTI_XLSX = r".\test_db\right_multithreaded.xlsx"
 
 TEST_DB_LEFT_MULTI_XLSX = r".\test_db\left_multithreaded.xlsx"
 
+TESTS_QUOTED_CSV = r"tests\quoted.csv"
+
+TESTS_OUTPUT_CSV_XLSX = r"tests\output_csv.xlsx"
+TESTS_OUTPUT_MMAP_XLSX = r"tests\output_mmap.xlsx"
+TESTS_OUTPUT_SAMPLE_XLSX = r"tests\output_sample.xlsx"
+TESTS_OUTPUT_RULES_XLSX = r"tests\output_rules.xlsx"
+TESTS_REORDERED_XLSX = r"tests\reordered.xlsx"
+TESTS_OUTPUT_COLUMNS_XLSX = r"tests\output_columns.xlsx"
+TESTS_OUTPUT_RESUME_XLSX = r"tests\output_resume.xlsx"
+TESTS_WORK_DIR = r"tests\work"
+TESTS_CACHE_DIR = r"tests\cache"
+
+TESTS_LEFT_PARQUET = r"tests\left.parquet"
+TESTS_RIGHT_PARQUET = r"tests\right.parquet"
+TESTS_OUTPUT_PARQUET = r"tests\output.parquet"
+TESTS_OUTPUT_PARQUET_XLSX = r"tests\output_parquet.xlsx"
+TESTS_OUTPUT_PARALLEL_XLSX = r"tests\output_parallel.xlsx"
+TESTS_OUTPUT_SERVICE_XLSX = r"tests\output_service.xlsx"
+TESTS_OUTPUT_COMPACT_XLSX = r"tests\output_compact.xlsx"
+TESTS_WATCH_RIGHT_XLSX = r"tests\watch_right.xlsx"
+TESTS_OUTPUT_WATCH_XLSX = r"tests\output_watch.xlsx"
+TESTS_OUTPUT_WATCH_FULL_XLSX = r"tests\output_watch_full.xlsx"
+TESTS_OUTPUT_MULTI_XLSX = r"tests\output_multi.xlsx"
+TESTS_RIGHT2_XLSX = r"tests\right2.xlsx"
+
+STARTUP_MODULES = ("xl_diff", "compare", "compare_multi", "sql_compare", "sql_compare_file", "summary")
+STARTUP_HEAVY_MODULES = ("openpyxl", "dateutil", "pyodbc", "pyarrow", "distutils")
+STARTUP_IMPORT_BUDGET = 0.5  # seconds to import every command line module, about the time of one eager import
+
 TESTS_CMD_OUTPUT_XLSX = r"test_cmd_line\output.xlsx"
 TESTS_CMD_LEFT_XLSX = r"test_cmd_line\left.xlsx"
 TESTS_CMD_RIGHT_XLSX = r"test_cmd_line\right.xlsx"
@@ -74,6 +135,98 @@ class TestConvert(unittest.TestCase):
                     cells_checked += 1
             self.assertGreater(cells_checked, 0)  # greater than zero
 
+    def test_infer_column_types(self):
+        rows = [["Id", "Account", "Amount", "Trade Date", "Name"],
+                ["1", "007", "1.5", "1/2/2019", "a"],
+                ["2", "010", "", "1/3/2019", "2"]]
+        types = infer_column_types(rows, True)
+        self.assertEqual(types, ["int", "str", "float", "date", "str"])
+
+        converters = get_converters(types, rows, True)
+        self.assertEqual(convert_row(rows[1], converters), [1, "007", 1.5, datetime(2019, 1, 2), "a"])
+        self.assertEqual(convert_row(rows[2], converters)[2], None)  # empty number is None
+
+        types = infer_column_types(rows, True, {"Id": "str", 3: "str"})  # schema overrides inferred types
+        self.assertEqual(types, ["str", "str", "str", "date", "str"])
+
+        converters = get_converters(["date"], [["Jan 2nd 2019"], ["March 3rd 2019"]], False)  # no fixed format
+        self.assertEqual(convert_row(["June 4th 2019"], converters), [datetime(2019, 6, 4)])
+        self.assertEqual(convert_row(["March"], converters), ["March"])  # not filled in from today's date
+
+        rows = [["Month", "Version", "Range", "Share", "Time"], ["March", "1.2.3", "10-12", "1/2", "3 PM"],
+                ["Apr", "1.2.4", "13-15", "3/4", "4 PM"]]
+        self.assertEqual(infer_column_types(rows, True), ["str"] * 5)
+        self.assertEqual(convert_row(rows[1], get_converters(["str"] * 5, rows, True)), rows[1])
+
+    def test_read_csv_parallel(self):
+        """
+        Split a csv file with quoted newlines into small chunks and check the rows match a single csv reader
+        :return: None
+        """
+        with open(TESTS_QUOTED_CSV, "w", newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(["Id", "Text"])
+            for i in range(0, 200):
+                writer.writerow([i, 'line\n"quoted"\nend' * (i % 3)])
+        rows = list(read_csv_rows_parallel(TESTS_QUOTED_CSV, workers=2, chunk_size=256))
+        with open(TESTS_QUOTED_CSV, newline='') as csv_file:
+            expected = list(csv.reader(csv_file))
+        self.assertEqual(len(rows), len(expected))
+        self.assertEqual(rows[0], expected[0])  # header is kept as text
+        for (row, expected_row) in zip(rows[1:], expected[1:]):
+            self.assertEqual(row, [int(expected_row[0]), expected_row[1]])
+        os.remove(TESTS_QUOTED_CSV)
+
+
+class TestBackends(unittest.TestCase):
+    """
+    Test reading and writing files with the reader and writer backends
+    """
+
+    def setUp(self):
+        save_workbook(xl.load_workbook(TESTS_LEFT_XLSX), TESTS_LEFT_PARQUET)
+        save_workbook(xl.load_workbook(TESTS_RIGHT_XLSX), TESTS_RIGHT_PARQUET)
+
+    def test_unknown_extension(self):
+        with self.assertRaises(ValueError):
+            load_workbook(r"tests\left.txt")
+
+    def test_compare_files_parquet(self):
+        compare_files(TESTS_LEFT_PARQUET, TESTS_RIGHT_PARQUET, TESTS_OUTPUT_PARQUET_XLSX, open_on_finish=False,
+                      sort_column=2, compare_type="sorted", sheet_matching="order")
+        wb = xl.load_workbook(TESTS_OUTPUT_PARQUET_XLSX)
+        ws = wb.worksheets[2]  # third worksheet is diff
+        self.assertEqual(ws.cell(row=1, column=3).value, "Same")  # sheet_name column is the same on both sides
+        self.assertEqual(ws.cell(row=1, column=4).value, "Header")
+
+    def test_write_parquet(self):
+        compare_files(TESTS_LEFT_XLSX, TESTS_RIGHT_XLSX, TESTS_OUTPUT_PARQUET, open_on_finish=False,
+                      sort_column=1, compare_type="sorted", sheet_matching="order")
+        wb = load_workbook(TESTS_OUTPUT_PARQUET)
+        self.assertEqual(wb.active.cell(row=1, column=1).value, "sheet_name")
+        self.assertGreater(wb.active.max_row, 1)
+
+    def test_write_xlsx_parallel(self):
+        """
+        Write sheets in small chunks of rows and check values and styles match the workbook
+        :return: None
+        """
+        wb = xl.load_workbook(TESTS_RIGHT_XLSX)
+        ws = wb.worksheets[0]
+        ws.append([datetime(2019, 1, 2), " padded ", "=1+1", True, 1.5])
+        ws.cell(row=1, column=1).fill = PatternFill(start_color='FFFF0000', end_color='FFFF0000', fill_type='solid')
+        ws.row_dimensions[20].height = 30
+        wb.create_sheet("empty")
+        write_xlsx_parallel(wb, TESTS_OUTPUT_PARALLEL_XLSX, workers=2, chunk_rows=2)
+
+        saved_wb = xl.load_workbook(TESTS_OUTPUT_PARALLEL_XLSX)
+        self.assertEqual(saved_wb.sheetnames, wb.sheetnames)
+        saved = saved_wb.worksheets[0]
+        self.assertEqual(list(saved.iter_rows(values_only=True)), list(ws.iter_rows(values_only=True)))
+        self.assertEqual(saved.cell(row=1, column=1).fill.start_color.rgb, 'FFFF0000')
+        self.assertEqual(saved.row_dimensions[20].height, 30)
+        self.assertEqual(saved.dimensions, ws.dimensions)
+
 
 class TestExcel(unittest.TestCase):
     """
@@ -132,8 +285,8 @@ class TestExcel(unittest.TestCase):
             ["Row 1", "Row 1", "Same", "1", 1, 0, "2", 3, 1],
             ["Row 2", "Row 2", "Same", "z", "z", "Same", "Q", "W", "Different"],
             ["Row 3", None, "Different", "extra", None, "Different", "row", None, "Different"],
-            ["Row 4", "Row 4", "Same", "1/1/2019", datetime(2019, 1, 1), "Different", "2/2/2012",
-             datetime(2012, 2, 1), "Different"]
+            ["Row 4", "Row 4", "Same", "1/1/2019", datetime(2019, 1, 1), 0, "2/2/2012",
+             datetime(2012, 2, 1), -1]  # date text and date cells differ by days
         ]
 
         wb = xl.load_workbook(TESTS_OUTPUT_XLSX)
@@ -160,8 +313,8 @@ class TestExcel(unittest.TestCase):
             ["Row 1", "Row 1", "Same", "1", 1, 0, "2", 3, 1],
             ["Row 2", "Row 2", "Same", "z", "z", "Same", "Q", "W", "Different"],
             ["Row 3", None, "Different", "extra", None, "Different", "row", None, "Different"],
-            ["Row 4", "Row 4", "Same", "1/1/2019", "1/1/2019", "Same", "2/2/2012",
-             "2/1/2012", "Different"]
+            ["Row 4", "Row 4", "Same", "1/1/2019", "1/1/2019", 0, "2/2/2012",
+             "2/1/2012", -1]  # dates differ by days
         ]
         wb = xl.load_workbook(TESTS_OUTPUT2_XLSX)
         ws = wb.worksheets[2]  # third worksheet is diff
@@ -177,6 +330,188 @@ class TestExcel(unittest.TestCase):
                 else:
                     self.assertEqual(str(value), str(expected_value))
 
+    def test_compare_files_csv_memory_map(self):
+        """
+        Compare csv files with and without memory maps and check the comparison sheets are the same
+        :return: None
+        """
+        compare_files(TESTS_LEFT_CSV, TESTS_RIGHT2_CSV, TESTS_OUTPUT_CSV_XLSX, open_on_finish=False,
+                      sheet_matching="order")
+        compare_files(TESTS_LEFT_CSV, TESTS_RIGHT2_CSV, TESTS_OUTPUT_MMAP_XLSX, open_on_finish=False,
+                      sheet_matching="order", memory_map=True)
+        expected = list(xl.load_workbook(TESTS_OUTPUT_CSV_XLSX).worksheets[2].iter_rows(values_only=True))
+        actual = list(xl.load_workbook(TESTS_OUTPUT_MMAP_XLSX).worksheets[2].iter_rows(values_only=True))
+        self.assertEqual(actual, expected)
+
+    def test_compare_files_sampled(self):
+        """
+        Sample every row by key and check the estimated rates, then sample half of the rows by position
+        :return: None
+        """
+        compare_files(self.left_xlsx, self.right_xlsx, TESTS_OUTPUT_SAMPLE_XLSX, open_on_finish=False,
+                      sort_column=1, compare_type="sorted", sheet_matching="order", sample_fraction=1)
+        summary = list(xl.load_workbook(TESTS_OUTPUT_SAMPLE_XLSX)["summary"].iter_rows(values_only=True))
+        self.assertEqual(summary[0][6:], ("Estimated Rate", "95% CI Low", "95% CI High"))
+        self.assertEqual([(r[1], r[6]) for r in summary[1:]],
+                         [("Header", "25.00%"), ("Col A", "25.00%"), ("Col B", "100.00%")])
+
+        compare_files(self.left_xlsx, self.right_xlsx, TESTS_OUTPUT_SAMPLE_XLSX, open_on_finish=False,
+                      sheet_matching="order", sample_fraction=0.5, sample_method="fraction")
+        ws = xl.load_workbook(TESTS_OUTPUT_SAMPLE_XLSX).worksheets[2]
+        self.assertEqual([ws.cell(row=r, column=1).value for r in range(1, ws.max_row + 1)],
+                         ["Header", "Row 2", "Row 3"])  # header and every second row
+
+    def test_get_sample_method(self):
+        """
+        Sample by key if there is a sort column, otherwise by position.  Sampling by key needs a sort column.
+        :return: None
+        """
+        self.assertEqual(get_sample_method(0.05, None, [1]), "key")
+        self.assertEqual(get_sample_method(0.05, None, None), "fraction")
+        with self.assertRaises(ValueError):
+            get_sample_method(0.05, "key", None)
+        with self.assertRaises(ValueError):
+            get_sample_method(2, "fraction", None)
+
+    def test_compare_files_rules(self):
+        """
+        Ignore one column and compare another with a tolerance.  The summary only counts differences of the rules.
+        :return: None
+        """
+        compare_files(self.left_xlsx, self.right_xlsx, TESTS_OUTPUT_RULES_XLSX, open_on_finish=False,
+                      sort_column=1, compare_type="sorted", sheet_matching="order",
+                      rules={"Col B": "ignore", 2: "abs:1"})
+        wb = xl.load_workbook(TESTS_OUTPUT_RULES_XLSX)
+        ws = wb.worksheets[2]
+        self.assertEqual({ws.cell(row=r, column=9).value for r in range(1, ws.max_row + 1)}, {"Ignored"})
+        summary = list(wb["summary"].iter_rows(values_only=True))
+        self.assertEqual([(r[1], r[2]) for r in summary[1:]], [("Header", 1), ("Col A", 1)])
+
+    def test_compare_sheet_sharded(self):
+        """
+        Compare in two processes and check the output and summary match the single process comparison
+        :return: None
+        """
+        wb = xl.Workbook()
+        expected_sheet = wb.create_sheet("expected")
+        sharded_sheet = wb.create_sheet("sharded")
+        compare_sheet(self.left_sheet, self.right_sheet, expected_sheet, 0.001)
+        nodes = compare_sheet_sharded(self.left_sheet, self.right_sheet, sharded_sheet, 0.001, workers=2, min_rows=0)
+        self.assertEqual(list(sharded_sheet.iter_rows(values_only=True)),
+                         list(expected_sheet.iter_rows(values_only=True)))
+        self.assertEqual([(n.column_with_differences, n.number_of_differences, n.match_percent) for n in nodes],
+                         [(n.column_with_differences, n.number_of_differences, n.match_percent)
+                          for n in summarize_differences(expected_sheet, 1, 3)])
+
+        nodes = compare_sheet_sharded(self.left_sheet, self.right_sheet, wb.create_sheet("no header"), 0.001,
+                                      has_header=False, workers=2, min_rows=0)
+        self.assertEqual([n.column_with_differences for n in nodes],
+                         [n.column_with_differences for n in summarize_differences(expected_sheet, 1, 3,
+                                                                                    has_header=False)])
+
+    def test_compare_files_column_names(self):
+        """
+        Reorder the columns of the left file and add a column.  Matched by name, every value is the same and the added
+        column is listed in the summary.
+        :return: None
+        """
+        wb = xl.Workbook()
+        for (n, row) in enumerate(self.left_sheet.iter_rows(values_only=True)):
+            wb.active.append(list(reversed(row)) + ["Extra" if n == 0 else n])
+        wb.save(TESTS_REORDERED_XLSX)
+        compare_files(self.left_xlsx, TESTS_REORDERED_XLSX, TESTS_OUTPUT_COLUMNS_XLSX, open_on_finish=False,
+                      sheet_matching="order", column_matching="name")
+        output_wb = xl.load_workbook(TESTS_OUTPUT_COLUMNS_XLSX)
+        ws = output_wb.worksheets[2]
+        self.assertEqual(ws.max_column, 9)  # added column is not compared
+        self.assertEqual({ws.cell(row=r, column=c).value for r in range(1, ws.max_row + 1) for c in (3, 6, 9)} - {"Same", 0},
+                         set())
+        summary = list(output_wb["summary"].iter_rows(values_only=True))
+        self.assertEqual(summary[-1], ("Sheet", "Extra", "right", 4, None, None))
+        os.remove(TESTS_REORDERED_XLSX)
+
+    def test_compare_files_compact(self):
+        """
+        Compare with compact output.  Status cells hold 0 and 1, text is stored in a shared strings table, and the
+        values and summary are the same as the default output.
+        :return: None
+        """
+        compare_files(self.left_xlsx, self.right_xlsx, TESTS_OUTPUT_XLSX, open_on_finish=False, sort_column=1,
+                      compare_type="sorted", sheet_matching="order")
+        compare_files(self.left_xlsx, self.right_xlsx, TESTS_OUTPUT_COMPACT_XLSX, open_on_finish=False, sort_column=1,
+                      compare_type="sorted", sheet_matching="order", compact=True)
+        expected_wb = xl.load_workbook(TESTS_OUTPUT_XLSX)
+        compact_wb = xl.load_workbook(TESTS_OUTPUT_COMPACT_XLSX)
+        status = {"Same": 0, "Different": 1}
+        for (expected_ws, compact_ws) in zip(expected_wb.worksheets, compact_wb.worksheets):
+            for (expected_row, compact_row) in zip(expected_ws.iter_rows(values_only=True),
+                                                   compact_ws.iter_rows(values_only=True)):
+                self.assertEqual([status.get(v, v) if isinstance(v, str) else v for v in expected_row],
+                                 list(compact_row))
+        self.assertEqual(compact_wb.worksheets[2].cell(row=2, column=3).number_format, '"Different";"Different";"Same"')
+        with zipfile.ZipFile(TESTS_OUTPUT_COMPACT_XLSX) as z:
+            self.assertIn("xl/sharedStrings.xml", z.namelist())
+        self.assertEqual(get_nodes_for_workbook_path(TESTS_OUTPUT_COMPACT_XLSX, 3),
+                         get_nodes_for_workbook_path(TESTS_OUTPUT_XLSX, 3))
+
+    def test_compare_files_resume(self):
+        """
+        Fail while saving the output, then resume.  The saved sheet pair is restored instead of compared again.
+        :return: None
+        """
+        with mock.patch("xl_diff.compare.save_workbook", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                compare_files(self.left_xlsx, self.right_xlsx, TESTS_OUTPUT_RESUME_XLSX, open_on_finish=False,
+                              sort_column=1, compare_type="sorted", sheet_matching="order", work_dir=TESTS_WORK_DIR)
+        with mock.patch("xl_diff.compare.compare_sheet", side_effect=AssertionError("sheet compared again")):
+            compare_files(self.left_xlsx, self.right_xlsx, TESTS_OUTPUT_RESUME_XLSX, open_on_finish=False,
+                          sort_column=1, compare_type="sorted", sheet_matching="order", work_dir=TESTS_WORK_DIR,
+                          resume=True)
+        self.assertEqual(os.listdir(TESTS_WORK_DIR), [])  # checkpoint is removed when the output is saved
+
+        compare_files(self.left_xlsx, self.right_xlsx, TESTS_OUTPUT_XLSX, open_on_finish=False,
+                      sort_column=1, compare_type="sorted", sheet_matching="order")
+        resumed_wb = xl.load_workbook(TESTS_OUTPUT_RESUME_XLSX)
+        expected_wb = xl.load_workbook(TESTS_OUTPUT_XLSX)
+        self.assertEqual(resumed_wb.sheetnames, expected_wb.sheetnames)
+        for (resumed, expected) in zip(resumed_wb.worksheets, expected_wb.worksheets):
+            self.assertEqual([(c.value, c.fill.start_color.rgb) for row in resumed.iter_rows() for c in row],
+                             [(c.value, c.fill.start_color.rgb) for row in expected.iter_rows() for c in row])
+
+    def test_files_are_equal(self):
+        """
+        Check files for equality without writing an output file
+        :return: None
+        """
+        self.assertTrue(files_are_equal(self.left_xlsx, self.left_xlsx))
+        self.assertTrue(files_are_equal(TESTS_LEFT_CSV, TESTS_LEFT_CSV, sort_column=1))
+        self.assertFalse(files_are_equal(self.left_xlsx, self.right_xlsx, sort_column=1, sheet_matching="order"))
+
+    def test_find_differences(self):
+        """
+        Stop after a number of differences.  Row numbers follow the sorted comparison.
+        :return: None
+        """
+        differences = find_differences(TESTS_LEFT_CSV, TESTS_RIGHT2_CSV, sort_column=1, sheet_matching="order",
+                                       max_differences=2)
+        self.assertEqual([(d.row, d.column, d.left, d.right) for d in differences],
+                         [(2, 3, "2", "3"), (3, 3, "Q", "W")])
+        differences = find_differences(TESTS_LEFT_CSV, TESTS_RIGHT2_CSV, sort_column=1, max_differences=None)
+        self.assertEqual(len(differences), 6)
+        differences = find_differences(TESTS_LEFT_CSV, TESTS_RIGHT2_CSV, sort_column=1, max_differences=None,
+                                       rules={3: "ignore"})
+        self.assertEqual([d.column for d in differences if d.column == 3], [])
+
+    def test_iter_row_pairs(self):
+        """
+        Sorted rows are matched by the same keys as sort_values: a key column of numbers and numeric text is numeric
+        :return: None
+        """
+        left = [("Id", "Value"), (10, "a"), (2, "b")]
+        right = [("Id", "Value"), ("2", "b"), ("10.0", "a")]
+        pairs = list(iter_row_pairs(iter(left), iter(right), sort_column=1))
+        self.assertEqual(pairs, [(left[0], right[0]), (left[2], right[1]), (left[1], right[2])])
+
     def test_sort_column_list_one_value(self):
         """
         
@@ -204,6 +539,201 @@ class TestExcel(unittest.TestCase):
             check_count += 1
         self.assertGreater(check_count, 0)  # greater than zero
 
+    def test_sort_row_map(self):
+        """
+        A row map holds the same alignment as the list of tuples, and compare_sheet reads the unsorted sheets through it
+        :return: None
+        """
+        sorted_values = sort_values(self.left_sheet, self.right_sheet, [1, 2], True)
+        row_map = sort_values(self.left_sheet, self.right_sheet, [1, 2], True, row_map=True, keep_keys=True)
+        self.assertIsInstance(row_map, RowMap)
+        self.assertEqual(list(row_map), sorted_values)
+        self.assertEqual(list(row_map.right_rows), [2, 3, 0, 0, 4])  # 0 is a missing row
+        self.assertEqual(row_map[2], sorted_values[2])
+
+        wb = xl.Workbook()
+        row_map = sort_values(self.left_sheet, self.right_sheet, 1, True, row_map=True)
+        left = make_sorted_sheet(wb, self.left_sheet, row_map, "left", "left", True)
+        right = make_sorted_sheet(wb, self.right_sheet, row_map, "right", "right", True)
+        expected = compare_sheet(left, right, wb.create_sheet("expected"), 0.001)
+        output = compare_sheet(self.left_sheet, self.right_sheet, wb.create_sheet("output"), 0.001, row_map=row_map)
+        self.assertEqual(list(output.iter_rows(values_only=True)), list(expected.iter_rows(values_only=True)))
+
+    def test_sort_nan_keys(self):
+        """
+        NaN keys are matched like other keys instead of stopping the merge.  Numeric key columns sort as numbers.
+        :return: None
+        """
+        wb = xl.Workbook()
+        left = wb.create_sheet("left")
+        right = wb.create_sheet("right")
+        for row in [("Header", "Id"), ("a", float("nan")), ("b", 10), ("c", "9")]:
+            left.append(row)
+        for row in [("Header", "Id"), ("b", 10), ("a", float("nan"))]:
+            right.append(row)
+        sorted_values = sort_values(left, right, [2], True)
+        self.assertEqual([(v.left_row, v.right_row) for v in sorted_values], [(4, None), (3, 2), (2, 3)])
+
+
+class TestRules(unittest.TestCase):
+    """
+    Check the comparator functions of column rules
+    """
+
+    def test_comparators(self):
+        self.assertFalse(make_comparator(None, 0.001)(1, 1.01)[1])
+        self.assertTrue(make_comparator("abs:0.1", 0.001)(1, 1.01)[1])
+        self.assertTrue(make_comparator("rel:0.01", 0.001)(1000, 1005)[1])
+        self.assertFalse(make_comparator("rel:0.01", 0.001)(10, 10.5)[1])
+        self.assertEqual(make_comparator("nocase+trim", 0.001)(" Row  1", "row 1"), ("Same", True))
+        self.assertEqual(make_comparator("nocase", 0.001)(" Row 1", "row 1"), ("Different", False))
+        self.assertEqual(make_comparator("ignore", 0.001)("a", "b"), ("Ignored", True))
+
+    def test_date_comparators(self):
+        self.assertEqual(make_comparator(None, 0.001)(datetime(2019, 1, 1, 12), date(2019, 1, 3)),
+                         (timedelta(days=1, hours=12), False))
+        self.assertEqual(make_comparator(None, 0.001)("2019-01-01", datetime(2019, 1, 1)), (timedelta(0), True))
+        self.assertTrue(make_comparator("abs:1", 0.001)("1/1/2019", "1/2/2019")[1])
+        self.assertEqual(make_comparator("date:%d/%m/%Y", 0.001)("1/2/2019", "2/2/2019")[0], timedelta(days=1))
+        self.assertEqual(make_comparator(None, 0.001)("March", "April"), ("Different", False))  # not dates
+
+    def test_parse_rules(self):
+        self.assertEqual(parse_rules("Amount=abs:0.01; 3=ignore"), {"Amount": "abs:0.01", 3: "ignore"})
+        self.assertEqual(parse_rules(["Start=DATE:%d/%m/%Y"]), {"Start": "date:%d/%m/%Y"})
+        self.assertRaises(ValueError, parse_rules, ["Amount=approximately"])
+
+
+class TestWatch(unittest.TestCase):
+    """
+    Check that a watch session only compares changed rows and writes the same output as a full comparison
+    """
+
+    def check_output(self):
+        compare_files(TESTS_LEFT_XLSX, TESTS_WATCH_RIGHT_XLSX, TESTS_OUTPUT_WATCH_FULL_XLSX, open_on_finish=False,
+                      sort_column=1, compare_type="sorted", sheet_matching="order")
+        expected = xl.load_workbook(TESTS_OUTPUT_WATCH_FULL_XLSX)
+        output = xl.load_workbook(TESTS_OUTPUT_WATCH_XLSX)
+        for name in ("Sheet v Sheet1", "summary"):
+            self.assertEqual(list(output[name].iter_rows(values_only=True)),
+                             list(expected[name].iter_rows(values_only=True)))
+
+    def test_refresh(self):
+        save_workbook(xl.load_workbook(TESTS_RIGHT_XLSX), TESTS_WATCH_RIGHT_XLSX)
+        session = WatchSession(TESTS_LEFT_XLSX, TESTS_WATCH_RIGHT_XLSX, TESTS_OUTPUT_WATCH_XLSX, sort_column=1,
+                               compare_type="sorted", sheet_matching="order")
+        self.assertEqual(session.refresh(), 5)  # header and 4 rows
+        self.check_output()
+        self.assertIsNone(session.refresh())  # no file changed
+
+        wb = xl.load_workbook(TESTS_WATCH_RIGHT_XLSX)
+        wb.worksheets[0].cell(row=2, column=3).value = 2  # Row 1 of Col B now matches the left file
+        save_workbook(wb, TESTS_WATCH_RIGHT_XLSX)
+        self.assertEqual(session.refresh(), 1)  # only the changed row is compared
+        self.check_output()
+
+        session = WatchSession(TESTS_LEFT_XLSX, TESTS_WATCH_RIGHT_XLSX, TESTS_OUTPUT_WATCH_XLSX, has_header=False,
+                               sheet_matching="order")
+        session.refresh()
+        summary = list(xl.load_workbook(TESTS_OUTPUT_WATCH_XLSX)["summary"].iter_rows(min_row=2, values_only=True))
+        self.assertTrue(summary)
+        self.assertTrue(all(r[1] in ("A", "B", "C") for r in summary))  # column letters without a header
+
+    def test_failed_load(self):
+        """
+        A file that is still being saved fails to load and is loaded again on every refresh until it loads
+        :return: None
+        """
+        save_workbook(xl.load_workbook(TESTS_RIGHT_XLSX), TESTS_WATCH_RIGHT_XLSX)
+        with open(TESTS_WATCH_RIGHT_XLSX, "rb") as f:
+            content = f.read()
+        with open(TESTS_WATCH_RIGHT_XLSX, "wb") as f:
+            f.write(content[:len(content) // 2])
+        session = WatchSession(TESTS_LEFT_XLSX, TESTS_WATCH_RIGHT_XLSX, TESTS_OUTPUT_WATCH_XLSX, sort_column=1,
+                               compare_type="sorted", sheet_matching="order")
+        self.assertRaises(zipfile.BadZipFile, session.refresh)
+        self.assertRaises(zipfile.BadZipFile, session.refresh)  # the file did not change, but it is not skipped
+        with open(TESTS_WATCH_RIGHT_XLSX, "wb") as f:
+            f.write(content)
+        self.assertEqual(session.refresh(), 5)
+        self.check_output()
+
+
+class TestMultiway(unittest.TestCase):
+    """
+    Check the N-way comparison
+    """
+
+    def test_merge_sorted_keys(self):
+        rows = merge_sorted_keys([([1, 2, 2], [2, 3, 4]), ([2, 3], [5, 2]), ([1, 3], [3, 4])])
+        self.assertEqual([list(r) for r in rows], [[2, 3, 4, 0], [0, 5, 0, 2], [3, 0, 0, 4]])  # 0 is a missing row
+
+    def test_compare_files_multi(self):
+        """
+        Two files give the same comparison as compare_files.  Three files add a difference column for each pair.
+        :return: None
+        """
+        compare_files(TESTS_LEFT_XLSX, TESTS_RIGHT_XLSX, TESTS_OUTPUT_XLSX, open_on_finish=False, sort_column=1,
+                      compare_type="sorted", sheet_matching="order")
+        compare_files_multi([TESTS_LEFT_XLSX, TESTS_RIGHT_XLSX], TESTS_OUTPUT_MULTI_XLSX, sort_column=1,
+                            compare_type="sorted", sheet_matching="order")
+        expected = xl.load_workbook(TESTS_OUTPUT_XLSX).worksheets[2]
+        output = xl.load_workbook(TESTS_OUTPUT_MULTI_XLSX).worksheets[2]
+        self.assertEqual(list(output.iter_rows(values_only=True)), list(expected.iter_rows(values_only=True)))
+
+        compare_files_multi([TESTS_LEFT_XLSX, TESTS_RIGHT_XLSX, TESTS_RIGHT2_XLSX], TESTS_OUTPUT_MULTI_XLSX,
+                            ["dev", "uat", "prod"], sort_column=1, compare_type="sorted", sheet_matching="order")
+        wb = xl.load_workbook(TESTS_OUTPUT_MULTI_XLSX)
+        self.assertEqual(wb.sheetnames, ["dev_Sheet", "uat_Sheet1", "prod_Sheet", "Sheet v Sheet1 v Sheet", "summary"])
+        self.assertEqual([c.value for c in wb.worksheets[3][3]][12:], ["Q", "W", "W", "Different", "Different", "Same"])
+        summary = list(wb["summary"].iter_rows(min_row=2, values_only=True))
+        self.assertEqual({r[0].split(": ")[1] for r in summary}, {"dev v uat", "dev v prod"})  # uat and prod match
+
+        compare_files_multi([TESTS_LEFT_XLSX, TESTS_RIGHT_XLSX], TESTS_OUTPUT_MULTI_XLSX, has_header=False,
+                            sheet_matching="order")
+        summary = list(xl.load_workbook(TESTS_OUTPUT_MULTI_XLSX)["summary"].iter_rows(min_row=2, values_only=True))
+        self.assertTrue(summary)
+        self.assertTrue(all(r[1] in ("A", "B", "C") for r in summary))  # column letters without a header
+
+    def test_arguments(self):
+        x = compare_multi_configure_arg_parser().parse_args(["dev.xlsx", "uat.xlsx", "prod.xlsx", "out.xlsx", "-c",
+                                                             "sorted", "-s", "1", "-L", "dev", "uat", "prod"])
+        self.assertEqual(x.files, ["dev.xlsx", "uat.xlsx", "prod.xlsx"])
+        self.assertEqual(x.output, "out.xlsx")
+        self.assertEqual(x.labels, ["dev", "uat", "prod"])
+
+
+class TestAlignment(unittest.TestCase):
+    """
+    Check keyless alignment of rows
+    """
+
+    def test_row_hash(self):
+        self.assertEqual(row_hash((1, "a", None)), row_hash(("1.0", "a")))  # numbers as numbers, trailing empty cells
+        self.assertEqual(row_hash((float("nan"),)), row_hash((float("nan"),)))
+        self.assertNotEqual(row_hash(("a\tb",)), row_hash(("a", "b")))
+        self.assertNotEqual(row_hash((None, "x")), row_hash(("None", "x")))
+
+    def test_align_sequences(self):
+        self.assertEqual(align_sequences([1, 2, 3, 4, 5], [1, 9, 2, 3, 5]),
+                         [(0, 0), (None, 1), (1, 2), (2, 3), (3, None), (4, 4)])
+        self.assertEqual(align_sequences([1, 2, 3], [1, 7, 3]), [(0, 0), (1, 1), (2, 2)])  # changed row is paired
+        self.assertEqual(align_sequences([5, 5, 6, 5], [5, 6, 5]), [(0, 0), (1, None), (2, 1), (3, 2)])
+
+    def test_align_rows(self):
+        """
+        Insert a row on the right.  Later rows still line up.
+        :return: None
+        """
+        wb = xl.Workbook()
+        left = wb.create_sheet("left")
+        right = wb.create_sheet("right")
+        for row in [["Id", "Name"], [1, "a"], [2, "b"], [3, "c"]]:
+            left.append(row)
+        for row in [["Id", "Name"], [1.0, "a"], [9, "x"], [2, "b"], [3, "C"]]:
+            right.append(row)
+        self.assertEqual([(v.left_row, v.right_row) for v in align_rows(left, right)],
+                         [(2, 2), (None, 3), (3, 4), (4, 5)])
+
 
 class TestSummary(unittest.TestCase):
     """
@@ -225,9 +755,17 @@ class TestSummary(unittest.TestCase):
             self.assertEqual(n.number_of_differences, expected_differences, "Wrong number of differences")
 
         check_node(nodes[0], "Header", 1)  # Header has 1 diference
-        check_node(nodes[1], "Col A", 2)  # Col A has 2 differences
+        check_node(nodes[1], "Col A", 1)  # Col A has 1 difference.  Its dates are equal
         check_node(nodes[2], "Col B", 4)  # Col B has 4 differecnes
 
+    def test_wilson_interval(self):
+        (low, high) = wilson_interval(0, 100)
+        self.assertEqual(low, 0)
+        self.assertAlmostEqual(high, 0.037, 3)
+        (low, high) = wilson_interval(50, 100)
+        self.assertAlmostEqual(low, 0.404, 3)
+        self.assertAlmostEqual(high, 0.596, 3)
+
     def test_summary_file(self):
         write_summary_file(self.output_xlsx, self.summary_xlsx)
         summary_wb = xl.load_workbook(self.summary_xlsx)
@@ -236,7 +774,7 @@ class TestSummary(unittest.TestCase):
         data = [
             ["Sheet Name", "Column Name", "Number of Differences", "Total Rows", "Percent Different", "Column Index"]
             , ["Sheet v Sheet1", "Header", 1, 5, "20.00%", 1]
-            , ["Sheet v Sheet1", "Col A", 2, 5, "40.00%", 2]
+            , ["Sheet v Sheet1", "Col A", 1, 5, "20.00%", 2]
             , ["Sheet v Sheet1", "Col B", 4, 5, "80.00%", 3]
         ]
         for i in range(1, summary_sheet.max_row + 1):
@@ -348,6 +886,91 @@ class TestSqlCompare(unittest.TestCase):
         os.remove(TEST_DB_LEFT_MULTI_XLSX)
         os.remove(TEST_DB_RIGHT_MULTI_XLSX)
 
+    def test_async_compare(self):
+        """
+        Use the asynchronous version of sql compare.  Both queries run in the shared query executor.
+        :return: None
+        """
+        output_path = asyncio.run(self.multithreaded.compare_query_results_async(TESTS_OUTPUT_MULTI_XLSX,
+                                                                                 "select * from left",
+                                                                                 "select * from right2"))
+        self.assertTrue(os.path.exists(output_path), "Output file was not generated")
+        os.remove(output_path)
+        os.remove(TEST_DB_LEFT_MULTI_XLSX)
+        os.remove(TEST_DB_RIGHT_MULTI_XLSX)
+
+    def test_async_compare_error(self):
+        """
+        A failing query raises the error from the asynchronous comparison
+        :return: None
+        """
+        with self.assertRaises(Exception):
+            asyncio.run(self.multithreaded.compare_query_results_async(TESTS_OUTPUT_MULTI_XLSX, "select * from left",
+                                                                       "select * from NOT_A_TABLE"))
+
+    def test_pipelined_compare(self):
+        """
+        Compare rows while both queries are fetching, matching rows by key because both queries are ordered
+        :return: None
+        """
+        output_path = self.same_db.compare_query_results_pipelined(TEST_DB_OUTPUT_XLSX, "select * from left order by 1",
+                                                                   "select * from right2 order by 1", sort_column=[1],
+                                                                   compare_type="sorted")
+        ws = xl.load_workbook(output_path)["comparison"]
+        self.assertEqual([c.value for c in ws[4]][:3], ["Row 3", None, "Different"])  # row 3 is only on the left
+        self.assertEqual([c.value for c in ws[5]][:3], ["Row 4", "Row 4", "Same"])
+        os.remove(output_path)
+
+        for query in ("select * from left", "select * from (select * from left order by 1) q",
+                      "select *, row_number() over (order by 1) from left"):  # rows of these queries are not ordered
+            with self.assertRaises(ValueError):
+                self.same_db.compare_query_results_pipelined(TEST_DB_OUTPUT_XLSX, query, "select * from right2 " +
+                                                             "order by 1", sort_column=[1], compare_type="sorted")
+
+    def test_strip_query(self):
+        self.assertEqual(strip_query("select * from t order by coalesce(a, b) desc;"), "select * from t")
+        self.assertEqual(strip_query("select * from (select * from t order by 1) q"),
+                         "select * from (select * from t order by 1) q")
+        self.assertFalse(has_order_by("select 'order by' as text, a from t -- order by a"))
+
+    def test_pushdown_compare(self):
+        """
+        Compute the difference on the server.  Only rows that differ are saved to the left and right files.
+        :return: None
+        """
+        output_path = self.same_db.compare_query_results_pushdown(TEST_DB_OUTPUT_XLSX, "select * from left",
+                                                                  "select * from left where Header <> 'Row 3'",
+                                                                  sort_column=1)
+        left_rows = list(xl.load_workbook(TEST_DB_LEFT_XLSX).worksheets[0].iter_rows(values_only=True))
+        right_rows = list(xl.load_workbook(TEST_DB_RIGHT_XLSX).worksheets[0].iter_rows(values_only=True))
+        self.assertEqual(left_rows[1:], [("Row 3", "extra", "row")])  # only the missing row is fetched
+        self.assertEqual(len(right_rows), 1)  # header only
+        self.assertTrue(os.path.exists(output_path), "Output file was not generated")
+        os.remove(output_path)
+
+    def test_pushdown_needs_same_server(self):
+        sc = SqlCompare(TEST_DB_CONNECTION_STRING, TEST_DB_CONNECTION_STRING.replace("demo.db", "other.db"))
+        with self.assertRaises(ValueError):
+            sc.compare_query_results_pushdown(TEST_DB_OUTPUT_XLSX, "select * from left", sort_column=1)
+
+    def test_reconciled_compare(self):
+        """
+        Compare hashes of key ranges and only fetch the rows of ranges that differ.  sqlite has no hash function, so
+        the lengths of the rows are summed instead, which does not depend on the order of the rows.  Rows with a NULL
+        key are always fetched.  The key column has another name on each side, one of them with a space.
+        :return: None
+        """
+        no_key = " union all select null, 'Row 0', 'no', 'key'"
+        query = "select cast(substr(Header, 5) as integer) as \"Row Id\", * from left" + no_key
+        query_right = "select cast(substr(Header, 5) as integer) as Id, * from left where Header <> 'Row 3'" + no_key
+        output_path = self.same_db.compare_query_results_reconciled(TEST_DB_OUTPUT_XLSX, query, query_right,
+                                                                    sort_column=1, buckets=4, leaf_rows=0,
+                                                                    hash_expression="sum(length(ColA || ColB))")
+        left_rows = list(xl.load_workbook(TEST_DB_LEFT_XLSX).worksheets[0].iter_rows(values_only=True))
+        self.assertEqual(left_rows[1:], [(None, "Row 0", "no", "key"),  # NULL key, always fetched
+                                         (3, "Row 3", "extra", "row")])  # only the range with row 3 is fetched
+        os.remove(output_path)
+
     def test_multithread_compare_error(self):
         """
         Test what happens when the threaded version of sql comparison encounters an error
@@ -365,6 +988,63 @@ class TestSqlCompare(unittest.TestCase):
             print("We got an OS error because the other file wasn't created.")
 
 
+class TestResultCache(unittest.TestCase):
+    """
+    Check that cached query results are used instead of running the query again
+    """
+
+    def setUp(self):
+        self.runs = 0
+
+    def run_query(self):
+        self.runs += 1
+        return ["Header"], [["Row 1"], ["Row 2"]]
+
+    def test_normalize_sql(self):
+        self.assertEqual(normalize_sql("select *\n  from  left;"), "select * from left")
+        self.assertEqual(normalize_sql("select 'a  b' from left"), "select 'a  b' from left")
+
+    def test_query_runs_once(self):
+        cache = ResultCache(max_rows=2)
+        first = cache.get_or_run("Driver=x", "select * from left", self.run_query)
+        cache.get_or_run("Driver=y", "select * from left", self.run_query)  # spills the first result to disk
+        second = cache.get_or_run("Driver=x", "select *  from left", self.run_query)
+        self.assertEqual(self.runs, 2)
+        self.assertEqual(first, second)
+        self.assertEqual(cache._key_locks, {})  # locks of finished queries are dropped
+        cache.clear()
+
+    def test_spilled_values(self):
+        rows = [[1, 2.5, "a", None, True, datetime(2020, 9, 10, 8, 30), date(2020, 9, 10), Decimal("1.10"), b"\x00"]]
+        cache = ResultCache(max_rows=0)  # every result spills to disk
+        cache.get_or_run("Driver=x", "select * from left", lambda: (["Header"], rows))
+        self.assertEqual(cache.get_or_run("Driver=x", "select * from left", self.run_query), (["Header"], rows))
+        self.assertEqual(self.runs, 0)
+        cache.clear()
+
+    def test_unreadable_spill_file(self):
+        """
+        A spill file cut short, e.g. by a run that was killed while writing it, counts as a result that is not cached
+        :return: None
+        """
+        cache = ResultCache(spill_dir=TESTS_CACHE_DIR)
+        cache.get_or_run("Driver=x", "select * from left", self.run_query)
+        path = os.path.join(TESTS_CACHE_DIR, cache.get_key("Driver=x", "select * from left") + ".json")
+        with open(path, "r+", encoding="utf-8") as f:
+            f.truncate(10)
+        cache = ResultCache(spill_dir=TESTS_CACHE_DIR)
+        self.assertEqual(cache.get_or_run("Driver=x", "select * from left", self.run_query), self.run_query())
+        self.assertEqual(self.runs, 3)  # run again instead of raising, then once more for the expected value
+        self.assertEqual(os.listdir(TESTS_CACHE_DIR), [os.path.basename(path)])  # no temporary files are left
+        os.remove(path)
+
+    def test_expired_result(self):
+        cache = ResultCache(ttl=-1)
+        cache.get_or_run("Driver=x", "select * from left", self.run_query)
+        cache.get_or_run("Driver=x", "select * from left", self.run_query)
+        self.assertEqual(self.runs, 2)
+
+
 class TestFileProcessing(unittest.TestCase):
     """
     Check file processing functionality
@@ -394,6 +1074,132 @@ class TestFileProcessing(unittest.TestCase):
         """
         process_file(True, self.file, True, True)
 
+    def test_process_file_asynchronous(self):
+        """
+        Call process file function with all lines running concurrently
+        :return:
+        """
+        process_file(True, self.file, asynchronous=True, timeout=60)
+
+    def test_process_file_cached(self):
+        """
+        Call process file function with query results cached for the whole file
+        :return:
+        """
+        process_file(True, self.file, cache_ttl=60)
+
+    def test_read_job_file_rules(self):
+        """
+        Rules are read from the column named Rules.  Other extra columns are ignored, as is a 15th column that does not
+        hold rules in a file without a header.
+        :return:
+        """
+        line = ["left", "right", "output.xlsx", "select 1", "", "", "", "0.001", "FALSE", "1", "sorted", "TRUE",
+                "TRUE", "TRUE"]
+        for (header, extra, expected) in [(["Notes", "Rules"], ["free text", "Col B=ignore"], {"Col B": "ignore"}),
+                                          (["Notes"], ["checked by finance"], {}),
+                                          (None, ["checked by finance"], {}),
+                                          (None, ["Col B=ignore"], {"Col B": "ignore"})]:
+            with open(TESTS_JOBS_TXT, "w") as f:
+                if header is not None:
+                    f.write("\t".join(["x"] * len(line) + header) + "\n")
+                f.write("\t".join(line + extra) + "\n")
+            self.assertEqual(read_job_file(header is not None, TESTS_JOBS_TXT)[0][-1], expected)
+        os.remove(TESTS_JOBS_TXT)
+
+    def test_check_job_files(self):
+        """
+        Lines that run at the same time may not save query results to the same files, e.g. the default paths
+        :return:
+        """
+        job = ("left", "right", "output.xlsx", "select 1", "", "", "", 0.001, False, [1], "default", True, True, True,
+               {})
+        check_job_files([job])
+        with self.assertRaises(ValueError):
+            check_job_files([job, job])
+        check_job_files([job, job[:5] + ("left2.xlsx", "right2.xlsx") + job[7:]])
+
+
+class TestService(unittest.TestCase):
+    def setUp(self):
+        self.service = make_service(port=0, token_file=TESTS_SERVICE_TOKEN)
+        self.thread = threading.Thread(target=self.service.serve_forever, daemon=True)
+        self.thread.start()
+        self.port = self.service.server_address[1]
+
+    def tearDown(self):
+        self.service.shutdown()
+        self.service.server_close()
+        os.remove(TESTS_SERVICE_TOKEN)
+
+    def post(self, body, headers):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port)
+        try:
+            connection.request("POST", "/jobs", body, headers)
+            return connection.getresponse().status
+        finally:
+            connection.close()
+
+    def test_compare_job(self):
+        """
+        Send a comparison to the service and check the output file is written
+        :return:
+        """
+        if os.path.exists(TESTS_OUTPUT_SERVICE_XLSX):
+            os.remove(TESTS_OUTPUT_SERVICE_XLSX)
+        result = submit_job("compare", {"left_path": TESTS_LEFT_XLSX, "right_path": TESTS_RIGHT_XLSX,
+                                        "output_path": TESTS_OUTPUT_SERVICE_XLSX, "compare_type": "sorted",
+                                        "sort_column": 1, "sheet_matching": "order", "rules": ["2=ignore"]},
+                            port=self.port, token_file=TESTS_SERVICE_TOKEN)
+        self.assertEqual(result["status"], "ok")
+        self.assertTrue(os.path.exists(TESTS_OUTPUT_SERVICE_XLSX))
+
+        result = submit_job("unknown", {}, port=self.port, token_file=TESTS_SERVICE_TOKEN)
+        self.assertEqual(result["status"], "error")
+        self.assertIn("unknown job type", result["error"])
+
+    def test_rejected_requests(self):
+        """
+        Requests without the token, with another content type or another host, and arguments that are not accepted
+        are rejected
+        :return:
+        """
+        with open(TESTS_SERVICE_TOKEN) as f:
+            token = f.read()
+        body = '{"type": "summary", "args": {}}'
+        self.assertEqual(self.post(body, {"Content-Type": "application/json"}), 403)
+        self.assertEqual(self.post(body, {"Content-Type": "application/json", "X-Service-Token": "wrong"}), 403)
+        self.assertEqual(self.post(body, {"Content-Type": "text/plain", "X-Service-Token": token}), 415)
+        self.assertEqual(self.post(body, {"Content-Type": "application/json", "X-Service-Token": token,
+                                          "Host": "attacker.example"}), 403)
+        result = submit_job("compare", {"left_path": TESTS_LEFT_XLSX, "right_path": TESTS_RIGHT_XLSX,
+                                        "output_path": TESTS_OUTPUT_SERVICE_XLSX, "open_on_finish": True},
+                            port=self.port, token_file=TESTS_SERVICE_TOKEN)
+        self.assertEqual(result["status"], "error")
+        self.assertIn("open_on_finish", result["error"])
+
+
+class TestStartup(unittest.TestCase):
+    def test_import_time(self):
+        """
+        Import the package and the command line modules in a new interpreter.  Heavy dependencies must not be loaded
+        until a comparison needs them, and the imports must stay within the time budget.
+        :return:
+        """
+        code = "import sys, {}; print(','.join(m for m in {!r} if m in sys.modules))".format(
+            ", ".join(STARTUP_MODULES), STARTUP_HEAVY_MODULES)
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                                check=True)
+        self.assertEqual(result.stdout.strip(), "")
+
+        import_time = 0
+        for line in result.stderr.splitlines():  # import time: self [us] | cumulative | imported package
+            parts = line.split("|")
+            if len(parts) == 3 and parts[2].strip() in STARTUP_MODULES and not parts[2].startswith("  "):
+                import_time += int(parts[1]) / 1000000
+        self.assertLess(import_time, STARTUP_IMPORT_BUDGET)
+
+
 class TestArgumentParse(unittest.TestCase):
     def test_compare(self):
         parser = compare_excel_configure_arg_parser()
@@ -1,8 +1,54 @@
-from .compare import compare_files, ValueNode, make_sorted_sheet, sort_values
-from .convert import convert_csv_to_excel
-from .sql_compare import run_sql_comparison, SqlCompare
-from .sql_to_xl import SqlToXl
-from .summary import write_summary_file, summarize_differences, SummaryNode, get_workbook_nodes, \
-    get_nodes_for_workbook_path
-from .sql_compare_file import process_file
-from .validators import is_number, is_date
+"""
+Compare Excel, CSV and columnar files and SQL query results.
+
+Submodules are imported when one of their names is first used, e.g. xl_diff.compare_files, so importing the package
+(or a command line module that only parses its arguments) does not load openpyxl, dateutil or pyodbc.
+"""
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:  # never run, but seen by type checkers and by PyInstaller, which bundles the modules imported here
+    from .compare import compare_files, ValueNode, make_sorted_sheet, sort_values
+    from .rowmap import RowMap
+    from .convert import convert_csv_to_excel
+    from .sql_compare import run_sql_comparison, SqlCompare
+    from .sql_to_xl import SqlToXl
+    from .result_cache import ResultCache
+    from .summary import write_summary_file, summarize_differences, SummaryNode, get_workbook_nodes, \
+        get_nodes_for_workbook_path
+    from .sql_compare_file import process_file
+    from .validators import is_number, is_date
+    from .backends import register_reader, register_writer, register_row_reader
+    from .equality import files_are_equal, find_differences
+    from .watch import watch_files
+    from .multiway import compare_files_multi
+
+_exports = {
+    "compare_files": ".compare", "ValueNode": ".compare", "make_sorted_sheet": ".compare", "sort_values": ".compare",
+    "RowMap": ".rowmap",
+    "convert_csv_to_excel": ".convert",
+    "run_sql_comparison": ".sql_compare", "SqlCompare": ".sql_compare",
+    "SqlToXl": ".sql_to_xl",
+    "ResultCache": ".result_cache",
+    "write_summary_file": ".summary", "summarize_differences": ".summary", "SummaryNode": ".summary",
+    "get_workbook_nodes": ".summary", "get_nodes_for_workbook_path": ".summary",
+    "process_file": ".sql_compare_file",
+    "is_number": ".validators", "is_date": ".validators",
+    "register_reader": ".backends", "register_writer": ".backends", "register_row_reader": ".backends",
+    "files_are_equal": ".equality", "find_differences": ".equality",
+    "watch_files": ".watch", "compare_files_multi": ".multiway",
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+    value = getattr(importlib.import_module(_exports[name], __name__), name)
+    globals()[name] = value  # later lookups do not call this function
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
@@ -0,0 +1,197 @@
+"""
+This module contains keyless row alignment for comparisons without a sort column.
+
+A positional comparison lines up row n with row n, so a single inserted row makes every later row different.  Instead,
+each row is reduced to a hash of its values, and the two sequences of hashes are aligned with a patience diff: rows
+that occur exactly once on each side are anchors, and the longest run of anchors in the same order on both sides
+(found in n log n with patience sorting) splits the sheets into smaller gaps that are aligned the same way.  Gaps
+without unique rows are aligned with difflib when they are small, or by position when they are not.
+
+Rows left over in a gap are paired by position, so a row with a changed value is still compared with its counterpart
+and shows the changed cell.  Extra rows on one side are unmatched, like missing keys of a sorted comparison.
+"""
+import difflib
+from bisect import bisect_left
+from collections import Counter
+
+from .rowmap import RowMap
+from .validators import is_number
+
+NAN_KEY = ("nan",)  # stands for NaN, which is not equal to itself and would give every NaN row its own hash
+
+ALIGN_MAX_GAP_CELLS = 1000000  # gaps without unique rows are aligned with difflib up to this many left x right rows
+
+
+def normalize_value(value):
+    """
+    Normalize a value for hashing.  Numbers and numeric text become floats, so 1, 1.0 and "1" are the same.  Other
+    values are kept, so None and "None" are not.
+    :param value: cell value
+    :return: normalized value
+    """
+    if not is_number(value):
+        return value
+    number = float(value)
+    return NAN_KEY if number != number else number
+
+
+def row_hash(values):
+    """
+    Hash the values of a row.  Trailing empty cells are ignored and numbers are compared as numbers, so sheets of
+    different widths and 1 vs 1.0 still match.  The tuple of values is hashed, so the values cannot run together.
+    :param values: tuple of row values
+    :return: hash value
+    """
+    values = list(values)
+    while values and values[-1] is None:
+        values.pop()
+    return hash(tuple(normalize_value(v) for v in values))
+
+
+def read_row_hashes(sheet, starting_row, columns=None):
+    """
+    Hash every row of a sheet
+    :param sheet: worksheet object
+    :param starting_row: first row to hash
+    :param columns: list of 1-based columns to hash, in this order.  If not supplied, every column is hashed.
+    :return: list of row hashes, starting with starting_row
+    """
+    rows = sheet.iter_rows(min_row=starting_row, values_only=True)
+    if columns is None:
+        return [row_hash(row) for row in rows]
+    return [row_hash(row[c - 1] if c <= len(row) else None for c in columns) for row in rows]
+
+
+def find_anchors(left, right, left_start, left_end, right_start, right_end):
+    """
+    Find the longest sequence of rows that are unique on both sides and in the same order on both sides
+    :param left: list of left row hashes
+    :param right: list of right row hashes
+    :return: list of (left index, right index) tuples in order
+    """
+    left_counts = Counter(left[left_start:left_end])
+    right_counts = Counter(right[right_start:right_end])
+    right_index = {right[j]: j for j in range(right_start, right_end) if right_counts[right[j]] == 1}
+    candidates = [(i, right_index[left[i]]) for i in range(left_start, left_end)
+                  if left_counts[left[i]] == 1 and left[i] in right_index]
+
+    # patience sorting: piles hold the smallest right index that ends an increasing run of each length
+    pile_tops = []
+    tops = []  # candidate index at the top of each pile
+    previous = [None] * len(candidates)  # candidate below each candidate in its run
+    for (n, (i, j)) in enumerate(candidates):
+        pile = bisect_left(pile_tops, j)
+        if pile == len(pile_tops):
+            pile_tops.append(j)
+            tops.append(n)
+        else:
+            pile_tops[pile] = j
+            tops[pile] = n
+        previous[n] = tops[pile - 1] if pile > 0 else None
+
+    anchors = []
+    n = tops[-1] if tops else None
+    while n is not None:
+        anchors.append(candidates[n])
+        n = previous[n]
+    anchors.reverse()
+    return anchors
+
+
+def align_gap(left, right, left_start, left_end, right_start, right_end):
+    """
+    Align a gap that has no unique rows.  Equal rows are matched and the other rows are paired by position.
+    :return: list of (left index or None, right index or None) tuples
+    """
+    if (left_end - left_start) * (right_end - right_start) > ALIGN_MAX_GAP_CELLS:
+        opcodes = [("replace", left_start, left_end, right_start, right_end)]
+    else:
+        matcher = difflib.SequenceMatcher(None, left[left_start:left_end], right[right_start:right_end],
+                                          autojunk=False)
+        opcodes = [(tag, i1 + left_start, i2 + left_start, j1 + right_start, j2 + right_start)
+                   for (tag, i1, i2, j1, j2) in matcher.get_opcodes()]
+
+    pairs = []
+    for (tag, i1, i2, j1, j2) in opcodes:
+        paired = min(i2 - i1, j2 - j1)
+        pairs.extend((i1 + k, j1 + k) for k in range(0, paired))
+        pairs.extend((i, None) for i in range(i1 + paired, i2))
+        pairs.extend((None, j) for j in range(j1 + paired, j2))
+    return pairs
+
+
+def align_sequences(left, right):
+    """
+    Align two sequences of row hashes with a patience diff
+    :param left: list of left row hashes
+    :param right: list of right row hashes
+    :return: list of (left index or None, right index or None) tuples in order.  Every index of each side appears once.
+    """
+    pairs = []
+    stack = [(0, len(left), 0, len(right))]  # gaps still to align, next gap on top.  A pair is a matched anchor.
+    while stack:
+        item = stack.pop()
+        if len(item) == 2:
+            pairs.append(item)
+            continue
+        (left_start, left_end, right_start, right_end) = item
+
+        # equal rows at the start and end of the gap are matched without searching
+        while left_start < left_end and right_start < right_end and left[left_start] == right[right_start]:
+            pairs.append((left_start, right_start))
+            left_start += 1
+            right_start += 1
+        suffix = []
+        while left_start < left_end and right_start < right_end and left[left_end - 1] == right[right_end - 1]:
+            left_end -= 1
+            right_end -= 1
+            suffix.append((left_end, right_end))
+        stack.extend(suffix)  # reversed order, so the last row is popped last
+
+        if left_start == left_end or right_start == right_end:  # rows on one side only
+            pairs.extend((i, None) for i in range(left_start, left_end))
+            pairs.extend((None, j) for j in range(right_start, right_end))
+            continue
+
+        anchors = find_anchors(left, right, left_start, left_end, right_start, right_end)
+        if not anchors:
+            pairs.extend(align_gap(left, right, left_start, left_end, right_start, right_end))
+            continue
+
+        # push gaps and anchors so they pop in order
+        next_left, next_right = left_end, right_end
+        for (i, j) in reversed(anchors):
+            if i + 1 < next_left or j + 1 < next_right:
+                stack.append((i + 1, next_left, j + 1, next_right))
+            stack.append((i, j))
+            (next_left, next_right) = (i, j)
+        stack.append((left_start, next_left, right_start, next_right))
+    return pairs
+
+
+def align_rows(left_sheet, right_sheet, has_header=True, column_map=None, row_map=False):
+    """
+    Line up the rows of two sheets without a key.  The result can be used like the result of sort_values to build
+    sheets with aligned rows.
+    :param left_sheet: first worksheet object
+    :param right_sheet: second worksheet object
+    :param has_header: if true, the first row is excluded from alignment
+    :param column_map: list of (left column, right column) pairs.  If supplied, only these columns are hashed.
+    :param row_map: if true, return a RowMap instead of a list
+    :return: list of ValueNode tuples with the left and right row numbers.  The missing side of an unmatched row is
+             None.
+    """
+    from .compare import ValueNode  # compare imports this module
+
+    starting_row = 2 if has_header else 1
+    left_columns = None if column_map is None else [l for (l, r) in column_map]
+    right_columns = None if column_map is None else [r for (l, r) in column_map]
+    left = read_row_hashes(left_sheet, starting_row, left_columns)
+    right = read_row_hashes(right_sheet, starting_row, right_columns)
+    if row_map:
+        aligned = RowMap()
+        for (i, j) in align_sequences(left, right):
+            aligned.append(None if i is None else i + starting_row, None if j is None else j + starting_row)
+        return aligned
+    return [ValueNode(None if i is None else i + starting_row, None if j is None else j + starting_row, None)
+            for (i, j) in align_sequences(left, right)]
@@ -0,0 +1,372 @@
+"""
+This module contains the pluggable reader and writer backends used to load input files and save output files.
+
+Backends are registered by file extension.  A reader takes a file path and keyword options and returns an openpyxl
+workbook object that can be passed to the comparison functions.  Readers ignore options they do not use.  A writer
+takes an openpyxl workbook object and a file path and saves the workbook in the format of the backend.  Output
+options, if any, are passed to the writer as keyword options.
+
+A row reader streams the rows of a file without building a workbook.  It is a context manager that takes a file path
+and keyword options and returns a list of (sheet name, row iterator) tuples.  Files without a row reader are loaded
+with their reader and their sheets are iterated.
+
+Columnar formats (Parquet, Arrow/Feather) are read with pyarrow, which is an optional dependency.  pyarrow is only
+imported when one of those files is read or written.  openpyxl is also imported by the functions that use it, so csv
+files can be streamed without loading it.
+"""
+import logging
+import os
+from contextlib import contextmanager
+
+from .convert import read_csv_to_workbook, iter_csv_rows
+
+_readers = {}  # map of lower case file extension to reader function
+_writers = {}  # map of lower case file extension to writer function
+_row_readers = {}  # map of lower case file extension to row reader function
+
+
+def register_reader(extension, reader):
+    """
+    Register a reader function for a file extension.  Registering an extension twice replaces the reader.
+    :param extension: file extension including the dot.  E.g. ".xlsx"
+    :param reader: function that takes a file path and keyword options and returns an openpyxl workbook object
+    :return: None
+    """
+    _readers[extension.lower()] = reader
+
+
+def register_writer(extension, writer):
+    """
+    Register a writer function for a file extension.  Registering an extension twice replaces the writer.
+    :param extension: file extension including the dot.  E.g. ".parquet"
+    :param writer: function that takes an openpyxl workbook object and a file path and saves the workbook
+    :return: None
+    """
+    _writers[extension.lower()] = writer
+
+
+def register_row_reader(extension, row_reader):
+    """
+    Register a row reader for a file extension.  Registering an extension twice replaces the row reader.
+    :param extension: file extension including the dot.  E.g. ".csv"
+    :param row_reader: context manager function that takes a file path and keyword options and returns a list of
+                        (sheet name, row iterator) tuples
+    :return: None
+    """
+    _row_readers[extension.lower()] = row_reader
+
+
+def get_extension(file_path):
+    """
+    Get the lower case extension of a file path
+    :param file_path: file path
+    :return: extension including the dot
+    """
+    (file_name, file_extension) = os.path.splitext(file_path)
+    return file_extension.lower()
+
+
+def get_reader(file_path):
+    """
+    Get the reader registered for the extension of the file path.  If no reader is registered, raise an error.
+    :param file_path: file path
+    :return: reader function
+    """
+    extension = get_extension(file_path)
+    if extension not in _readers:
+        raise ValueError("file extension for {} is not one of {}.  file cannot be processed.".format(
+            file_path, ", ".join(sorted(_readers))))
+    return _readers[extension]
+
+
+def get_writer(file_path):
+    """
+    Get the writer registered for the extension of the file path.  If no writer is registered, raise an error.
+    :param file_path: file path
+    :return: writer function
+    """
+    extension = get_extension(file_path)
+    if extension not in _writers:
+        raise ValueError("file extension for {} is not one of {}.  output cannot be saved.".format(
+            file_path, ", ".join(sorted(_writers))))
+    return _writers[extension]
+
+
+def load_workbook(file_path, **options):
+    """
+    Load a file into an openpyxl workbook object using the reader registered for its extension
+    :param file_path: file path
+    :param options: keyword options passed to the reader.  E.g. schema and has_header for csv files
+    :return: openpyxl workbook object
+    """
+    logging.info("loading file: '{}'".format(file_path))
+    return get_reader(file_path)(file_path, **options)
+
+
+def open_rows(file_path, **options):
+    """
+    Open a file for streaming its rows, using the row reader registered for its extension.  If there is none, the
+    file is loaded with its reader.
+    :param file_path: file path
+    :param options: keyword options passed to the reader.  E.g. schema and has_header for csv files
+    :return: context manager that returns a list of (sheet name, row iterator) tuples.  Rows are tuples or lists of
+            values.
+    """
+    logging.info("streaming file: '{}'".format(file_path))
+    row_reader = _row_readers.get(get_extension(file_path), read_workbook_rows)
+    return row_reader(file_path, **options)
+
+
+@contextmanager
+def read_workbook_rows(file_path, **options):
+    """
+    Row reader for files without their own row reader.  Loads the whole file with its reader.
+    :param file_path: file path
+    :param options: keyword options passed to the reader
+    :return: context manager that returns a list of (sheet name, row iterator) tuples
+    """
+    wb = get_reader(file_path)(file_path, **options)
+    yield [(ws.title, ws.iter_rows(values_only=True)) for ws in wb.worksheets]
+
+
+def save_workbook(wb, file_path, **options):
+    """
+    Save an openpyxl workbook object using the writer registered for the extension of the file path
+    :param wb: openpyxl workbook object
+    :param file_path: target file path
+    :param options: keyword options passed to the writer, e.g. shared_strings=True
+    :return: None
+    """
+    logging.info("saving to file: '{}'".format(file_path))
+    get_writer(file_path)(wb, file_path, **options)
+
+
+def read_xlsx(file_path, **options):
+    """
+    Read an excel XLSX file
+    :param file_path: file path
+    :param options: not used
+    :return: openpyxl workbook object
+    """
+    import openpyxl as xl
+
+    return xl.load_workbook(filename=file_path)
+
+
+@contextmanager
+def read_xlsx_rows(file_path, **options):
+    """
+    Stream the rows of an excel XLSX file.  The file is opened in read-only mode, so rows are parsed as they are read.
+    :param file_path: file path
+    :param options: not used
+    :return: context manager that returns a list of (sheet name, row iterator) tuples
+    """
+    import openpyxl as xl
+
+    wb = xl.load_workbook(filename=file_path, read_only=True)
+    try:
+        yield [(ws.title, ws.iter_rows(values_only=True)) for ws in wb.worksheets]
+    finally:
+        wb.close()
+
+
+def write_xlsx(wb, file_path, workers=None, shared_strings=False, **options):
+    """
+    Save an openpyxl workbook object as an excel XLSX file.  The sheets of large workbooks are serialized by several
+    worker processes.
+    :param wb: openpyxl workbook object
+    :param file_path: target file path
+    :param workers: number of worker processes for large workbooks.  1 turns off parallel writing.
+    :param shared_strings: if true, each distinct text is stored once in a shared strings table
+    :param options: not used
+    :return: None
+    """
+    from .parallel_xlsx import PARALLEL_XLSX_MIN_CELLS, count_cells, write_xlsx_parallel
+
+    if shared_strings:
+        write_xlsx_parallel(wb, file_path, workers, shared_strings=True)  # openpyxl only writes inline strings
+    elif workers == 1 or count_cells(wb) < PARALLEL_XLSX_MIN_CELLS:
+        wb.save(file_path)
+    else:
+        write_xlsx_parallel(wb, file_path, workers)
+
+
+def read_csv(file_path, schema=None, has_header=True, workers=None, **options):
+    """
+    Read a csv file with typed values.  Large files are parsed in chunks by several worker processes.
+    :param file_path: file path
+    :param schema: dictionary that maps a 1-based column index or a header name to a type name
+    :param has_header: if true, the first row contains column names and is kept as text
+    :param workers: number of worker processes for large files.  1 turns off parallel parsing.
+    :param options: not used
+    :return: openpyxl workbook object
+    """
+    from .parallel_csv import PARALLEL_CSV_MIN_SIZE, read_csv_rows_parallel
+
+    if workers == 1 or os.path.getsize(file_path) < PARALLEL_CSV_MIN_SIZE:
+        return read_csv_to_workbook(file_path, schema, has_header)
+
+    import openpyxl as xl
+
+    wb = xl.Workbook()
+    ws = wb.active
+    for row in read_csv_rows_parallel(file_path, schema, has_header, workers):
+        ws.append(row)  # chunks arrive in file order
+    return wb
+
+
+@contextmanager
+def read_csv_rows(file_path, schema=None, has_header=True, **options):
+    """
+    Stream the rows of a csv file with typed values
+    :param file_path: file path
+    :param schema: dictionary that maps a 1-based column index or a header name to a type name
+    :param has_header: if true, the first row contains column names and is kept as text
+    :param options: not used
+    :return: context manager that returns a list with one (sheet name, row iterator) tuple
+    """
+    rows = iter_csv_rows(file_path, schema, has_header)
+    try:
+        yield [("Sheet", rows)]  # same sheet name as a csv file loaded into a workbook
+    finally:
+        rows.close()
+
+
+def read_arrow_table(file_path):
+    """
+    Read a Parquet or Arrow/Feather file into a pyarrow table.  Files are memory-mapped so that column buffers are
+    not copied into memory until they are used.
+    :param file_path: file path
+    :return: pyarrow table
+    """
+    import pyarrow as pa  # optional dependency, only needed for columnar files
+
+    if get_extension(file_path) == ".parquet":
+        import pyarrow.parquet as pq
+        return pq.read_table(file_path, memory_map=True)
+
+    import pyarrow.ipc
+    with pa.memory_map(file_path, "r") as source:
+        try:
+            return pa.ipc.open_file(source).read_all()
+        except pa.ArrowInvalid:  # not the random access file format, try the streaming format
+            source.seek(0)
+            return pa.ipc.open_stream(source).read_all()
+
+
+def read_arrow(file_path, **options):
+    """
+    Read a Parquet or Arrow/Feather file into a workbook with a single sheet.  Column names become the header row and
+    native column types (numbers, dates, strings) are kept.
+    :param file_path: file path
+    :param options: not used
+    :return: openpyxl workbook object
+    """
+    import openpyxl as xl
+
+    table = read_arrow_table(file_path)
+    wb = xl.Workbook()
+    ws = wb.active
+    ws.title = os.path.splitext(os.path.basename(file_path))[0][:31]  # excel sheet names are limited to 31 chars
+    ws.append(table.column_names)
+
+    columns = [column.to_pylist() for column in table.columns]  # convert column by column
+    for row in zip(*columns):
+        ws.append(row)
+    return wb
+
+
+@contextmanager
+def read_arrow_rows(file_path, **options):
+    """
+    Stream the rows of a Parquet or Arrow/Feather file, one record batch at a time.  The first row is the column names.
+    :param file_path: file path
+    :param options: not used
+    :return: context manager that returns a list with one (sheet name, row iterator) tuple
+    """
+    table = read_arrow_table(file_path)
+
+    def rows():
+        yield tuple(table.column_names)
+        for batch in table.to_batches():
+            yield from zip(*(column.to_pylist() for column in batch.columns))
+
+    yield [(os.path.splitext(os.path.basename(file_path))[0][:31], rows())]
+
+
+def sheet_to_columns(sheet):
+    """
+    Get the values of a worksheet as a list of column names and a list of column value lists.  The first row is used
+    for column names.  Duplicate names are made unique by adding the column index.
+    :param sheet: openpyxl worksheet object
+    :return: tuple of (list of column names, list of column value lists)
+    """
+    rows = list(sheet.iter_rows(values_only=True))
+    if not rows:
+        return [], []
+
+    names = []
+    for (index, name) in enumerate(rows[0], start=1):
+        name = str(name) if name is not None else "column_{}".format(index)
+        names.append(name if name not in names else "{}_{}".format(name, index))
+    columns = [[row[i] if i < len(row) else None for row in rows[1:]] for i in range(0, len(names))]
+    return names, columns
+
+
+def column_to_array(values):
+    """
+    Convert a list of cell values to a pyarrow array.  Columns where every value is a number become float columns.
+    Mixed columns (e.g. a difference column with both numbers and "Same"/"Different") become string columns.
+    :param values: list of values
+    :return: pyarrow array
+    """
+    import pyarrow as pa
+
+    present = [v for v in values if v is not None]
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+        return pa.array(values, type=pa.float64())
+    try:
+        return pa.array(values)  # keep the native type if the column has a single type (e.g. dates)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([str(v) if v is not None else None for v in values], type=pa.string())
+
+
+def write_parquet(wb, file_path, **options):
+    """
+    Save the worksheets of a workbook as a single columnar Parquet table.  A "sheet_name" column identifies the sheet
+    each row came from.  Comparison sheets repeat each column name 3 times (left, right, difference), so the column
+    names are suffixed to stay unique.
+    :param wb: openpyxl workbook object
+    :param file_path: target file path
+    :param options: not used
+    :return: None
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    tables = []
+    for sheet in wb.worksheets:
+        names, columns = sheet_to_columns(sheet)
+        if not names:
+            continue
+        arrays = [pa.array([sheet.title] * len(columns[0]), type=pa.string())]
+        arrays.extend(column_to_array(c) for c in columns)
+        tables.append(pa.table(arrays, names=["sheet_name"] + names))
+
+    # sheets have different columns, so the combined table has the union of columns with nulls for missing values
+    table = pa.concat_tables(tables, promote_options="permissive") if tables else pa.table({})
+    pq.write_table(table, file_path)
+
+
+register_reader(".xlsx", read_xlsx)
+register_reader(".csv", read_csv)
+register_reader(".parquet", read_arrow)
+register_reader(".arrow", read_arrow)
+register_reader(".feather", read_arrow)
+register_row_reader(".xlsx", read_xlsx_rows)
+register_row_reader(".csv", read_csv_rows)
+register_row_reader(".parquet", read_arrow_rows)
+register_row_reader(".arrow", read_arrow_rows)
+register_row_reader(".feather", read_arrow_rows)
+register_writer(".xlsx", write_xlsx)
+register_writer(".parquet", write_parquet)
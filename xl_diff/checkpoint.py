@@ -0,0 +1,92 @@
+"""
+This module contains checkpoints for long-running comparisons, so a run that dies part way through can be resumed.
+
+A checkpoint is a directory in a work directory, named by a hash of the inputs and options of the run.  Each finished
+piece of work (a compared sheet pair, a shard of rows of a sheet, a line of a job file) is saved to its own file as it
+completes, together with its summary counts.  A resumed run with the same inputs and options loads the saved pieces
+instead of doing the work again.  If an input file changes, its size or modification time changes the hash, so stale
+results are not used.
+
+Files are written to a temporary name and renamed, so a run killed while saving never leaves a partial piece behind.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import shutil
+
+
+def file_signature(path):
+    """
+    Get the parts of a file's metadata that change when the file changes
+    :param path: file path
+    :return: tuple of (path, size, modification time), or the path alone if the file does not exist
+    """
+    if path is None or not os.path.exists(path):
+        return path,
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime_ns
+
+
+def get_run_key(files, options):
+    """
+    Get the key of a run from its input files and options
+    :param files: list of input file paths
+    :param options: tuple of options that change the result.  Must have a stable repr.
+    :return: hex digest
+    """
+    text = repr(([file_signature(f) for f in files], options))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class Checkpoint():
+    """
+    Saved pieces of work of one run
+    """
+
+    def __init__(self, work_dir, run_key, resume=False):
+        """
+        :param work_dir: directory that holds the checkpoints of every run
+        :param run_key: key of the run, from get_run_key
+        :param resume: if true, pieces saved by an earlier run with the same key are used.  Otherwise, they are removed.
+        """
+        self.path = os.path.join(work_dir, run_key[:32])
+        if not resume and os.path.exists(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path, exist_ok=True)
+
+    def load(self, name):
+        """
+        Load a saved piece of work
+        :param name: name of the piece, e.g. "sheet_Sheet1"
+        :return: saved value, or None if the piece was not saved
+        """
+        path = self._piece_path(name)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            value = pickle.load(f)
+        logging.info("resuming from checkpoint '{}'".format(name))
+        return value
+
+    def save(self, name, value):
+        """
+        Save a finished piece of work
+        :param name: name of the piece
+        :param value: picklable value
+        :return: None
+        """
+        path = self._piece_path(name)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(value, f)
+        os.replace(path + ".tmp", path)  # atomic, so a killed run never leaves a partial piece
+
+    def clear(self):
+        """
+        Remove the checkpoint after the run is complete
+        :return: None
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def _piece_path(self, name):
+        return os.path.join(self.path, hashlib.sha256(str(name).encode("utf-8")).hexdigest()[:32] + ".pickle")
@@ -0,0 +1,100 @@
+"""
+This module contains column matching for sheets whose columns are not in the same order.
+
+By default columns are compared by position.  When they are matched by name, the header rows of both sheets are read
+once per sheet pair and turned into a column map: a list of (left column, right column) pairs in the order of the left
+sheet.  The comparison then reads the right value of each pair from its own column.  Columns that only exist on one
+side are not compared cell by cell; they are reported as unmatched columns in the summary.
+"""
+import logging
+from collections import namedtuple
+
+COLUMN_MATCHING = ("position", "name")
+UnmatchedColumn = namedtuple('UnmatchedColumn', ['sheet_name', 'column_name', 'side', 'column_index'])
+
+
+def read_header(sheet):
+    """
+    Read the first row of a sheet
+    :param sheet: worksheet object
+    :return: list of header values
+    """
+    return [sheet.cell(row=1, column=col).value for col in range(1, sheet.max_column + 1)]
+
+
+def header_key(value):
+    """
+    Get the name used to match a header, ignoring leading and trailing white space
+    :param value: header value
+    :return: text
+    """
+    return "" if value is None else str(value).strip()
+
+
+def match_columns(left_header, right_header):
+    """
+    Match columns by header name.  A repeated name matches the column with the same occurrence of that name on the
+    other side.
+    :param left_header: list of left header values
+    :param right_header: list of right header values
+    :return: tuple of (list of (left column, right column) pairs in left order, list of left only columns,
+             list of right only columns).  Columns are 1-based.
+    """
+    def occurrences(header):
+        seen = {}
+        keys = []
+        for value in header:
+            key = header_key(value)
+            seen[key] = seen.get(key, 0) + 1
+            keys.append((key, seen[key]))
+        return keys
+
+    right_columns = {key: col for (col, key) in enumerate(occurrences(right_header), start=1)}
+    column_map = []
+    left_only = []
+    for (col, key) in enumerate(occurrences(left_header), start=1):
+        if key in right_columns:
+            column_map.append((col, right_columns.pop(key)))
+        else:
+            left_only.append(col)
+    right_only = sorted(right_columns.values())
+    return column_map, left_only, right_only
+
+
+def get_column_map(left_sheet, right_sheet, sheet_name, unmatched_columns=None):
+    """
+    Build the column map of a pair of sheets with headers
+    :param left_sheet: first worksheet object
+    :param right_sheet: second worksheet object
+    :param sheet_name: name of the comparison sheet, used to report unmatched columns
+    :param unmatched_columns: list that receives an UnmatchedColumn for each column without a match
+    :return: list of (left column, right column) pairs
+    """
+    left_header = read_header(left_sheet)
+    right_header = read_header(right_sheet)
+    (column_map, left_only, right_only) = match_columns(left_header, right_header)
+    unmatched = [UnmatchedColumn(sheet_name, left_header[col - 1], "left", col) for col in left_only] + \
+                [UnmatchedColumn(sheet_name, right_header[col - 1], "right", col) for col in right_only]
+    for u in unmatched:
+        logging.info("column '{}' is only in the {} sheet of {}".format(u.column_name, u.side, sheet_name))
+    if unmatched_columns is not None:
+        unmatched_columns.extend(unmatched)
+    return column_map
+
+
+def map_columns(column_map, columns):
+    """
+    Find the right columns matched to left columns, e.g. the sort columns of the right sheet
+    :param column_map: list of (left column, right column) pairs
+    :param columns: left column number, list of column numbers, or None
+    :return: right column number or list of numbers, in the same form as columns
+    """
+    if columns is None:
+        return None
+    right_columns = dict(column_map)
+    for col in (columns if isinstance(columns, list) else [columns]):
+        if col not in right_columns:
+            raise ValueError("sort column {} has no column with the same name in the right sheet".format(col))
+    if isinstance(columns, list):
+        return [right_columns[col] for col in columns]
+    return right_columns[columns]
@@ -1,5 +1,5 @@
 """
-This module is used to compare data files.  This project compares two excel or CSV files
+This module is used to compare data files.  This project compares two excel, CSV or Parquet files
 and saves the results in an excel file.
 
 Command line parsing has been moved to a separate file to keep code clean.
@@ -12,17 +12,35 @@ Sorting based on a single column (e.g. a primary key) or group of columns (e.g.
 """
 import logging
 import os
+from array import array
 from collections import namedtuple
+from datetime import date, datetime, time, timedelta
 
 import openpyxl as xl
-from dateutil.parser import parse
 from openpyxl.styles import PatternFill
 
-from .summary import create_summary_worksheet, get_workbook_nodes
-from .validators import is_file_extension_valid, is_number, is_date
+from .alignment import align_rows
+from .backends import load_workbook, save_workbook
+from .checkpoint import Checkpoint, get_run_key
+from .columns import COLUMN_MATCHING, get_column_map, map_columns
+from .convert import make_date_parser
+from .helper_excel import get_empty_workbook
+from .merge import normalize_key
+from .mmap_csv import compare_csv_files_mapped
+from .rowmap import RowMap, ROW_TYPECODE
+from .rules import compile_rules
+from .sampling import sample_sheet
+from .sharded import compare_sheet_sharded
+from .summary import create_summary_worksheet, get_workbook_nodes, get_sheet_nodes, STATUS_NUMBER_FORMAT, \
+    DELTA_NUMBER_FORMAT
+from .validators import is_file_extension_valid, is_number, is_extension
 
 ValueNode = namedtuple('ValueNode', ['left_row', 'right_row', 'value'])  # object to store left row #, right #, value
 SHEETS_PER_COMPARISON = 3
+SAME_FILL = PatternFill(start_color="93f277", fill_type="solid")
+DIFFERENT_FILL = PatternFill(start_color="edb26f", fill_type="solid")
+STATUS_VALUES = {"Same": 0, "Different": 1}  # numbers stored for the status text of compact output
+parse_date_text = make_date_parser()  # shared by comparisons without a parser of their own
 
 
 def make_sorted_sheet(workbook, sheet, sorted_values, new_sheet_name, left_or_right, has_header=True):
@@ -30,7 +48,7 @@ def make_sorted_sheet(workbook, sheet, sorted_values, new_sheet_name, left_or_ri
     Create and sort excel worksheet according to the sorted_values.
     :param workbook: excel workbook object
     :param sheet: sheet object
-    :param sorted_values: list of values by which to
+    :param sorted_values: list of values by which to sort (ValueNode tuples), or a RowMap object
     :param new_sheet_name: name of sheet
     :param left_or_right: indicates if sheet is left or right
     :param has_header: skip in sort
@@ -46,12 +64,14 @@ def make_sorted_sheet(workbook, sheet, sorted_values, new_sheet_name, left_or_ri
             header_values.append(sheet.cell(row=1, column=c).value)
         new_sheet.append(header_values)
 
-    for v in sorted_values:
-        if left_or_right == "left":
-            row_id = v.left_row
-        else:
-            row_id = v.right_row
+    if isinstance(sorted_values, RowMap):
+        row_ids = (row_id or None for row_id in sorted_values.side(left_or_right))  # read the array, no tuples
+    elif left_or_right == "left":
+        row_ids = (v.left_row for v in sorted_values)
+    else:
+        row_ids = (v.right_row for v in sorted_values)
 
+    for row_id in row_ids:
         # if a row id exists for this value & sheet, copy row data to new row in new sheet
         row_values = []
         if row_id is not None:  # if no row id, row_values will be empty
@@ -81,7 +101,9 @@ def copy_sheet_to_workbook(sheet, wb: xl.Workbook):
 
 
 def compare_files(left_path, right_path, output_path, threshold=0.001, open_on_finish=False, sort_column=None,
-                  compare_type="default", has_header=True, sheet_matching="name", add_summary=True):
+                  compare_type="default", has_header=True, sheet_matching="name", add_summary=True, csv_schema=None,
+                  memory_map=False, sample_fraction=None, sample_method="key", rules=None, workers=None,
+                  column_matching="position", work_dir=None, resume=False, compact=False):
     """
     Compare two files and save comparison file.  Numerical differences that are below the threshold count as identical.
     Compare type indicates if rows are sorted or left alone.  Sheets are compared either by matching name or position.
@@ -92,24 +114,126 @@ def compare_files(left_path, right_path, output_path, threshold=0.001, open_on_f
     :param threshold: maximum acceptable differrnces of numerical values
     :param open_on_finish: if true, the output file will be opened when it is complete
     :param sort_column: numerical index of column, or list of such indices, used to sort rows
-    :param compare_type: sorted or default (unsorted)
+    :param compare_type: sorted, aligned (rows lined up by content, without a key) or default (unsorted)
     :param has_header: if true, first row is excluded from sort
     :param sheet_matching: if "name", sheets with the same name will be compared.  Otherwise, order is used.
+    :param csv_schema: dictionary that maps a csv column (1-based index or header name) to a type name.  Types of
+                        other csv columns are inferred from a sample of rows.
+    :param memory_map: if true and both files are csv files compared without sorting, memory-map the files and only
+                        compare the values of rows whose bytes differ
+    :param sample_fraction: if supplied, only compare this share of rows (between 0 and 1).  The summary estimates the
+                        difference rate of every column with a 95% confidence interval.
+    :param sample_method: "key" to sample rows by a hash of the sort columns, so both files sample the same keys, or
+                        "fraction" to sample one row in every 1 / sample_fraction rows by position
+    :param rules: dictionary that maps a column (1-based index or header name) to a comparison rule, e.g.
+                        {"Amount": "abs:0.01", 3: "rel:0.001", "Name": "nocase+trim", "Id": "ignore"}.  See the rules
+                        module.  Columns without a rule are compared with the threshold.
+    :param workers: if supplied, compare the rows of each sheet in shards using this many processes.  The summary is
+                        merged from the counts of the shards instead of read back from the output sheets.
+    :param column_matching: if "name", columns are matched by header name, so added or reordered columns do not shift
+                        the comparison.  Columns only found on one side are listed in the summary.  Otherwise, columns
+                        are matched by position.
+    :param work_dir: if supplied, each compared sheet pair (and each shard of rows, with workers) is saved to a
+                        checkpoint in this directory as soon as it is done.  The checkpoint is removed when the output
+                        file is saved.
+    :param resume: if true, sheet pairs and shards saved by an earlier run of the same comparison are loaded instead
+                        of compared again
+    :param compact: if true, the Same and Different status of text and date cells is stored as 0 and 1 with a number
+                        format that shows the text, and XLSX output stores each distinct text once in a shared strings
+                        table.  The output file is smaller and faster to save and open.
     :return: None
     """
     logging.info(
         "Comparing '{}' vs '{}' with threshold = '{}', sort column = '{}', compare type='{}'".format(
             left_path, right_path, threshold, sort_column, compare_type))
 
-    # check file extension if valid.  If not, convert CSV to
+    # check file extension if valid.  A reader backend must be registered for each extension
     logging.info("validating file types: '{}', '{}'".format(left_path, right_path))
     left_path = is_file_extension_valid(left_path)
     right_path = is_file_extension_valid(right_path)
+    if column_matching not in COLUMN_MATCHING:
+        raise ValueError("column matching must be one of {}".format(COLUMN_MATCHING))
+    if column_matching == "name" and not has_header:
+        raise ValueError("columns can only be matched by name if the sheets have a header")
+
+    summary_nodes = None  # filled by sharded or checkpointed comparisons
+    unmatched_columns = []
+    checkpoint = None
+    if work_dir is not None:
+        options = (threshold, sort_column, compare_type, has_header, sheet_matching, csv_schema, sample_fraction,
+                   sample_method, rules, column_matching)
+        checkpoint = Checkpoint(work_dir, get_run_key([left_path, right_path], options), resume)
+    if memory_map and is_extension(left_path, ".csv") and is_extension(right_path, ".csv") \
+            and compare_type not in ("sorted", "aligned") and not sample_fraction and not rules \
+            and column_matching == "position":
+        logging.info("comparing memory-mapped csv files: '{}', '{}'".format(left_path, right_path))
+        output_wb = get_empty_workbook()
+        compare_csv_files_mapped(left_path, right_path, output_wb, threshold, csv_schema, has_header)
+    else:
+        summary_nodes = [] if workers or checkpoint else None
+        output_wb = compare_workbooks(left_path, right_path, threshold, sort_column, compare_type, has_header,
+                                      sheet_matching, csv_schema, sample_fraction, sample_method, rules, workers,
+                                      summary_nodes, column_matching, unmatched_columns, checkpoint)
+
+    if add_summary:
+        logging.info(f"worksheets {output_wb.worksheets}")
+        logging.info("add summary sheet")
+        if summary_nodes is not None:
+            workbook_nodes = summary_nodes  # counted while comparing
+        else:
+            workbook_nodes = get_workbook_nodes(SHEETS_PER_COMPARISON, output_wb, threshold=threshold,
+                                                include_all=bool(sample_fraction),
+                                                rules=rules)  # get differences for workbook
+        logging.info(f"number of nodes {len(workbook_nodes)}")
+        output_wb = create_summary_worksheet(workbook_nodes, output_wb, estimate=bool(sample_fraction),
+                                             header_rows=1 if has_header else 0,
+                                             unmatched_columns=unmatched_columns)
 
-    # load workbook into excel library
-    logging.info("loading excel files: '{}', '{}'".format(left_path, right_path))
-    left_wb = xl.load_workbook(filename=left_path)
-    right_wb = xl.load_workbook(filename=right_path)
+    if compact:
+        encode_status(output_wb)
+        save_workbook(output_wb, output_path, shared_strings=True)
+    else:
+        save_workbook(output_wb, output_path)  # writer backend is chosen by the output file extension
+
+    logging.info("save complete")
+    if checkpoint is not None:
+        checkpoint.clear()
+    if open_on_finish:
+        path_to_open = '"' + output_path + '"'
+        logging.info("opening file".format(path_to_open))
+        os.system(path_to_open)  # use OS command line to open file.  This works on Windows
+
+
+def compare_workbooks(left_path, right_path, threshold=0.001, sort_column=None, compare_type="default",
+                      has_header=True, sheet_matching="name", csv_schema=None, sample_fraction=None,
+                      sample_method="key", rules=None, workers=None, summary_nodes=None, column_matching="position",
+                      unmatched_columns=None, checkpoint=None):
+    """
+    Load two files and compare them sheet by sheet.  For each pair of sheets, the output workbook gets a copy of the
+    left sheet, a copy of the right sheet and a comparison sheet.
+    :param left_path: first file to compare.  Results show on left.
+    :param right_path: second file to compare.  Results show on right
+    :param threshold: maximum acceptable differrnces of numerical values
+    :param sort_column: numerical index of column, or list of such indices, used to sort rows
+    :param compare_type: sorted, aligned (rows lined up by content, without a key) or default (unsorted)
+    :param has_header: if true, first row is excluded from sort
+    :param sheet_matching: if "name", sheets with the same name will be compared.  Otherwise, order is used.
+    :param csv_schema: dictionary that maps a csv column (1-based index or header name) to a type name
+    :param sample_fraction: if supplied, only compare this share of rows (between 0 and 1)
+    :param sample_method: "key" to sample rows by a hash of the sort columns or "fraction" to sample by position
+    :param rules: dictionary that maps a column (1-based index or header name) to a comparison rule
+    :param workers: if supplied, compare the rows of each sheet in shards using this many processes
+    :param summary_nodes: list that receives the summary nodes of sharded or checkpointed comparisons
+    :param column_matching: if "name", columns are matched by header name.  Otherwise, by position.
+    :param unmatched_columns: list that receives an UnmatchedColumn for each column only found on one side
+    :param checkpoint: Checkpoint object.  If supplied, each sheet pair is saved when it is done, and sheet pairs
+                        saved by an earlier run are restored instead of compared.
+    :return: output openpyxl workbook object
+    """
+    # load workbook into excel library using the reader backend for each file type
+    logging.info("loading files: '{}', '{}'".format(left_path, right_path))
+    left_wb = load_workbook(left_path, schema=csv_schema, has_header=has_header)
+    right_wb = load_workbook(right_path, schema=csv_schema, has_header=has_header)
     output_wb = xl.Workbook()
 
     # get sheet names
@@ -135,41 +259,125 @@ def compare_files(left_path, right_path, output_path, threshold=0.001, open_on_f
     for (i, j) in sheets_to_process:
         left_sheet = left_wb[i]
         right_sheet = right_wb[j]
-
-        if compare_type == "sorted":
-            logging.info("sorting sheets prior to comparison: ({},{})".format(i, j))
-
-            sorted_values = sort_values(left_sheet, right_sheet, sort_column, has_header)
+        output_sheet_name = i if sheet_matching == "name" or i == j else "{} v {}".format(i, j)
+        checkpoint_name = "sheet {} v {}".format(i, j)
+
+        saved = checkpoint.load(checkpoint_name) if checkpoint is not None else None
+        if saved is not None:
+            restore_sheet_pair(output_wb, saved)
+            if summary_nodes is not None:
+                summary_nodes.extend(saved["nodes"])
+            if unmatched_columns is not None:
+                unmatched_columns.extend(saved["unmatched"])
+            continue
+
+        # match columns once per sheet pair.  Sort columns of the right sheet follow the map
+        column_map = None
+        right_sort_column = sort_column
+        pair_unmatched = []
+        if column_matching == "name":
+            column_map = get_column_map(left_sheet, right_sheet, output_sheet_name, pair_unmatched)
+            right_sort_column = map_columns(column_map, sort_column)
+        if unmatched_columns is not None:
+            unmatched_columns.extend(pair_unmatched)
+
+        if sample_fraction:
+            logging.info("sampling {} of rows by {}: ({},{})".format(sample_fraction, sample_method, i, j))
+            left_sheet = sample_sheet(left_sheet, sample_fraction, sample_method, sort_column, has_header)
+            right_sheet = sample_sheet(right_sheet, sample_fraction, sample_method, right_sort_column, has_header)
+
+        row_map = None
+        if compare_type in ("sorted", "aligned"):
+            if compare_type == "sorted":
+                logging.info("sorting sheets prior to comparison: ({},{})".format(i, j))
+                sorted_values = sort_values(left_sheet, right_sheet, sort_column, has_header, right_sort_column,
+                                            row_map=True)
+            else:
+                logging.info("aligning rows by content prior to comparison: ({},{})".format(i, j))
+                sorted_values = align_rows(left_sheet, right_sheet, has_header, column_map, row_map=True)
             logging.info("values sorted.  Sorting left sheet")
+            (input_left, input_right) = (left_sheet, right_sheet)
             left_sheet = make_sorted_sheet(output_wb, left_sheet, sorted_values, 'left_' + i, 'left', has_header)
             logging.info("left sorted.  Sorting right sheet")
             right_sheet = make_sorted_sheet(output_wb, right_sheet, sorted_values, 'right_' + j, 'right',
                                             has_header)
+            if not workers:  # the input sheets are compared in the order of the map, so the copies are only output
+                (left_sheet, right_sheet, row_map) = (input_left, input_right, sorted_values)
         else:
             copy_sheet_to_workbook(left_sheet, output_wb)
             copy_sheet_to_workbook(right_sheet, output_wb)
 
-        output_sheet_name = i if sheet_matching == "name" or i == j else "{} v {}".format(i, j)
         output_sheet = output_wb.create_sheet(output_sheet_name)
 
         logging.info("comparing sheets: ({},{})".format(i, j))
-        compare_sheet(left_sheet, right_sheet, output_sheet, threshold)
+        if workers:
+            nodes = compare_sheet_sharded(left_sheet, right_sheet, output_sheet, threshold, rules, has_header, workers,
+                                          include_all=bool(sample_fraction), column_map=column_map,
+                                          checkpoint=checkpoint, checkpoint_name=checkpoint_name)
+        else:
+            compare_sheet(left_sheet, right_sheet, output_sheet, threshold, rules, has_header, column_map, row_map)
+            nodes = get_sheet_nodes(output_sheet, threshold=threshold, include_all=bool(sample_fraction),
+                                    rules=rules) if summary_nodes is not None or checkpoint is not None else []
+        if summary_nodes is not None:
+            summary_nodes.extend(nodes)
 
-    if add_summary:
-        logging.info(f"worksheets {output_wb.worksheets}")
-        logging.info("add summary sheet")
-        workbook_nodes = get_workbook_nodes(SHEETS_PER_COMPARISON, output_wb)  # get differences for workbook
-        logging.info(f"number of nodes {len(workbook_nodes)}")
-        output_wb = create_summary_worksheet(workbook_nodes, output_wb)
+        if checkpoint is not None:
+            save_sheet_pair(checkpoint, checkpoint_name, output_wb, nodes, pair_unmatched)
 
-    logging.info("saving to file: '{}'".format(output_path))
-    output_wb.save(output_path)
+    return output_wb
+
+
+def encode_status(output_wb, sheets_per_comparison=SHEETS_PER_COMPARISON):
+    """
+    Replace the Same and Different text of the difference cells of the comparison sheets with 0 and 1.  The number
+    format of the cells shows the text, so the output looks the same in Excel.
+    :param output_wb: output openpyxl workbook object
+    :param sheets_per_comparison: number of sheets of each sheet comparison.  The last one is the comparison sheet.
+    :return: None
+    """
+    for i in range(sheets_per_comparison - 1, len(output_wb.worksheets), sheets_per_comparison):
+        for row in output_wb.worksheets[i].iter_rows():
+            for cell in row[2::3]:  # left, right, difference
+                if isinstance(cell.value, str) and cell.value in STATUS_VALUES:
+                    cell.value = STATUS_VALUES[cell.value]
+                    cell.number_format = STATUS_NUMBER_FORMAT
 
-    logging.info("save complete")
-    if open_on_finish:
-        path_to_open = '"' + output_path + '"'
-        logging.info("opening file".format(path_to_open))
-        os.system(path_to_open)  # use OS command line to open file.  This works on Windows
+
+def save_sheet_pair(checkpoint, checkpoint_name, output_wb, nodes, unmatched_columns):
+    """
+    Save the sheets of a compared sheet pair (the last sheets of the output workbook) to a checkpoint
+    :param checkpoint: Checkpoint object
+    :param checkpoint_name: name of the sheet pair in the checkpoint
+    :param output_wb: output openpyxl workbook object
+    :param nodes: list of SummaryNode objects of the comparison sheet
+    :param unmatched_columns: list of UnmatchedColumn tuples of the sheet pair
+    :return: None
+    """
+    sheets = output_wb.worksheets[-SHEETS_PER_COMPARISON:]
+    output_sheet = sheets[-1]
+    same_rgb = SAME_FILL.start_color.rgb
+    same = [[cell.fill.start_color.rgb == same_rgb for cell in row[2::3]] for row in output_sheet.iter_rows()]
+    checkpoint.save(checkpoint_name, {"sheets": [(ws.title, list(ws.iter_rows(values_only=True))) for ws in sheets],
+                                      "same": same, "nodes": nodes, "unmatched": unmatched_columns})
+
+
+def restore_sheet_pair(output_wb, saved):
+    """
+    Add the sheets of a sheet pair saved by save_sheet_pair to the output workbook
+    :param output_wb: output openpyxl workbook object
+    :param saved: saved sheet pair
+    :return: None
+    """
+    for (title, rows) in saved["sheets"]:
+        ws = output_wb.create_sheet(title)
+        for row in rows:
+            ws.append(row)
+    for (row, flags) in enumerate(saved["same"], start=1):
+        for (n, same) in enumerate(flags):
+            cell = ws.cell(row=row, column=n * 3 + 3)
+            cell.fill = SAME_FILL if same else DIFFERENT_FILL
+            if isinstance(cell.value, timedelta):
+                cell.number_format = DELTA_NUMBER_FORMAT
 
 
 def get_list_of_values(row_number, sheet, sort_column):
@@ -190,123 +398,190 @@ def get_list_of_values(row_number, sheet, sort_column):
         raise e
 
 
-def sort_values(left, right, sort_column, has_header=False):
+def read_keys(sheet, columns, starting_row, numeric_columns, nan_columns=None):
+    """
+    Read the key values of every row of a sheet.  While reading, a key column stops counting as numeric as soon as
+    one of its values is not a number, and a numeric key column is flagged once one of its values is NaN.
+    :param sheet: worksheet object
+    :param columns: list of 1-based key column numbers
+    :param starting_row: first row to read
+    :param numeric_columns: list of flags, one per key column.  Updated in place.
+    :param nan_columns: list of flags, one per key column.  Updated in place (optional).
+    :return: list with the key of each row from starting_row.  The key is a tuple of values if there are several key
+            columns, otherwise the value itself.
+    """
+    keys = []
+    single = len(columns) == 1  # a tuple per row would take more memory than the value
+    for row in sheet.iter_rows(min_row=starting_row, values_only=True):
+        values = tuple(row[c - 1] if c <= len(row) else None for c in columns)
+        for (n, v) in enumerate(values):
+            if numeric_columns[n]:
+                if not is_number(v):
+                    numeric_columns[n] = False
+                elif nan_columns is not None and not nan_columns[n] and float(v) != float(v):
+                    nan_columns[n] = True
+        keys.append(values[0] if single else values)
+    return keys
+
+
+def pack_keys(keys, numeric_columns, multiple_columns, starting_row, nan_columns=None, keep_values=True):
+    """
+    Normalize the keys of a sheet and sort them.  The positions of the keys are sorted instead of (key, row) tuples,
+    and the row numbers are packed in an array, so only the sort keys take memory per row.  The sort key of a single
+    numeric column without NaN is the number itself.
+    :param keys: list of keys from read_keys, one per row from starting_row
+    :param numeric_columns: list of flags, one per key column, from read_keys of every sheet
+    :param multiple_columns: if true, values are tuples.  Otherwise, the single key value is used.
+    :param starting_row: row number of the first key
+    :param nan_columns: list of flags, one per key column, from read_keys of every sheet.  If not supplied, any numeric
+                        column may hold NaN.
+    :param keep_values: if false, the normalized values are not returned
+    :return: tuple of (list of sort keys, array of row numbers, list of normalized values or None), sorted by sort key
+    """
+    flags = list(zip(numeric_columns, nan_columns or [True] * len(numeric_columns)))
+
+    def normalize(key):
+        return [normalize_key(v, numeric, nan) for (v, (numeric, nan)) in zip(key if len(flags) > 1 else (key,), flags)]
+
+    if len(flags) == 1:
+        sort_keys = [normalize_key(k, *flags[0])[1] for k in keys]
+    else:
+        sort_keys = [tuple(s for (v, s) in normalize(k)) for k in keys]
+    order = sorted(range(0, len(sort_keys)), key=sort_keys.__getitem__)  # stable, so equal keys keep their row order
+    rows = array(ROW_TYPECODE, (starting_row + n for n in order))
+    values = None
+    if keep_values:
+        values = [tuple(v for (v, s) in normalize(keys[n])) if multiple_columns else normalize(keys[n])[0][0]
+                  for n in order]
+    return [sort_keys[n] for n in order], rows, values
+
+
+def sort_values(left, right, sort_column, has_header=False, right_sort_column=None, row_map=False, keep_keys=False):
     """
     Line up values from left and right sheets for sorting.  Functions as a full outer join of the two data set indexes.
     To do this, we use a modified merge-sort algorithm.  Values sorted are tuples in case multiple columns are used.
+    Key columns where every value is a number are compared as numbers.  Other key columns are compared as text.
     :param left: first worksheet object
     :param right: second worksheet object
     :param sort_column: number or list of numbers indicating columns used for sorting
     :param has_header:if true, first row is excluded from sort
-    :return:sorted list of tuples indicating which rows from each sheet matches the value.
+    :param right_sort_column: sort columns of the right sheet, if they are not the same as sort_column.  E.g. when
+                        columns are matched by name.
+    :param row_map: if true, return a RowMap, which stores the row numbers in arrays and takes a fraction of the
+                        memory of the list of tuples
+    :param keep_keys: if true, the RowMap also stores the key value of each row
+    :return:sorted list of tuples indicating which rows from each sheet matches the value, or a RowMap object.
     """
     if sort_column is None:  # e.g., if not none
         return
 
     starting_row = 1 if has_header is False else 2
-
-    # get list of named tuples. left side populates x.  right populates y.  merge later.
-    if isinstance(sort_column, list):
-        x = [ValueNode(n, None, tuple(get_list_of_values(n, left, sort_column))) for n in
-             range(starting_row, left.max_row + 1)]  # x = left
-        y = [ValueNode(None, n, tuple(get_list_of_values(n, right, sort_column))) for n in
-             range(starting_row, right.max_row + 1)]  # y = right
-
-        # get dictionary of columns and whether or not to convert them.  flag based on whether or not any item in the tuple is not a number.
-        convert_column = [(col, (len([i for i in x if not is_number(i.value[col])]) > 0 or
-                                 len([i for i in y if not is_number(i.value[col])]) > 0)) for col in
-                          range(0, len(sort_column))]
-        # convert
-
-        x = sorted([ValueNode(i.left_row, i.right_row,
-                              tuple([str(i.value[col]) if convert else i.value[col] for (col, convert) in
-                                     convert_column])) for
-                    i in x], key=lambda tup: tup[2])
-        y = sorted([ValueNode(i.left_row, i.right_row,
-                              tuple([str(i.value[col]) if convert else i.value[col] for (col, convert) in
-                                     convert_column])) for
-                    i in y], key=lambda tup: tup[2])
-
-
-    else:
-        x = [ValueNode(n, None, left.cell(row=n, column=sort_column).value) for n in
-             range(starting_row, left.max_row + 1)]  # x = left
-        y = [ValueNode(None, n, right.cell(row=n, column=sort_column).value) for n in
-             range(starting_row, right.max_row + 1)]  # y = right
-
-        # if there are any values that are not numbers, convert all to string
-        if (
-                len([i for i in x if not is_number(i.value)]) > 0 or
-                len([i for i in y if not is_number(i.value)]) > 0):
-            x = sorted([ValueNode(i.left_row, i.right_row, str(i.value)) for i in x], key=lambda tup: tup[2])
-            y = sorted([ValueNode(i.left_row, i.right_row, str(i.value)) for i in y], key=lambda tup: tup[2])
-        else:  # otherwise, convert all to number
-            x = sorted([ValueNode(i.left_row, i.right_row, float(i.value)) for i in x], key=lambda tup: tup[2])
-            y = sorted([ValueNode(i.left_row, i.right_row, float(i.value)) for i in y], key=lambda tup: tup[2])
+    columns = sort_column if isinstance(sort_column, list) else [sort_column]
+
+    # read keys of both sides in one pass each, inferring the type of each key column on the way
+    numeric_columns = [True] * len(columns)
+    nan_columns = [False] * len(columns)
+    left_keys = read_keys(left, columns, starting_row, numeric_columns, nan_columns)
+    right_columns = columns if right_sort_column is None else \
+        (right_sort_column if isinstance(right_sort_column, list) else [right_sort_column])
+    right_keys = read_keys(right, right_columns, starting_row, numeric_columns, nan_columns)
+
+    # x = left, y = right.  Sort keys, row numbers and values (None unless they are returned) of each side
+    keep_values = not row_map or keep_keys
+    (x, x_rows, x_values) = pack_keys(left_keys, numeric_columns, isinstance(sort_column, list), starting_row,
+                                      nan_columns, keep_values)
+    left_keys = None  # the raw keys are no longer needed
+    (y, y_rows, y_values) = pack_keys(right_keys, numeric_columns, isinstance(sort_column, list), starting_row,
+                                      nan_columns, keep_values)
+    right_keys = None
+    x_values = x_values if keep_values else [None] * len(x)
+    y_values = y_values if keep_values else [None] * len(y)
 
     logging.debug("starting_row for sort: {}".format(starting_row))
 
     i = j = 0
 
-    z = []  # z is combined list
+    if row_map:
+        z = RowMap(keep_keys)  # z is combined row map
+        add = z.append
+    else:
+        z = []  # z is combined list
+        add = lambda left_row, right_row, value: z.append(ValueNode(left_row, right_row, value))
     while i < len(x) and j < len(y):
 
-        f = x[i].value
-        r = y[j].value
+        f = x[i]
+        r = y[j]
 
-        # compare left and right values.  if both values match, combine into a single tuple.  otherwise, take only one
+        # compare left and right keys.  if both keys match, combine into a single tuple.  otherwise, take only one.
+        # sort keys are always comparable, so one of the branches advances
         if f == r:
-            temp = ValueNode(x[i].left_row, y[j].right_row, f)
-            z.append(temp)
+            add(x_rows[i], y_rows[j], x_values[i])
             i += 1
             j += 1
         elif f < r:  # left side has number lower than right side
-            z.append(x[i])  # add node from left side since right side is None
+            add(x_rows[i], None, x_values[i])  # add node from left side since right side is None
             i += 1
-        elif r < f:  # right side has number lower than left side
-            z.append(y[j])  # add node from right side since left is None
+        else:  # right side has number lower than left side
+            add(None, y_rows[j], y_values[j])  # add node from right side since left is None
             j += 1
-        else:
-            logging.warning("encountered a case where no comparison can be made {} vs {}".format(f, r))
 
     while i < len(x):
-        z.append(x[i])
+        add(x_rows[i], None, x_values[i])
         i += 1
     while j < len(y):
-        z.append(y[j])
+        add(None, y_rows[j], y_values[j])
         j += 1
 
     return z
 
 
-def compare_sheet(left_sheet, right_sheet, output_sheet, threshold):
+def compare_sheet(left_sheet, right_sheet, output_sheet, threshold, rules=None, has_header=True, column_map=None,
+                  row_map=None):
     """
     Compare two excel sheet objects.  Return output sheet.
     :param left_sheet: first sheet to compare (left)
     :param right_sheet: second sheet to compare (right)
     :param output_sheet: resulting sheet object
     :param threshold: numerical differences below this amount are considered identical
+    :param rules: dictionary that maps a column (1-based index or header name) to a comparison rule
+    :param has_header: if true, rules can name columns by the values of the first row of the left sheet
+    :param column_map: list of (left column, right column) pairs to compare, e.g. from get_column_map.  If not
+                        supplied, columns are compared by position.
+    :param row_map: RowMap object from sort_values or align_rows.  If supplied, the sheets are the unsorted input
+                        sheets and their rows are compared in the order of the map, without building sorted sheets.
+                        Otherwise, rows are compared by position.
     :return: output sheet object containing comparison
     """
-    max_col = max(left_sheet.max_column, right_sheet.max_column)
-    max_row = max(left_sheet.max_row, right_sheet.max_row)
+    if column_map is None:
+        column_map = [(col, col) for col in range(1, max(left_sheet.max_column, right_sheet.max_column) + 1)]
+    if row_map is None:
+        rows = [(row, row, row) for row in range(1, max(left_sheet.max_row, right_sheet.max_row) + 1)]
+    else:
+        # (output row, left row, right row).  0 is a missing row, whose values are empty
+        rows = [(1, 1, 1)] if has_header else []
+        rows.extend(zip(range(len(rows) + 1, len(rows) + len(row_map) + 1), row_map.left_rows, row_map.right_rows))
+    header = [left_sheet.cell(row=1, column=left_col).value for (left_col, right_col) in column_map]
+    comparators = compile_rules(rules, header, threshold, len(column_map), has_header)  # one function per column
 
     columns_per_value = 3  # each comparison takes up 3 rows
     left_offset = 0
     right_offset = 1
     diff_offset = 2
-    starting_row = 1
 
-    for col in range(1, max_col + 1):
+    for (col, (left_col, right_col)) in enumerate(column_map, start=1):
         output_column = (col - 1) * columns_per_value + 1  # 1-based column count, offset by columns per value
-        for row in range(starting_row, max_row + 1):
-            left_cell = left_sheet.cell(row=row, column=col)
-            right_cell = right_sheet.cell(row=row, column=col)
-            diff_value = cell_difference(left_cell, right_cell)
-            output_sheet.cell(row=row, column=output_column + left_offset).value = left_cell.value  # output left
-            output_sheet.cell(row=row, column=output_column + right_offset).value = right_cell.value  # output right
-            output_sheet.cell(row=row, column=output_column + diff_offset).value = diff_value  # output diff
-            apply_style(output_sheet.cell(row=row, column=output_column + diff_offset), threshold)
+        compare = comparators[col - 1]
+        for (row, left_row, right_row) in rows:
+            left_value = left_sheet.cell(row=left_row, column=left_col).value if left_row else None
+            right_value = right_sheet.cell(row=right_row, column=right_col).value if right_row else None
+            (diff_value, same) = compare(left_value, right_value)
+            output_sheet.cell(row=row, column=output_column + left_offset).value = left_value  # output left
+            output_sheet.cell(row=row, column=output_column + right_offset).value = right_value  # output right
+            diff_cell = output_sheet.cell(row=row, column=output_column + diff_offset)
+            diff_cell.value = diff_value  # output diff
+            diff_cell.fill = SAME_FILL if same else DIFFERENT_FILL
+            if isinstance(diff_value, timedelta):
+                diff_cell.number_format = DELTA_NUMBER_FORMAT
 
     return output_sheet
 
@@ -321,23 +596,51 @@ def cell_difference(left_cell, right_cell):
     return value_difference(left_cell.value, right_cell.value)
 
 
-def value_difference(left, right):
+def value_difference(left, right, parse_date=None):
     """
-    Determine the difference between two values and return.  if both values are numbers, return a number.  If one is
-    a string, return either Same or Different.
+    Determine the difference between two values and return.  if both values are numbers, return a number.  If both
+    are dates (date cells or date text), return the time between them.  Otherwise, return either Same or Different.
     :param left: first value to compare (left)
     :param right: second value to compare (right)
-    :return: right - left, if both are numbers, or string indicating Sameness
+    :param parse_date: function from make_date_parser used to parse date text.  Each column can have its own, so the
+                        format of its dates is only searched for once.
+    :return: right - left, if both are numbers or dates, or string indicating Sameness
     """
-    if is_number(left) and is_number(right):
+    if isinstance(left, (int, float)) and isinstance(right, (int, float)):
+        diff_value = float(right) - float(left)  # native numbers (e.g. typed csv values) need no parsing
+    elif not isinstance(left, date) and is_number(left) and is_number(right):
         diff_value = float(right) - float(left)  # numbers are subtracted
-    elif is_date(left) and is_date(right):
-        diff_value = "Same" if parse(right) == parse(left) else "Different"  # date comparison
     else:
-        diff_value = "Same" if right == left else "Different"  # non-number comparison
+        diff_value = date_difference(left, right, parse_date or parse_date_text)  # date comparison
+        if diff_value is None:
+            diff_value = "Same" if right == left else "Different"  # non-number comparison
     return diff_value
 
 
+def date_difference(left, right, parse_date):
+    """
+    Get the time between two dates.  Date cells are used as they are and date text is parsed.
+    :param left: first value (left)
+    :param right: second value (right)
+    :param parse_date: function that parses date text and returns None for other text
+    :return: right - left as a timedelta, or None if either value is not a date
+    """
+    left_date = left if isinstance(left, date) else parse_date(left) if isinstance(left, str) else None
+    if left_date is None:
+        return None
+    right_date = right if isinstance(right, date) else parse_date(right) if isinstance(right, str) else None
+    if right_date is None:
+        return None
+    if not isinstance(left_date, datetime):
+        left_date = datetime.combine(left_date, time())
+    if not isinstance(right_date, datetime):
+        right_date = datetime.combine(right_date, time())
+    try:
+        return right_date - left_date
+    except TypeError:  # only one of the dates has a time zone
+        return None
+
+
 def apply_style(cell, threshold):
     """
     Apply style to difference cell based on contents.
@@ -345,13 +648,12 @@ def apply_style(cell, threshold):
     :param threshold: differences below threshold are considered identical
     :return: None
     """
-    same_color = "93f277"
-    different_color = "edb26f"
-    pattern_same = PatternFill(start_color=same_color, fill_type="solid")
-    pattern_diferent = PatternFill(start_color=different_color, fill_type="solid")
-    if is_number(cell.value) and abs(cell.value) <= threshold:
-        cell.fill = pattern_same  # under threshold
+    if isinstance(cell.value, timedelta):
+        cell.number_format = DELTA_NUMBER_FORMAT
+        cell.fill = SAME_FILL if cell.value == timedelta(0) else DIFFERENT_FILL  # dates are only the same if equal
+    elif is_number(cell.value) and abs(cell.value) <= threshold:
+        cell.fill = SAME_FILL  # under threshold
     elif cell.value == "Same":
-        cell.fill = pattern_same  # match
+        cell.fill = SAME_FILL  # match
     else:
-        cell.fill = pattern_diferent  # under threshold or different
\ No newline at end of file
+        cell.fill = DIFFERENT_FILL  # under threshold or different
\ No newline at end of file
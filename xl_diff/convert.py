@@ -1,30 +1,288 @@
 """
-This module contains a function used to convert a CSV file to an Excel XLSX workbook.
+This module contains functions used to read a CSV file into an Excel workbook and convert it to an XLSX file.
+
+CSV files only contain text, so column types are inferred once from a sample of rows and each value is converted to
+its native type (int, float, datetime or str) while the file is read.  The inferred types can be overridden with a
+schema that maps a column (1-based index or header name) to a type name.
 """
 import csv
 import logging
 import os
+from datetime import datetime
+from itertools import islice
+
+CSV_SAMPLE_SIZE = 1000  # number of rows used to infer column types
+COLUMN_TYPES = ("int", "float", "date", "str")
+DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%m/%d/%Y", "%m/%d/%Y %H:%M:%S", "%d/%m/%Y", "%Y%m%d",
+                "%d-%b-%Y", "%b %d %Y")  # common formats tried before falling back to dateutil
+
+
+def is_int_text(value):
+    """
+    Check if text is an integer.  Values with leading zeros (e.g. account numbers) are not treated as integers so that
+    the zeros are not lost.
+    :param value: text to check
+    :return: true if integer, false if not
+    """
+    text = value.strip().lstrip("+-")
+    return text.isdigit() and (text == "0" or not text.startswith("0"))
+
+
+def is_float_text(value):
+    """
+    Check if text is a floating point number.  Like integers, values with leading zeros are not numbers.
+    :param value: text to check
+    :return: true if number, false if not
+    """
+    text = value.strip().lstrip("+-")
+    try:
+        float(text)
+    except ValueError:
+        return False
+    return not (len(text) > 1 and text[0] == "0" and text[1].isdigit())  # leading zeros, e.g. "007.5"
+
+
+def get_date_format(values):
+    """
+    Find a date format that parses every value.
+    :param values: list of text values
+    :return: format string, or None if no known format parses every value
+    """
+    for date_format in DATE_FORMATS:
+        try:
+            for v in values:
+                datetime.strptime(v.strip(), date_format)
+            return date_format
+        except ValueError:
+            continue
+    return None
+
+
+def make_date_parser(date_format=None):
+    """
+    Build a function that parses date text, e.g. for one column of a comparison.  The format that parsed the last value
+    is tried first, so a column of dates in one format is parsed with a single strptime call per value.  Text that no
+    known format parses is parsed by dateutil.  Text without digits (e.g. "March") is not a date, because dateutil
+    fills the missing parts from today's date.
+    :param date_format: strptime format tried before the common formats, e.g. "%d/%m/%Y" (optional)
+    :return: function that takes text and returns a datetime, or None if the text is not a date
+    """
+    formats = ([date_format] if date_format else []) + [f for f in DATE_FORMATS if f != date_format]
+    last_format = [formats[0]]  # format that parsed the last value
+
+    def parse_date(value):
+        text = value.strip()
+        try:
+            return datetime.strptime(text, last_format[0])
+        except ValueError:
+            pass
+        if not any(c.isdigit() for c in text):
+            return None
+        for f in formats:
+            try:
+                parsed = datetime.strptime(text, f)
+            except ValueError:
+                continue
+            last_format[0] = f
+            return parsed
+        from dateutil.parser import parse  # slow to import, so only imported when a value needs it
+
+        try:
+            return parse(text)
+        except (ValueError, OverflowError):
+            return None
+
+    return parse_date
+
+
+def is_date_text(value):
+    """
+    Check if text is a date in one of the common formats.  dateutil is not used to infer types because it reads text
+    such as "March", "1.2.3" or "10-12" as dates, filling the missing parts from today's date.
+    :param value: text to check
+    :return: true if date, false if not
+    """
+    return get_date_format([value]) is not None
+
+
+def infer_column_type(values):
+    """
+    Infer the type of a column from a sample of its values.  Empty values are ignored.
+    :param values: list of text values
+    :return: one of COLUMN_TYPES
+    """
+    values = [v for v in values if v.strip() != ""]
+    if not values:
+        return "str"
+    if all(is_int_text(v) for v in values):
+        return "int"
+    if all(is_float_text(v) for v in values):
+        return "float"
+    if all(is_date_text(v) for v in values):
+        return "date"
+    return "str"
+
+
+def infer_column_types(rows, has_header=True, schema=None):
+    """
+    Infer the type of each column from a sample of rows.  Types in the schema replace inferred types.
+    :param rows: list of rows from a csv reader, including the header row if has_header is true
+    :param has_header: if true, the first row contains column names and is not used to infer types
+    :param schema: dictionary that maps a 1-based column index or a header name to a type name in COLUMN_TYPES
+    :return: list of type names, one per column
+    """
+    header = rows[0] if has_header and rows else []
+    data = rows[1:] if has_header else rows
+    column_count = max([len(r) for r in rows], default=0)
+    types = [infer_column_type([r[i] for r in data if i < len(r)]) for i in range(0, column_count)]
+
+    for (column, type_name) in (schema or {}).items():
+        if type_name not in COLUMN_TYPES:
+            raise ValueError("column type {} for column {} is not one of {}".format(type_name, column, COLUMN_TYPES))
+        index = column - 1 if isinstance(column, int) else header.index(column) if column in header else None
+        if index is None or index >= column_count:
+            raise ValueError("column {} in csv schema was not found".format(column))
+        types[index] = type_name
+    return types
+
+
+def get_converter(type_name, sample=None):
+    """
+    Get a function that converts text to the type.  Empty text becomes None for typed columns.  Text that can not be
+    converted is kept as it is, so one bad value does not stop the whole file from loading.
+    :param type_name: one of COLUMN_TYPES
+    :param sample: sample text values, used to pick the date format tried first for date columns
+    :return: function that takes text and returns the converted value
+    """
+    if type_name == "str":
+        return str
+
+    if type_name == "int":
+        convert = int
+    elif type_name == "float":
+        convert = float
+    else:
+        parse_date = make_date_parser(get_date_format([v for v in sample or [] if v.strip() != ""]))
+
+        def convert(value):
+            parsed = parse_date(value)
+            if parsed is None:
+                raise ValueError("'{}' is not a date".format(value))
+            return parsed
+
+    def converter(value):
+        if value.strip() == "":
+            return None
+        try:
+            return convert(value)
+        except (ValueError, OverflowError):
+            return value
+
+    return converter
+
+
+def get_converters(types, rows, has_header=True):
+    """
+    Get a converter function for each column
+    :param types: list of type names, one per column
+    :param rows: sample rows used to infer the types
+    :param has_header: if true, the first row contains column names
+    :return: list of converter functions, one per column
+    """
+    data = rows[1:] if has_header else rows
+    return [get_converter(t, [r[i] for r in data if i < len(r)]) for (i, t) in enumerate(types)]
+
 
-import openpyxl as xl
+def convert_row(row, converters):
+    """
+    Convert the text values of a csv row to their column types
+    :param row: list of text values
+    :param converters: list of converter functions, one per column
+    :return: list of converted values
+    """
+    return [converters[i](v) if i < len(converters) else v for (i, v) in enumerate(row)]
+
+
+def iter_csv_rows(csv_path, schema=None, has_header=True, sample_size=CSV_SAMPLE_SIZE):
+    """
+    Read the rows of a csv file one at a time, converted to the types of their columns.  Column types are inferred
+    from the first rows of the file.
+    :param csv_path: string file path of CSV file to read
+    :param schema: dictionary that maps a 1-based column index or a header name to a type name in COLUMN_TYPES
+    :param has_header: if true, the first row contains column names and is kept as text
+    :param sample_size: number of rows used to infer column types
+    :return: generator of rows
+    """
+    with open(csv_path, newline='') as csv_file:
+        rd = csv.reader(csv_file, delimiter=",", quotechar='"')
+        sample = list(islice(rd, sample_size + 1 if has_header else sample_size))
+        types = infer_column_types(sample, has_header, schema)
+        converters = get_converters(types, sample, has_header)
+        logging.info("csv column types: {}".format(types))
+
+        for (n, row) in enumerate(sample):
+            yield row if has_header and n == 0 else convert_row(row, converters)
+        for row in rd:
+            yield convert_row(row, converters)
 
 
-def convert_csv_to_excel(csv_path):
+def read_csv_to_workbook(csv_path, schema=None, has_header=True, infer_types=True, sample_size=CSV_SAMPLE_SIZE):
+    """
+    Read a csv file into an in-memory excel workbook with a single sheet.
+    :param csv_path: string file path of CSV file to read
+    :param schema: dictionary that maps a 1-based column index or a header name to a type name in COLUMN_TYPES
+    :param has_header: if true, the first row contains column names and is kept as text
+    :param infer_types: if true, convert values to the type of their column.  Otherwise, every value is text.
+    :param sample_size: number of rows used to infer column types
+    :return: openpyxl workbook object
+    """
+    import openpyxl as xl
+
+    wb = xl.Workbook()  # create the excel workbook
+    ws = wb.active  # use the active sheet by default
+    logging.info("reading csv file: '{}'".format(csv_path))
+
+    if not infer_types:
+        with open(csv_path, newline='') as csv_file:  # append each row of the csv to the excel worksheet
+            for row in csv.reader(csv_file, delimiter=",", quotechar='"'):
+                ws.append(row)
+        return wb
+
+    for row in iter_csv_rows(csv_path, schema, has_header, sample_size):
+        ws.append(row)
+    return wb
+
+
+def parse_schema(column_types):
+    """
+    Parse a list of "column=type" strings, e.g. from the command line, into a schema dictionary.  Numeric columns are
+    1-based column indexes.  Other columns are header names.
+    :param column_types: list of strings such as ["1=int", "Amount=float"]
+    :return: dictionary that maps a column to a type name
+    """
+    schema = {}
+    for item in column_types or []:
+        (column, separator, type_name) = item.rpartition("=")
+        if not separator:
+            raise ValueError("csv column type '{}' should look like column=type".format(item))
+        schema[int(column) if column.isdigit() else column] = type_name.strip().lower()
+    return schema
+
+
+def convert_csv_to_excel(csv_path, schema=None, has_header=True, infer_types=True):
     """
     This function converts a csv file, given by its file path, to an excel file in the same directory with the same
     name.
     :param csv_path:string file path of CSV file to convert
+    :param schema: dictionary that maps a 1-based column index or a header name to a type name in COLUMN_TYPES
+    :param has_header: if true, the first row contains column names and is kept as text
+    :param infer_types: if true, convert values to the type of their column.  Otherwise, every value is text.
     :return: string file path of converted Excel file.
     """
     (file_path, file_extension) = os.path.splitext(csv_path)  # split the csv pathname to remove the extension
 
-    wb = xl.Workbook()  # create the excel workbook
-    ws = wb.active  # use the active sheet by default
     logging.info("converting file to xlsx: '{}'".format(csv_path))
-
-    with open(csv_path, newline='') as csv_file:  # append each row of the csv to the excel worksheet
-        rd = csv.reader(csv_file, delimiter=",", quotechar='"')
-        for row in rd:
-            ws.append(row)
+    wb = read_csv_to_workbook(csv_path, schema, has_header, infer_types)
 
     output_path = os.path.join(file_path + '.xlsx')  # output file path should be the same as the csv file
     logging.info("saving to file: '{}'".format(output_path))
@@ -0,0 +1,147 @@
+"""
+This module contains a quick equality check of two files.
+
+Both files are streamed row by row and compared value by value, and the check stops at the first difference (or after
+a given number of differences).  No output workbook is built or saved, so a check of files that differ early takes
+seconds instead of the time of a full comparison.
+
+The check finds the same value differences as compare_files, and sorted rows are matched by the same keys as
+sort_values: a key column is compared as numbers if every key in both sheets is a number, otherwise as text.  Unlike
+compare_files, a sheet that is only in one file is a difference.
+"""
+import logging
+from collections import namedtuple
+from itertools import zip_longest, islice
+
+from .backends import open_rows
+from .merge import normalize_key, merge_rows
+from .rules import compile_rules, make_comparator
+from .validators import is_file_extension_valid, is_number
+
+Difference = namedtuple('Difference', ['sheet_name', 'row', 'column', 'left', 'right'])  # 1-based row and column
+
+
+def get_row_key(left_rows, right_rows, sort_column):
+    """
+    Get the function that gives the sort key of a row, typing the key columns like sort_values does
+    :param left_rows: list of left data rows
+    :param right_rows: list of right data rows
+    :param sort_column: 1-based column number or list of column numbers
+    :return: function that takes a row and returns a tuple of sort keys
+    """
+    columns = sort_column if isinstance(sort_column, list) else [sort_column]
+
+    def values(row):
+        return [row[c - 1] if c <= len(row) else None for c in columns]
+
+    numeric_columns = [True] * len(columns)  # a key column is numeric only if it is numeric in both sheets
+    for row in left_rows + right_rows:
+        for (n, v) in enumerate(values(row)):
+            if numeric_columns[n] and not is_number(v):
+                numeric_columns[n] = False
+    return lambda row: tuple(normalize_key(v, numeric)[1] for (v, numeric) in zip(values(row), numeric_columns))
+
+
+def iter_row_pairs(left_rows, right_rows, sort_column=None, has_header=True):
+    """
+    Pair up the rows of two sheets, by position or by key
+    :param left_rows: iterator of left rows
+    :param right_rows: iterator of right rows
+    :param sort_column: if supplied, rows are sorted in memory and matched by these columns.  Otherwise by position.
+    :param has_header: if true, the first row is the header and is not sorted
+    :return: generator of (left row, right row) tuples.  The missing side of an unmatched row is None.
+    """
+    if sort_column is None:
+        yield from zip_longest(left_rows, right_rows)
+        return
+
+    left_header = next(left_rows, None) if has_header else None
+    right_header = next(right_rows, None) if has_header else None
+    (left_rows, right_rows) = (list(left_rows), list(right_rows))
+    row_key = get_row_key(left_rows, right_rows, sort_column)
+    left_rows.sort(key=row_key)  # stable, so equal keys keep their row order like in sort_values
+    right_rows.sort(key=row_key)
+    if has_header:
+        yield left_header, right_header
+    yield from merge_rows(iter(left_rows), iter(right_rows), sort_column, row_key)
+
+
+def iter_differences(left_sheets, right_sheets, threshold=0.001, sort_column=None, has_header=True,
+                     sheet_matching="name", rules=None):
+    """
+    Compare the sheets of two files and yield each difference as it is found
+    :param left_sheets: list of (sheet name, row iterator) tuples from open_rows
+    :param right_sheets: list of (sheet name, row iterator) tuples from open_rows
+    :param threshold: maximum acceptable differrnces of numerical values
+    :param sort_column: numerical index of column, or list of such indices, used to match rows
+    :param has_header: if true, first row is excluded from sort
+    :param sheet_matching: if "name", sheets with the same name will be compared.  Otherwise, order is used.
+    :param rules: dictionary that maps a column (1-based index or header name) to a comparison rule
+    :return: generator of Difference tuples.  A sheet without a match has no row and column.
+    """
+    if sheet_matching == "name":
+        left_by_name = dict(left_sheets)
+        right_by_name = dict(right_sheets)
+        sheet_pairs = [(name, rows, right_by_name.get(name)) for (name, rows) in left_sheets]
+        sheet_pairs += [(name, None, rows) for (name, rows) in right_sheets if name not in left_by_name]
+    else:
+        sheet_pairs = [(l[0] if l else r[0], l[1] if l else None, r[1] if r else None)
+                       for (l, r) in zip_longest(left_sheets, right_sheets)]
+
+    for (sheet_name, left_rows, right_rows) in sheet_pairs:
+        if left_rows is None or right_rows is None:
+            yield Difference(sheet_name, None, None, None, None)  # sheet is only in one file
+            continue
+
+        default = make_comparator(None, threshold)
+        comparators = None  # compiled from the first row, which has the header names
+        pairs = iter_row_pairs(iter(left_rows), iter(right_rows), sort_column, has_header)
+        for (row, (left_values, right_values)) in enumerate(pairs, start=1):
+            if comparators is None:
+                header = list(left_values or right_values or ())
+                comparators = compile_rules(rules, header, threshold, len(header), has_header)
+            for (column, (l, r)) in enumerate(zip_longest(left_values or (), right_values or ()), start=1):
+                compare = comparators[column - 1] if column <= len(comparators) else default
+                if not compare(l, r)[1]:
+                    yield Difference(sheet_name, row, column, l, r)
+
+
+def find_differences(left_path, right_path, threshold=0.001, sort_column=None, has_header=True,
+                     sheet_matching="name", csv_schema=None, max_differences=1, rules=None):
+    """
+    Stream two files and return their first differences.  Stops reading after max_differences differences.
+    :param left_path: first file to compare (left)
+    :param right_path: second file to compare (right)
+    :param threshold: maximum acceptable differrnces of numerical values
+    :param sort_column: numerical index of column, or list of such indices, used to match rows.  Rows of each sheet are
+                        sorted in memory first.  If not supplied, rows are matched by position and are not held in
+                        memory.
+    :param has_header: if true, first row is excluded from sort
+    :param sheet_matching: if "name", sheets with the same name will be compared.  Otherwise, order is used.
+                        Sheets without a match count as a difference, while compare_files leaves them out.
+    :param csv_schema: dictionary that maps a csv column (1-based index or header name) to a type name
+    :param max_differences: stop after this many differences.  None finds every difference.
+    :param rules: dictionary that maps a column (1-based index or header name) to a comparison rule
+    :return: list of Difference tuples.  Empty if the files are equal.
+    """
+    left_path = is_file_extension_valid(left_path)
+    right_path = is_file_extension_valid(right_path)
+
+    with open_rows(left_path, schema=csv_schema, has_header=has_header) as left_sheets, \
+            open_rows(right_path, schema=csv_schema, has_header=has_header) as right_sheets:
+        differences = list(islice(iter_differences(left_sheets, right_sheets, threshold, sort_column, has_header,
+                                                   sheet_matching, rules), max_differences))
+
+    for d in differences:
+        logging.info("difference found: {}".format(d))
+    return differences
+
+
+def files_are_equal(left_path, right_path, threshold=0.001, sort_column=None, has_header=True,
+                    sheet_matching="name", csv_schema=None, rules=None):
+    """
+    Check if two files are equal, stopping at the first difference.  See find_differences for the parameters.
+    :return: True if no value differs by more than the threshold
+    """
+    return not find_differences(left_path, right_path, threshold, sort_column, has_header, sheet_matching,
+                                csv_schema, max_differences=1, rules=rules)
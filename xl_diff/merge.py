@@ -0,0 +1,75 @@
+"""
+This module contains the key helpers shared by comparisons that match rows by key.
+
+normalize_key gives the sort key of a key value once the type of its column is known, as sort_values does after
+reading every key.  key_value gives a sort key without knowing the column type, for rows that arrive in a stream.
+merge_rows is a merge join of two streams of rows sorted by key.
+"""
+import logging
+
+from .validators import is_number
+
+
+def normalize_key(value, numeric, has_nan=True):
+    """
+    Convert a key value to the type of its column and get a sort key that orders every value of the column.  NaN
+    sorts after every number and equals other NaN values, so it can be matched like any other key.
+    :param value: key value
+    :param numeric: True if every value of the column is a number
+    :param has_nan: False if no value of the column is NaN.  The sort key of a number is then the number itself,
+                    which takes less memory than a tuple.
+    :return: tuple of (normalized value, sort key)
+    """
+    if not numeric:
+        text = str(value)
+        return text, text
+    number = float(value)
+    if not has_nan:
+        return number, number
+    return number, ((1, 0.0) if number != number else (0, number))  # NaN is the only value not equal to itself
+
+
+def key_value(value):
+    """
+    Make a value comparable with any other value: None first, then numbers, then text.
+    :param value: value from a row
+    :return: tuple that sorts the same way for every type of value
+    """
+    if value is None:
+        return 0, 0.0, ""
+    if is_number(value) and not isinstance(value, str):
+        return 1, float(value), ""
+    return 2, 0.0, str(value)
+
+
+def merge_rows(left_rows, right_rows, sort_column, row_key=None):
+    """
+    Merge two streams of rows sorted by the sort columns.  Works like a full outer join on the key.
+    :param left_rows: iterator of left rows in key order
+    :param right_rows: iterator of right rows in key order
+    :param sort_column: 1-based column number or list of column numbers
+    :param row_key: function that gets the sort key of a row.  If not supplied, the key_value of each sort column.
+    :return: generator of (left row, right row) tuples.  The missing side of an unmatched row is None.
+    """
+    columns = sort_column if isinstance(sort_column, list) else [sort_column]
+
+    def key(row):
+        return row_key(row) if row_key is not None else tuple(key_value(row[c - 1]) for c in columns)
+
+    left = next(left_rows, None)
+    right = next(right_rows, None)
+    last_key = None
+    while left is not None or right is not None:
+        left_key = key(left) if left is not None else None
+        right_key = key(right) if right is not None else None
+        if right is None or (left is not None and left_key < right_key):
+            pair, left = (left, None), next(left_rows, None)
+        elif left is None or right_key < left_key:
+            pair, right = (None, right), next(right_rows, None)
+        else:
+            pair, left, right = (left, right), next(left_rows, None), next(right_rows, None)
+        current_key = left_key if pair[0] is not None else right_key
+        if last_key is not None and current_key < last_key:
+            logging.warning("rows are not in key order at key {}.  Check the ORDER BY clause".format(current_key))
+        last_key = current_key
+        yield pair
@@ -0,0 +1,204 @@
+"""
+This module contains a memory-mapped csv comparison for files that are mostly identical.
+
+Both files are memory-mapped and split into records without copying them into Python strings.  The raw bytes of each
+pair of aligned rows are compared first.  Only rows whose bytes differ are split into fields on both sides and
+compared value by value.  Rows with identical bytes are decoded once and their difference cells are filled in
+directly.  Only their typed columns are converted, once for both sides when both files inferred the same type for the
+column, and with the converter of each side when they did not.
+
+The output has the same layout as compare_sheet: a copy of the left values, a copy of the right values and a sheet with
+left, right and difference columns side by side.
+"""
+import csv
+import locale
+import logging
+import mmap
+import os
+from contextlib import contextmanager
+from datetime import date, timedelta
+from itertools import zip_longest, islice
+
+from .convert import CSV_SAMPLE_SIZE, infer_column_types, get_converters, convert_row
+from .validators import is_number
+
+QUOTE = b'"'
+NEWLINE = b"\n"
+
+
+@contextmanager
+def map_file(file_path):
+    """
+    Memory-map a file for reading.  Empty files can not be memory-mapped, so they are returned as empty bytes.
+    :param file_path: file path
+    :return: context manager that returns the mmap object
+    """
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def find_records(data):
+    """
+    Find the byte range of each record in a memory-mapped csv file.  Newlines inside quoted fields do not end a record.
+    Line terminators are not included in the range.
+    :param data: mmap object (or bytes)
+    :return: generator of (start, end) tuples
+    """
+    size = len(data)
+    start = 0
+    while start < size:
+        newline = data.find(NEWLINE, start)
+        if newline == -1:
+            newline = size
+        quote = data.find(QUOTE, start, newline)
+        while quote != -1:  # the record has quotes, so a newline may be inside a quoted field
+            closing = data.find(QUOTE, quote + 1)
+            if closing == -1:
+                break  # unbalanced quote.  let the csv reader deal with the rest of the record
+            if closing > newline:
+                newline = data.find(NEWLINE, closing)
+                newline = size if newline == -1 else newline
+            quote = data.find(QUOTE, closing + 1, newline)
+        end = newline - 1 if newline > start and data[newline - 1:newline] == b"\r" else newline
+        yield start, end
+        start = newline + 1
+
+
+def decode_record(view, start, end, encoding):
+    """
+    Split the bytes of one record into text fields
+    :param view: memoryview of the file
+    :param start: first byte of the record
+    :param end: byte after the last byte of the record
+    :param encoding: text encoding of the file
+    :return: list of text fields
+    """
+    text = str(view[start:end], encoding)
+    return next(csv.reader([text], delimiter=",", quotechar='"'), [])
+
+
+def get_file_converters(view, records, encoding, schema, has_header, sample_size=CSV_SAMPLE_SIZE):
+    """
+    Infer column types from a sample of records and build a converter for each column
+    :param view: memoryview of the file
+    :param records: list of (start, end) tuples
+    :param encoding: text encoding of the file
+    :param schema: dictionary that maps a 1-based column index or a header name to a type name
+    :param has_header: if true, the first record contains column names
+    :param sample_size: number of rows used to infer column types
+    :return: tuple of (list of type names, list of converter functions)
+    """
+    sample = [decode_record(view, s, e, encoding)
+              for (s, e) in islice(records, sample_size + 1 if has_header else sample_size)]
+    types = infer_column_types(sample, has_header, schema)
+    return types, get_converters(types, sample, has_header)
+
+
+def convert_identical_row(values, left_types, right_types, left_converters, right_converters):
+    """
+    Convert the text values of a row whose bytes are the same in both files.  Text columns are not converted.  A typed
+    column is converted once if both files have the same type for it, and once per side if they do not.
+    :param values: list of text values
+    :return: tuple of (left values, right values)
+    """
+    left_values = list(values)
+    right_values = left_values
+    for (n, text) in enumerate(values):
+        left_type = left_types[n] if n < len(left_types) else "str"
+        right_type = right_types[n] if n < len(right_types) else "str"
+        if left_type == right_type:
+            if left_type != "str":
+                left_values[n] = left_converters[n](text)  # right_values is the same list
+        else:
+            if right_values is left_values:
+                right_values = list(values)
+            if left_type != "str":
+                left_values[n] = left_converters[n](text)
+            if right_type != "str":
+                right_values[n] = right_converters[n](text)
+    return left_values, right_values
+
+
+def identical_difference(value):
+    """
+    Get the difference value of two equal values without comparing them
+    :param value: value on both sides
+    :return: 0.0 for numbers, no time for dates, Same for anything else
+    """
+    if is_number(value):
+        return 0.0
+    if isinstance(value, date):
+        return timedelta(0)
+    return "Same"
+
+
+def compare_csv_files_mapped(left_path, right_path, output_wb, threshold, schema=None, has_header=True,
+                             sheet_name="Sheet"):
+    """
+    Compare two csv files row by row using memory maps and add the left, right and comparison sheets to the workbook.
+    :param left_path: first csv file (left)
+    :param right_path: second csv file (right)
+    :param output_wb: openpyxl workbook object that receives the sheets
+    :param threshold: numerical differences below this amount are considered identical
+    :param schema: dictionary that maps a 1-based column index or a header name to a type name
+    :param has_header: if true, the first row contains column names and is kept as text
+    :param sheet_name: title used for the new sheets
+    :return: tuple of (left sheet, right sheet, comparison sheet)
+    """
+    from .compare import value_difference, apply_style  # compare imports this module
+
+    encoding = locale.getpreferredencoding(False)  # same default as open() in the csv readers
+    left_sheet = output_wb.create_sheet(sheet_name)
+    right_sheet = output_wb.create_sheet(sheet_name)
+    output_sheet = output_wb.create_sheet(sheet_name)
+
+    with map_file(left_path) as left_map, map_file(right_path) as right_map, \
+            memoryview(left_map) as left_view, memoryview(right_map) as right_view:
+        left_records = list(find_records(left_map))
+        right_records = list(find_records(right_map))
+        (left_types, left_converters) = get_file_converters(left_view, left_records, encoding, schema, has_header)
+        (right_types, right_converters) = get_file_converters(right_view, right_records, encoding, schema,
+                                                              has_header)
+
+        same_rows = 0
+        row = 0
+        for (left_record, right_record) in zip_longest(left_records, right_records):
+            row += 1
+            keep_text = has_header and row == 1
+            if left_record and right_record and \
+                    left_view[left_record[0]:left_record[1]] == right_view[right_record[0]:right_record[1]]:
+                same_rows += 1  # identical bytes.  decode once and skip the value comparison
+                values = decode_record(left_view, left_record[0], left_record[1], encoding)
+                if keep_text:
+                    left_values = right_values = values
+                else:
+                    (left_values, right_values) = convert_identical_row(values, left_types, right_types,
+                                                                        left_converters, right_converters)
+                differences = [identical_difference(l) if l is r or l == r else value_difference(l, r)
+                               for (l, r) in zip(left_values, right_values)]
+            else:
+                left_values = [] if not left_record else \
+                    decode_record(left_view, left_record[0], left_record[1], encoding)
+                right_values = [] if not right_record else \
+                    decode_record(right_view, right_record[0], right_record[1], encoding)
+                if not keep_text:
+                    left_values = convert_row(left_values, left_converters)
+                    right_values = convert_row(right_values, right_converters)
+                differences = [value_difference(l, r) for (l, r) in zip_longest(left_values, right_values)]
+                left_values = left_values + [None] * (len(differences) - len(left_values))
+                right_values = right_values + [None] * (len(differences) - len(right_values))
+
+            left_sheet.append(left_values)
+            right_sheet.append(right_values)
+            for (n, (l, r, d)) in enumerate(zip(left_values, right_values, differences)):
+                output_column = n * 3 + 1
+                output_sheet.cell(row=row, column=output_column).value = l
+                output_sheet.cell(row=row, column=output_column + 1).value = r
+                output_sheet.cell(row=row, column=output_column + 2).value = d
+                apply_style(output_sheet.cell(row=row, column=output_column + 2), threshold)
+    logging.info("compared {} rows, {} with identical bytes".format(row, same_rows))
+    return left_sheet, right_sheet, output_sheet
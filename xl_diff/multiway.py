@@ -0,0 +1,208 @@
+"""
+This module contains a comparison of the same report from several environments (e.g. dev, uat and prod) in one pass.
+
+Comparing N files two at a time loads and sorts each file up to N - 1 times.  Here every file is loaded once and the
+keys of every sheet are read and sorted once.  The sorted keys of all files are then lined up by a single k-way merge
+(heapq.merge), the N-way form of the merge in sort_values: each output row holds the row of every file with that key,
+or no row for files without the key.  Repeated keys are paired in row order, like in sort_values.  Without a sort
+column, rows are lined up by position.
+
+Each sheet of the output gets a sorted copy of the sheet of every file and a comparison sheet.  For each column, the
+comparison sheet has the value of every file, then a difference column for every pair of files.  The summary counts
+the differences of every sheet, column and pair of files.
+"""
+import heapq
+import logging
+import os
+from array import array
+from datetime import timedelta
+from itertools import combinations, groupby, zip_longest
+
+from .backends import load_workbook, save_workbook
+from .rowmap import MISSING_ROW, ROW_TYPECODE
+from .rules import compile_rules
+from .summary import get_column_name, make_summary_node, create_summary_worksheet, DELTA_NUMBER_FORMAT
+from .validators import is_file_extension_valid
+
+MULTIWAY_COMPARE_TYPES = ("default", "sorted")
+
+
+def get_labels(paths):
+    """
+    Get a short name for each file, used in sheet names and the summary.  File names are used if they are unique, then
+    the names of the folders of the files (e.g. dev/report.xlsx and prod/report.xlsx), then numbers.
+    :param paths: list of file paths
+    :return: list of labels
+    """
+    for labels in ([os.path.splitext(os.path.basename(p))[0] for p in paths],
+                   [os.path.basename(os.path.dirname(os.path.abspath(p))) for p in paths]):
+        if len(set(labels)) == len(labels):
+            return labels
+    return [str(n) for n in range(1, len(paths) + 1)]
+
+
+def merge_sorted_keys(key_lists):
+    """
+    Line up the sorted keys of several sheets with a k-way merge.  Functions as a full outer join of every sheet.
+    :param key_lists: list of (sort keys, row numbers) pairs, one per sheet, each sorted by sort key (see pack_keys)
+    :return: list of arrays of row numbers, one per sheet and all of the same length.  MISSING_ROW where a sheet does
+             not have the key of an output row.
+    """
+    def tag(side, sort_keys, row_numbers):
+        for (sort_key, row_number) in zip(sort_keys, row_numbers):
+            yield sort_key, side, row_number
+
+    rows = [array(ROW_TYPECODE) for _ in key_lists]
+    tagged = [tag(side, sort_keys, row_numbers) for (side, (sort_keys, row_numbers)) in enumerate(key_lists)]
+    merged = heapq.merge(*tagged, key=lambda item: item[0])  # equal keys come in sheet order, then row order
+    for (_, group) in groupby(merged, key=lambda item: item[0]):
+        group_rows = [[] for _ in key_lists]
+        for (_, side, row_number) in group:
+            group_rows[side].append(row_number)
+        for n in range(0, max(len(g) for g in group_rows)):  # repeated keys are paired by occurrence
+            for (side, g) in enumerate(group_rows):
+                rows[side].append(g[n] if n < len(g) else MISSING_ROW)
+    return rows
+
+
+def sort_values_multi(sheets, sort_column, has_header=False):
+    """
+    Line up the rows of several sheets by key in one merge
+    :param sheets: list of worksheet objects
+    :param sort_column: number or list of numbers indicating columns used for sorting
+    :param has_header: if true, first row is excluded from sort
+    :return: list of arrays of row numbers, one per sheet, as returned by merge_sorted_keys
+    """
+    from .compare import read_keys, pack_keys  # compare imports most modules
+
+    starting_row = 1 if has_header is False else 2
+    columns = sort_column if isinstance(sort_column, list) else [sort_column]
+    numeric_columns = [True] * len(columns)  # a key column is numeric only if it is numeric in every sheet
+    nan_columns = [False] * len(columns)
+    keys = [read_keys(sheet, columns, starting_row, numeric_columns, nan_columns) for sheet in sheets]
+    return merge_sorted_keys([pack_keys(k, numeric_columns, isinstance(sort_column, list), starting_row, nan_columns,
+                                        keep_values=False)[:2] for k in keys])
+
+
+def compare_sheets_multi(sheets, labels, output_wb, sheet_name, threshold=0.001, sort_column=None, has_header=True,
+                         rules=None):
+    """
+    Compare the same sheet of several files and add the sorted copies and the comparison sheet to the output
+    :param sheets: list of worksheet objects, one per file
+    :param labels: list of file labels
+    :param output_wb: output workbook object
+    :param sheet_name: name of the comparison sheet
+    :param threshold: numerical differences below this amount are considered identical
+    :param sort_column: if supplied, rows are lined up by these columns.  Otherwise, by position.
+    :param has_header: if true, the first row is a header
+    :param rules: dictionary that maps a column (1-based index or header name) to a comparison rule
+    :return: list of SummaryNode objects with the differences of each column and pair of files
+    """
+    from .compare import SAME_FILL, DIFFERENT_FILL  # compare imports most modules
+
+    width = max(sheet.max_column for sheet in sheets)
+    values = [[tuple(row) + (None,) * (width - len(row)) for row in sheet.iter_rows(values_only=True)]
+              for sheet in sheets]
+    empty = (None,) * width
+    if sort_column is not None:
+        row_numbers = sort_values_multi(sheets, sort_column, has_header)
+        aligned = [[v[r - 1] if r else empty for r in rows] for (v, rows) in zip(values, row_numbers)]
+        if has_header:
+            aligned = [[v[0] if v else empty] + a for (v, a) in zip(values, aligned)]
+    else:
+        aligned = [list(side) for side in zip(*zip_longest(*values, fillvalue=empty))] or [[] for _ in sheets]
+    row_count = len(aligned[0]) if aligned else 0
+
+    for (label, sheet, rows) in zip(labels, sheets, aligned):
+        copy = output_wb.create_sheet("{}_{}".format(label, sheet.title))
+        for row in rows:
+            copy.append(row)
+
+    header = list(aligned[0][0]) if row_count else []
+    pairs = list(combinations(range(0, len(sheets)), 2))
+    comparators = [compile_rules(rules, header, threshold, width, has_header) for _ in pairs]
+    counts = [[0] * width for _ in pairs]
+    output_sheet = output_wb.create_sheet(sheet_name)
+    columns_per_value = len(sheets) + len(pairs)
+    for row_number in range(0, row_count):
+        row_values = [aligned[side][row_number] for side in range(0, len(sheets))]
+        output_row = []
+        fills = []
+        for column in range(0, width):
+            output_row.extend(v[column] for v in row_values)
+            for (p, (a, b)) in enumerate(pairs):
+                (difference, same) = comparators[p][column](row_values[a][column], row_values[b][column])
+                output_row.append(difference)
+                fills.append((column * columns_per_value + len(sheets) + p + 1, same, difference))
+                counts[p][column] += not same
+        output_sheet.append(output_row)
+        for (output_column, same, difference) in fills:
+            cell = output_sheet.cell(row=row_number + 1, column=output_column)
+            cell.fill = SAME_FILL if same else DIFFERENT_FILL
+            if isinstance(difference, timedelta):
+                cell.number_format = DELTA_NUMBER_FORMAT
+
+    return [make_summary_node("{}: {} v {}".format(sheet_name, labels[a], labels[b]),
+                              get_column_name(header, c, has_header), counts[p][c], row_count, float(c + 1))
+            for (p, (a, b)) in enumerate(pairs) for c in range(0, width) if counts[p][c] > 0]
+
+
+def compare_files_multi(paths, output_path, labels=None, threshold=0.001, sort_column=None, compare_type="default",
+                        has_header=True, sheet_matching="name", add_summary=True, csv_schema=None, rules=None,
+                        open_on_finish=False):
+    """
+    Compare the same report from several files in one pass and save one comparison file.  Every file is loaded once.
+    :param paths: list of two or more files to compare, e.g. the dev, uat and prod versions of a report
+    :param output_path: output file
+    :param labels: list of short names of the files, used in sheet names and the summary.  Defaults to the file names,
+                        or the folder names if the file names are the same.
+    :param threshold: maximum acceptable differences of numerical values
+    :param sort_column: numerical index of column, or list of such indices, used to sort rows
+    :param compare_type: sorted or default (unsorted)
+    :param has_header: if true, first row is excluded from sort
+    :param sheet_matching: if "name", sheets with the same name in every file are compared.  Otherwise, order is used.
+    :param add_summary: if true, add a summary sheet with the count of differences by sheet, column and pair of files
+    :param csv_schema: dictionary that maps a csv column (1-based index or header name) to a type name
+    :param rules: dictionary that maps a column (1-based index or header name) to a comparison rule
+    :param open_on_finish: if true, the output file will be opened when it is complete
+    :return: None
+    """
+    from .helper_excel import get_empty_workbook
+
+    if len(paths) < 2:
+        raise ValueError("at least two files are needed for a comparison")
+    if compare_type not in MULTIWAY_COMPARE_TYPES:
+        raise ValueError("compare type must be one of {} when comparing more than two files".format(
+            MULTIWAY_COMPARE_TYPES))
+    if compare_type == "sorted" and sort_column is None:
+        raise ValueError("a sort column is needed if compare type is sorted")
+    labels = labels or get_labels(paths)
+    if len(labels) != len(paths):
+        raise ValueError("expected {} labels, one per file, but got {}".format(len(paths), len(labels)))
+
+    logging.info("comparing {} files: {}".format(len(paths), ", ".join(paths)))
+    workbooks = [load_workbook(is_file_extension_valid(p), schema=csv_schema, has_header=has_header) for p in paths]
+    if sheet_matching == "name":
+        sheet_names = [[name] * len(workbooks) for name in workbooks[0].sheetnames
+                       if all(name in wb.sheetnames for wb in workbooks)]
+    else:
+        sheet_names = [list(names) for names in zip(*(wb.sheetnames for wb in workbooks))]
+    if not sheet_names:
+        raise ValueError("No sheets were found for processing.  Check sheet_matching parameter is set correctly " +
+                         "(e.g. name or order)")
+
+    output_wb = get_empty_workbook()
+    nodes = []
+    for names in sheet_names:
+        output_sheet_name = names[0] if len(set(names)) == 1 else " v ".join(names)
+        logging.info("comparing sheet {}".format(output_sheet_name))
+        nodes.extend(compare_sheets_multi([wb[name] for (wb, name) in zip(workbooks, names)], labels, output_wb,
+                                          output_sheet_name, threshold, sort_column if compare_type == "sorted" else
+                                          None, has_header, rules))
+    if add_summary:
+        create_summary_worksheet(nodes, output_wb, header_rows=1 if has_header else 0)
+    save_workbook(output_wb, output_path)
+
+    logging.info("save complete")
+    if open_on_finish:
+        os.system('"' + output_path + '"')  # use OS command line to open file.  This works on Windows
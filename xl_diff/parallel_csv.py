@@ -0,0 +1,120 @@
+"""
+This module contains a multi-process csv reader for large csv files.
+
+The file is split into chunks of roughly equal size.  Chunks always end at a record boundary: a newline is only a
+boundary if it is not inside a quoted field, which is true when an even number of quote characters come before it.
+Each chunk is parsed and converted to typed values in a worker process.  Chunks are returned in file order, so rows
+can be appended to a worksheet exactly as if the file was read by a single csv reader.
+
+Note: quote counting assumes the quote character only appears in quoted fields (as in RFC 4180 files), which is how
+the csv module writes files.
+"""
+import csv
+import io
+import logging
+import mmap
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from .convert import CSV_SAMPLE_SIZE, infer_column_types, get_converters, convert_row
+
+PARALLEL_CSV_MIN_SIZE = 64 * 1024 * 1024  # files smaller than this are read by a single csv reader
+CHUNK_SIZE = 32 * 1024 * 1024  # target size of each chunk in bytes
+
+
+def find_record_boundaries(csv_path, chunk_size=CHUNK_SIZE, quotechar=b'"'):
+    """
+    Find byte offsets that split the file into chunks of about chunk_size bytes at record boundaries
+    :param csv_path: file path of csv file
+    :param chunk_size: target size of each chunk in bytes
+    :param quotechar: quote character of the csv file
+    :return: list of offsets, starting with 0 and ending with the file size
+    """
+    file_size = os.path.getsize(csv_path)
+    boundaries = [0]
+    if file_size == 0:
+        return boundaries
+
+    with open(csv_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        quotes = 0  # number of quote characters before position
+        position = 0
+        target = chunk_size
+        while target < file_size:
+            quotes += data[position:target].count(quotechar)  # slices of an mmap are counted in C
+            position = target
+            newline = data.find(b"\n", position)
+            while newline != -1:
+                quotes += data[position:newline].count(quotechar)
+                position = newline
+                if quotes % 2 == 0:  # newline is not inside a quoted field
+                    break
+                newline = data.find(b"\n", position + 1)
+            if newline == -1:
+                break  # no more record boundaries
+            boundaries.append(newline + 1)
+            target = max(target + chunk_size, newline + 1)
+    boundaries.append(file_size)
+    return boundaries
+
+
+def parse_chunk(csv_path, start, end, types, sample, has_header, keep_first_row):
+    """
+    Parse and convert the rows of one chunk.  This function runs in a worker process.
+    :param csv_path: file path of csv file
+    :param start: byte offset of the first record in the chunk
+    :param end: byte offset after the last record in the chunk
+    :param types: list of column type names
+    :param sample: sample rows used to infer the types, used to build the same converters in every worker
+    :param has_header: if true, the first row of the sample is the header
+    :param keep_first_row: if true, the first row of the chunk is the header and is not converted
+    :return: list of rows
+    """
+    with open(csv_path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    converters = get_converters(types, sample, has_header)
+    reader = csv.reader(io.TextIOWrapper(io.BytesIO(data), newline=''), delimiter=",", quotechar='"')
+    rows = []
+    if keep_first_row:
+        rows.append(next(reader, None))
+    for row in reader:
+        rows.append(convert_row(row, converters))
+    return [r for r in rows if r is not None]
+
+
+def read_csv_rows_parallel(csv_path, schema=None, has_header=True, workers=None, chunk_size=CHUNK_SIZE,
+                           sample_size=CSV_SAMPLE_SIZE):
+    """
+    Read the rows of a csv file using several processes.  Rows are yielded in file order.  At most two chunks per
+    worker are parsed ahead of the consumer, so memory use does not grow with the file size.
+    :param csv_path: file path of csv file
+    :param schema: dictionary that maps a 1-based column index or a header name to a type name
+    :param has_header: if true, the first row contains column names and is kept as text
+    :param workers: number of worker processes.  Defaults to the number of cores.
+    :param chunk_size: target size of each chunk in bytes
+    :param sample_size: number of rows used to infer column types
+    :return: generator of rows
+    """
+    with open(csv_path, newline='') as csv_file:  # types are inferred once, from the start of the file
+        sample = list(islice(csv.reader(csv_file, delimiter=",", quotechar='"'),
+                             sample_size + 1 if has_header else sample_size))
+    types = infer_column_types(sample, has_header, schema)
+    logging.info("csv column types: {}".format(types))
+
+    boundaries = find_record_boundaries(csv_path, chunk_size)
+    chunks = list(zip(boundaries[:-1], boundaries[1:]))
+    logging.info("reading '{}' in {} chunks".format(csv_path, len(chunks)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        window = 2 * (workers or os.cpu_count() or 1)
+        pending = deque()
+        for (n, (start, end)) in enumerate(chunks):
+            pending.append(executor.submit(parse_chunk, csv_path, start, end, types, sample, has_header,
+                                           has_header and n == 0))
+            if len(pending) >= window:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
@@ -0,0 +1,280 @@
+"""
+This module contains a multi-process writer for large XLSX output files.
+
+openpyxl serializes every worksheet one after the other, which dominates the time to save a large comparison.  This
+writer reads the cells of each sheet in the main process and resolves their styles against the shared stylesheet of
+the workbook.  Chunks of rows are then serialized to sheet XML by worker processes, each writing its own part file.
+openpyxl saves the rest of the package (workbook, styles, column widths, merged cells...) with empty sheets, and the
+zip package is assembled from that file with the sheet data of each worksheet streamed in from the part files.
+
+Cells are written the same way openpyxl writes them (inline strings, numbers with 16 significant digits, dates as
+serial numbers), so the file opens in Excel the same way.  Workbooks with hyperlinks, comments, rich text or array
+formulas are saved by openpyxl.
+
+With shared strings, each distinct text is written once to a shared strings table and cells refer to it by index, like
+files saved by Excel.  Comparison outputs repeat every text value in the left, right and source sheets, so this makes
+them much smaller and faster to open.
+"""
+import logging
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+from xml.sax.saxutils import escape
+
+from openpyxl.cell.rich_text import CellRichText
+from openpyxl.compat import safe_string
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.datetime import to_excel, to_ISO8601
+from openpyxl.worksheet.formula import ArrayFormula, DataTableFormula
+
+PARALLEL_XLSX_MIN_CELLS = 1000000  # workbooks with fewer cells are saved by openpyxl
+XLSX_CHUNK_ROWS = 50000  # rows serialized by each task
+SHEET_DATA = re.compile(rb"<sheetData\s*/>|<sheetData>.*?</sheetData>", re.S)
+DIMENSION = re.compile(rb'<dimension ref="[^"]*"\s*/>')
+COPY_BUFFER_SIZE = 1024 * 1024
+SHARED_STRINGS_PART = "xl/sharedStrings.xml"
+SHARED_STRINGS_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"
+SHARED_STRINGS_RELATIONSHIP = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings"
+SPREADSHEET_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+
+
+def count_cells(wb):
+    """
+    Get the number of cells of all worksheets, counting the used range of each sheet
+    :param wb: openpyxl workbook object
+    :return: number of cells
+    """
+    return sum(ws.max_row * ws.max_column for ws in wb.worksheets)
+
+
+def read_cell(cell, iso_dates, epoch):
+    """
+    Get the XML type and text of a cell, the same way openpyxl writes it
+    :param cell: openpyxl cell object
+    :param iso_dates: if true, dates are written as ISO 8601 text
+    :param epoch: date epoch of the workbook
+    :return: tuple of (type attribute or None, value)
+    """
+    value = cell._value
+    data_type = cell.data_type
+    if data_type == "s":
+        return "inlineStr", value
+    if data_type == "f":
+        return None, value
+    if data_type == "d":
+        if getattr(value, "tzinfo", None) is not None:
+            raise TypeError("Excel does not support timezones in datetimes. "
+                            "The tzinfo in the datetime/time object must be set to None.")
+        if iso_dates and not isinstance(value, timedelta):
+            return "d", to_ISO8601(value)
+        return "n", to_excel(value, epoch)
+    return data_type, value
+
+
+def is_supported(cell):
+    """
+    Check if this writer can write a cell.  Other cells are left to openpyxl.
+    :param cell: openpyxl cell object
+    :return: True if supported
+    """
+    return not (cell.hyperlink or cell.comment
+                or isinstance(cell._value, (CellRichText, ArrayFormula, DataTableFormula)))
+
+
+def read_sheet_rows(ws, strings=None):
+    """
+    Read the cells of a worksheet in row order.  Styles are added to the stylesheet of the workbook, so the skeleton
+    saved afterwards has every style used by the sheet data.
+    :param ws: openpyxl worksheet object
+    :param strings: dictionary that maps each text to its index in the shared strings table.  If supplied, text cells
+                        refer to the table and new texts are added to it.  Otherwise, text is written inline.
+    :return: list of (row index, row attributes, list of (column index, style id or None, type, value)) tuples, or
+             None if the sheet has cells this writer does not support
+    """
+    wb = ws.parent
+    rows = {}
+    for ((row, col), cell) in sorted(ws._cells.items()):  # only cells that exist, like openpyxl's own writer
+        if not is_supported(cell):
+            return None
+        if cell._value is None and not cell.has_style:
+            rows.setdefault(row, [])
+            continue
+        style_id = cell.style_id if cell.has_style else None
+        (data_type, value) = read_cell(cell, wb.iso_dates, wb.epoch)
+        if strings is not None and data_type == "inlineStr" and value != "":
+            (data_type, value) = ("s", strings.setdefault(value, len(strings)))
+        rows.setdefault(row, []).append((col, style_id, data_type, value))
+    for row in ws.row_dimensions.keys() - rows.keys():  # styled rows without cells
+        rows[row] = []
+    return [(row, list(ws.row_dimensions[row]) if row in ws.row_dimensions else [], cells)
+            for (row, cells) in sorted(rows.items())]
+
+
+def cell_xml(row, col, style_id, data_type, value):
+    """
+    Serialize one cell
+    :return: XML text of the c element
+    """
+    attributes = 'r="{}{}"'.format(get_column_letter(col), row)
+    if style_id is not None:
+        attributes += ' s="{}"'.format(style_id)
+    if data_type is not None:
+        attributes += ' t="{}"'.format(data_type)
+    if value is None or value == "":
+        return "<c {}/>".format(attributes)
+    if data_type is None:  # formula
+        return "<c {}><f>{}</f><v></v></c>".format(attributes, escape(value[1:]))
+    if data_type == "inlineStr":
+        space = ' xml:space="preserve"' if value != value.strip() else ""
+        return "<c {}><is><t{}>{}</t></is></c>".format(attributes, space, escape(value))
+    return "<c {}><v>{}</v></c>".format(attributes, escape(safe_string(value)))
+
+
+def write_rows_xml(rows, part_path):
+    """
+    Serialize rows to a part file of sheet data.  This function runs in a worker process.
+    :param rows: list of rows from read_sheet_rows
+    :param part_path: file path of the part file
+    :return: part_path
+    """
+    with open(part_path, "w", encoding="utf-8") as f:
+        for (row, attributes, cells) in rows:
+            row_attributes = "".join(' {}="{}"'.format(k, escape(v)) for (k, v) in attributes)
+            if not cells:
+                f.write('<row r="{}"{}/>'.format(row, row_attributes))
+                continue
+            f.write('<row r="{}"{}>'.format(row, row_attributes))
+            f.write("".join(cell_xml(row, col, style_id, data_type, value)
+                            for (col, style_id, data_type, value) in cells))
+            f.write("</row>")
+    return part_path
+
+
+def save_skeleton(wb, path):
+    """
+    Save a workbook with empty sheets.  The cells are put back afterwards.
+    :param wb: openpyxl workbook object
+    :param path: file path of the skeleton
+    :return: None
+    """
+    cells = [ws._cells for ws in wb.worksheets]
+    try:
+        for ws in wb.worksheets:
+            ws._cells = {}
+        wb.save(path)
+    finally:
+        for (ws, ws_cells) in zip(wb.worksheets, cells):
+            ws._cells = ws_cells
+
+
+def write_sheet_part(output_zip, info, skeleton_xml, dimension, part_paths):
+    """
+    Write a worksheet part to the output package, with the sheet data of the skeleton replaced by the part files
+    :param output_zip: zipfile.ZipFile object open for writing
+    :param info: ZipInfo of the worksheet in the skeleton
+    :param skeleton_xml: worksheet XML of the skeleton
+    :param dimension: used range of the sheet, e.g. "A1:C10"
+    :param part_paths: list of part files of the sheet, in row order
+    :return: None
+    """
+    skeleton_xml = DIMENSION.sub('<dimension ref="{}" />'.format(dimension).encode(), skeleton_xml, count=1)
+    match = SHEET_DATA.search(skeleton_xml)
+    size = len(skeleton_xml) + sum(os.path.getsize(p) for p in part_paths)
+    with output_zip.open(info, "w", force_zip64=size > zipfile.ZIP64_LIMIT // 2) as f:
+        f.write(skeleton_xml[:match.start()])
+        f.write(b"<sheetData>")
+        for part_path in part_paths:
+            with open(part_path, "rb") as part:
+                shutil.copyfileobj(part, f, COPY_BUFFER_SIZE)
+        f.write(b"</sheetData>")
+        f.write(skeleton_xml[match.end():])
+
+
+def write_shared_strings(output_zip, strings):
+    """
+    Write the shared strings table to the output package
+    :param output_zip: zipfile.ZipFile object open for writing
+    :param strings: dictionary that maps each text to its index, in index order
+    :return: None
+    """
+    with output_zip.open(SHARED_STRINGS_PART, "w", force_zip64=True) as f:
+        f.write('<sst xmlns="{}" uniqueCount="{}">'.format(SPREADSHEET_NS, len(strings)).encode())
+        for text in strings:
+            space = ' xml:space="preserve"' if text != text.strip() else ""
+            f.write("<si><t{}>{}</t></si>".format(space, escape(text)).encode("utf-8"))
+        f.write(b"</sst>")
+
+
+def add_shared_strings_part(filename, xml):
+    """
+    Register the shared strings table in the content types or the workbook relationships of a skeleton without one
+    :param filename: name of the part in the package
+    :param xml: XML of the part
+    :return: XML of the part, with the shared strings table added if the part needs it
+    """
+    if filename == "[Content_Types].xml" and b"/" + SHARED_STRINGS_PART.encode() not in xml:
+        override = '<Override PartName="/{}" ContentType="{}" />'.format(SHARED_STRINGS_PART, SHARED_STRINGS_TYPE)
+        return xml.replace(b"</Types>", override.encode() + b"</Types>")
+    if filename == "xl/_rels/workbook.xml.rels" and SHARED_STRINGS_RELATIONSHIP.encode() not in xml:
+        relationship = '<Relationship Type="{}" Target="sharedStrings.xml" Id="rIdSharedStrings" />'.format(
+            SHARED_STRINGS_RELATIONSHIP)
+        return xml.replace(b"</Relationships>", relationship.encode() + b"</Relationships>")
+    return xml
+
+
+def write_xlsx_parallel(wb, file_path, workers=None, chunk_rows=XLSX_CHUNK_ROWS, shared_strings=False):
+    """
+    Save an openpyxl workbook object as an excel XLSX file, serializing the sheet data in several processes
+    :param wb: openpyxl workbook object
+    :param file_path: target file path
+    :param workers: number of worker processes.  Defaults to the number of cores.  With 1, or when every sheet fits in
+                        one chunk, the sheet data is serialized in a thread of this process.
+    :param chunk_rows: number of rows serialized by each task
+    :param shared_strings: if true, text is written once to a shared strings table instead of inline in each cell
+    :return: None
+    """
+    strings = {} if shared_strings else None
+    sheet_rows = [read_sheet_rows(ws, strings) for ws in wb.worksheets]
+    if any(rows is None for rows in sheet_rows):
+        logging.info("workbook has hyperlinks, comments or rich text.  saving with openpyxl")
+        wb.save(file_path)
+        return
+
+    dimensions = [ws.calculate_dimension() for ws in wb.worksheets]
+    in_process = workers == 1 or all(len(rows) <= chunk_rows for rows in sheet_rows)  # not worth starting processes
+    temp_dir = tempfile.mkdtemp(prefix="xl_diff_xlsx_")
+    try:
+        with (ThreadPoolExecutor(max_workers=1) if in_process else ProcessPoolExecutor(max_workers=workers)) \
+                as executor:
+            futures = []
+            for (n, rows) in enumerate(sheet_rows):
+                futures.append([executor.submit(write_rows_xml, rows[start:start + chunk_rows],
+                                                os.path.join(temp_dir, "sheet{}_{}.xml".format(n, start)))
+                                for start in range(0, len(rows), chunk_rows)])
+            del sheet_rows
+
+            skeleton_path = os.path.join(temp_dir, "skeleton.xlsx")
+            save_skeleton(wb, skeleton_path)  # saved while the workers serialize the sheet data
+            sheet_parts = {ws.path[1:]: n for (n, ws) in enumerate(wb.worksheets)}
+
+            with zipfile.ZipFile(skeleton_path) as skeleton, \
+                    zipfile.ZipFile(file_path, "w", zipfile.ZIP_DEFLATED) as output_zip:
+                for info in skeleton.infolist():
+                    if info.filename in sheet_parts:
+                        n = sheet_parts[info.filename]
+                        part_paths = [f.result() for f in futures[n]]
+                        write_sheet_part(output_zip, info, skeleton.read(info), dimensions[n], part_paths)
+                    elif strings is not None and info.filename == SHARED_STRINGS_PART:
+                        continue  # older versions of openpyxl save an empty table, written below
+                    elif strings is not None:
+                        output_zip.writestr(info, add_shared_strings_part(info.filename, skeleton.read(info)))
+                    else:
+                        output_zip.writestr(info, skeleton.read(info))
+                if strings is not None:
+                    write_shared_strings(output_zip, strings)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
@@ -0,0 +1,283 @@
+"""
+This module contains a cache of query results, so a query that is run several times on the same connection (e.g. the
+same left query on every line of a job file) only runs once.
+
+Results are keyed by the connection string and the normalized SQL.  Entries expire after a time to live.  The most
+recently used results are kept in memory up to a number of rows; the least recently used results spill to files in a
+local directory.  If the directory is kept between runs, results saved by an earlier run are used until they expire.
+
+Files are written outside the lock of the cache, to a temporary file that replaces the file of the result when it is
+complete.  A file that can not be read (e.g. from another program) counts as a result that is not cached.
+
+Files are written as JSON, so reading a directory written by someone else cannot run code.  Values that JSON has no
+type for (dates, times, decimals, bytes and GUIDs returned by pyodbc) are saved as an object with the type name as its
+only key, e.g. {"date": "2020-09-10"}.
+"""
+import base64
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+from uuid import UUID
+
+CACHE_TTL = 3600  # seconds a result is used before the query is run again
+CACHE_MAX_ROWS = 1000000  # rows kept in memory before the least recently used results spill to disk
+SQL_LITERAL = re.compile(r"('(?:[^']|'')*')")  # quoted text is not normalized
+VALUE_TYPES = {  # type name -> (type, function that converts the value to text, function that reads the text)
+    "datetime": (datetime.datetime, datetime.datetime.isoformat, datetime.datetime.fromisoformat),
+    "date": (datetime.date, datetime.date.isoformat, datetime.date.fromisoformat),
+    "time": (datetime.time, datetime.time.isoformat, datetime.time.fromisoformat),
+    "decimal": (Decimal, str, Decimal),
+    "bytes": ((bytes, bytearray), lambda v: base64.b64encode(v).decode("ascii"), base64.b64decode),
+    "uuid": (UUID, str, UUID),
+}  # datetime is checked before date, as it is a subclass of date
+
+
+def normalize_sql(sql):
+    """
+    Normalize SQL so queries that only differ in white space or a trailing semicolon share a cache entry.  Quoted text
+    is left as it is.
+    :param sql: SQL query
+    :return: normalized SQL
+    """
+    parts = SQL_LITERAL.split(sql)
+    for n in range(0, len(parts), 2):  # even parts are outside quotes
+        parts[n] = re.sub(r"\s+", " ", parts[n])
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def encode_value(value):
+    """
+    Convert a value JSON has no type for to an object tagged with its type name.  Used as the default of json.dump.
+    :param value: query result value, e.g. a date
+    :return: dictionary with the type name as its only key
+    """
+    for (name, (value_type, to_text, _)) in VALUE_TYPES.items():
+        if isinstance(value, value_type):
+            return {name: to_text(value)}
+    raise TypeError("cannot save a value of type {} in the cache".format(type(value).__name__))
+
+
+def decode_value(obj):
+    """
+    Convert an object tagged by encode_value back to its value.  Used as the object_hook of json.load.
+    :param obj: dictionary read from JSON
+    :return: value
+    """
+    if len(obj) == 1:
+        ((name, text),) = obj.items()
+        if name in VALUE_TYPES:
+            return VALUE_TYPES[name][2](text)
+    return obj
+
+
+class ResultCache():
+    """
+    Cache of query results shared by several SqlToXl objects.  Safe to use from several threads.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, max_rows=CACHE_MAX_ROWS, spill_dir=None):
+        """
+        :param ttl: seconds a result is used before the query is run again
+        :param max_rows: number of rows kept in memory.  Older results are written to spill_dir.
+        :param spill_dir: directory for results that do not fit in memory.  If supplied, every result is also saved
+                          there, so later runs using the same directory can use it until it expires.  If not supplied,
+                          a temporary directory is created when needed and removed by clear().
+        """
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.spill_dir = spill_dir
+        self._temporary_dir = spill_dir is None
+        self._memory = OrderedDict()  # key -> (created, columns, rows), least recently used first
+        self._spilling = {}  # key -> entry that left memory and is being written to the spill directory
+        self._rows = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}  # key -> (lock held while the query of that key runs, number of threads using it)
+
+    def get_key(self, connection_string, sql):
+        """
+        Get the cache key of a query
+        :param connection_string: connection string
+        :param sql: SQL query
+        :return: hex digest of the connection string and normalized SQL
+        """
+        text = connection_string + "\0" + normalize_sql(sql)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_or_run(self, connection_string, sql, run):
+        """
+        Get the result of a query from the cache, or run the query and cache the result.  If the same query is already
+        running in another thread, wait for it and use its result.
+        :param connection_string: connection string
+        :param sql: SQL query
+        :param run: function without arguments that runs the query and returns (columns, rows)
+        :return: tuple of (columns, rows)
+        """
+        key = self.get_key(connection_string, sql)
+        with self._lock:
+            (key_lock, users) = self._key_locks.get(key, (None, 0))
+            key_lock = key_lock or threading.Lock()
+            self._key_locks[key] = (key_lock, users + 1)
+        try:
+            with key_lock:
+                result = self.get(key)
+                if result is not None:
+                    logging.info("using cached result of query {}".format(key[:12]))
+                    return result
+                columns, rows = run()
+                self.put(key, columns, rows)
+                return columns, rows
+        finally:
+            with self._lock:  # the lock of a key is dropped when no thread uses it
+                (key_lock, users) = self._key_locks[key]
+                if users == 1:
+                    del self._key_locks[key]
+                else:
+                    self._key_locks[key] = (key_lock, users - 1)
+
+    def get(self, key):
+        """
+        Get a result that has not expired, from memory or from the spill directory
+        :param key: cache key
+        :return: tuple of (columns, rows), or None if the key is not cached
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+            from_disk = entry is None
+            entry = entry or self._spilling.get(key)
+        if entry is None:
+            entry = self._load(key)
+            if entry is None:
+                return None
+        (created, columns, rows) = entry
+        if time.time() - created > self.ttl:
+            self._remove(key)
+            return None
+        if from_disk:
+            self._store(key, entry)  # used again, so it moves back to memory
+        return columns, rows
+
+    def put(self, key, columns, rows):
+        """
+        Add a result to the cache
+        :param key: cache key
+        :param columns: list of column names
+        :param rows: list of rows
+        :return: None
+        """
+        entry = (time.time(), columns, rows)
+        self._store(key, entry)
+        if not self._temporary_dir:
+            self._spill(key, entry)
+
+    def clear(self):
+        """
+        Remove every result.  A temporary spill directory is deleted.
+        :return: None
+        """
+        with self._lock:
+            self._memory.clear()
+            self._rows = 0
+            if self.spill_dir is not None and self._temporary_dir:
+                shutil.rmtree(self.spill_dir, ignore_errors=True)
+                self.spill_dir = None
+
+    def _store(self, key, entry):
+        """
+        Keep an entry in memory and spill the least recently used entries while there are too many rows.  The entries
+        are written after the lock is released and are found in _spilling until then.
+        """
+        spilled = []
+        with self._lock:
+            if key in self._memory:
+                self._rows -= len(self._memory.pop(key)[2])
+            self._memory[key] = entry
+            self._rows += len(entry[2])
+            while self._rows > self.max_rows and self._memory:
+                (old_key, old_entry) = self._memory.popitem(last=False)
+                self._rows -= len(old_entry[2])
+                self._spilling[old_key] = old_entry
+                spilled.append((old_key, old_entry))
+        for (old_key, old_entry) in spilled:
+            try:
+                if self._temporary_dir or not os.path.exists(self._spill_path(old_key)):  # else saved by put
+                    self._spill(old_key, old_entry)
+            finally:
+                with self._lock:
+                    if self._spilling.get(old_key) is old_entry:
+                        del self._spilling[old_key]
+
+    def _spill(self, key, entry):
+        """
+        Write an entry to the spill directory.  Called without the lock, so other threads can use the cache while a
+        large result is written.  The file only replaces the file of the key when it is complete.
+        """
+        with self._lock:
+            if self.spill_dir is None:
+                self.spill_dir = tempfile.mkdtemp(prefix="xl_diff_cache_")
+            spill_dir = self.spill_dir
+        (created, columns, rows) = entry
+        temporary_path = None
+        try:
+            os.makedirs(spill_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=spill_dir, prefix=key[:12], suffix=".tmp",
+                                             delete=False) as f:
+                temporary_path = f.name
+                json.dump({"created": created, "columns": columns, "rows": rows}, f, default=encode_value)
+            os.replace(temporary_path, os.path.join(spill_dir, key + ".json"))
+            logging.info("spilled cached result {} to disk".format(key[:12]))
+        except OSError as e:  # e.g. the temporary directory was removed by clear
+            logging.warning("could not save cached result {}: {}".format(key[:12], e))
+        finally:
+            if temporary_path is not None and os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def _load(self, key):
+        """
+        Read an entry from the spill directory.  Files in a temporary directory are removed, as the entry moves back
+        to memory.  A file that can not be read is removed, so the query is run again.
+        :return: (created, columns, rows), or None if there is no file
+        """
+        with self._lock:
+            spill_dir = self.spill_dir
+        if spill_dir is None:
+            return None
+        path = os.path.join(spill_dir, key + ".json")
+        try:
+            with open(path, encoding="utf-8") as f:
+                saved = json.load(f, object_hook=decode_value)
+            entry = (saved["created"], saved["columns"], saved["rows"])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("cached result {} could not be read and is not used: {}".format(key[:12], e))
+            entry = None
+        if entry is None or self._temporary_dir:
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # e.g. removed by another thread
+        return entry
+
+    def _remove(self, key):
+        """
+        Remove an expired entry from memory and disk
+        """
+        with self._lock:
+            if key in self._memory:
+                self._rows -= len(self._memory.pop(key)[2])
+            if self.spill_dir is not None and os.path.exists(self._spill_path(key)):
+                os.remove(self._spill_path(key))
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, key + ".json")
@@ -0,0 +1,82 @@
+"""
+This module contains a compact alignment result for sorted and aligned comparisons.
+
+sort_values and align_rows line up the rows of two sheets as a list of ValueNode tuples, one per key.  Each tuple holds
+two boxed row numbers and the key values, which costs well over 100 bytes per row.  A RowMap stores the same alignment
+in two typed arrays of row numbers, 4 bytes per row and side, with 0 for a missing row (rows are 1-based, so 0 is
+never a real row).  Key values are only kept if they are asked for.
+
+A RowMap can be used wherever a list of ValueNode tuples is read: iterating or indexing it builds the tuples on the fly.
+make_sorted_sheet and compare_sheet read its arrays directly.
+"""
+from array import array
+from itertools import repeat
+
+MISSING_ROW = 0  # row number stored for the missing side of an unmatched row
+ROW_TYPECODE = "I"  # unsigned int, 4 bytes on the platforms Python supports
+
+
+class RowMap():
+    """
+    Left and right row numbers of aligned rows, stored in typed arrays
+    """
+
+    def __init__(self, keep_keys=False):
+        """
+        :param keep_keys: if true, the key value of each row is stored as well
+        """
+        self.left_rows = array(ROW_TYPECODE)
+        self.right_rows = array(ROW_TYPECODE)
+        self.keys = [] if keep_keys else None
+
+    @classmethod
+    def from_nodes(cls, nodes, keep_keys=False):
+        """
+        Build a row map from ValueNode tuples, e.g. the result of sort_values
+        :param nodes: iterable of ValueNode tuples
+        :param keep_keys: if true, the values of the nodes are stored as keys
+        :return: RowMap object
+        """
+        row_map = cls(keep_keys)
+        for node in nodes:
+            row_map.append(node.left_row, node.right_row, node.value)
+        return row_map
+
+    def append(self, left_row, right_row, key=None):
+        """
+        Add an aligned row
+        :param left_row: 1-based left row number, or None if the row is only on the right
+        :param right_row: 1-based right row number, or None if the row is only on the left
+        :param key: key value of the row.  Ignored unless keys are kept.
+        :return: None
+        """
+        self.left_rows.append(MISSING_ROW if left_row is None else left_row)
+        self.right_rows.append(MISSING_ROW if right_row is None else right_row)
+        if self.keys is not None:
+            self.keys.append(key)
+
+    def side(self, left_or_right):
+        """
+        Get the row numbers of one side
+        :param left_or_right: "left" or "right"
+        :return: array of row numbers, MISSING_ROW where the side has no row
+        """
+        return self.left_rows if left_or_right == "left" else self.right_rows
+
+    def __len__(self):
+        return len(self.left_rows)
+
+    def __getitem__(self, n):
+        from .compare import ValueNode  # compare imports this module
+
+        if isinstance(n, slice):
+            return [self[i] for i in range(*n.indices(len(self)))]
+        (left_row, right_row) = (self.left_rows[n], self.right_rows[n])
+        return ValueNode(left_row or None, right_row or None, None if self.keys is None else self.keys[n])
+
+    def __iter__(self):
+        from .compare import ValueNode  # compare imports this module
+
+        keys = self.keys if self.keys is not None else repeat(None)
+        for (left_row, right_row, key) in zip(self.left_rows, self.right_rows, keys):
+            yield ValueNode(left_row or None, right_row or None, key)
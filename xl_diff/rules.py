@@ -0,0 +1,161 @@
+"""
+This module contains comparison rules for single columns.
+
+By default every column is compared with value_difference and the global threshold.  A rule changes how one column
+is compared:
+
+    abs:0.01        numbers are the same if they differ by at most 0.01
+    rel:0.001       numbers are the same if they differ by at most 0.1% of the larger value
+    nocase          text is compared without case
+    trim            text is compared without leading, trailing and repeated white space
+    nocase+trim     options can be combined with +
+    date:%d/%m/%Y   dates are the same only if equal.  Text dates are tried with this format first.
+    ignore          the column is not compared
+
+Dates are compared by every rule, with their difference shown as a time span.  The format of a column's text dates is
+found on its first value and tried first for the values after it, so each comparator parses dates of its own column.
+An abs tolerance applies to dates in days, e.g. abs:1 accepts dates up to a day apart.
+
+Rules are compiled once per sheet into one comparator function per column, so the comparison loop calls the function
+of its column without checking the rule of every cell.  A comparator takes the left and right values and returns a
+tuple of (difference value, True if the values count as the same).
+"""
+import re
+from datetime import timedelta
+
+RULE_SEPARATOR = ";"  # separates rules in a single text field, e.g. a column of the job file
+TEXT_OPTIONS = ("nocase", "trim")
+IGNORED = "Ignored"  # difference value of ignored columns
+
+
+def parse_rules(column_rules):
+    """
+    Parse a list of "column=rule" strings, e.g. from the command line, into a rules dictionary.  Numeric columns are
+    1-based column indexes.  Other columns are header names.  Each rule is checked, so errors show up before the
+    comparison starts.
+    :param column_rules: list of strings such as ["1=ignore", "Amount=abs:0.01"], or a single string with rules
+                        separated by semicolons
+    :return: dictionary that maps a column to a rule
+    """
+    if isinstance(column_rules, str):
+        column_rules = [r for r in column_rules.split(RULE_SEPARATOR) if r.strip()]
+    rules = {}
+    for item in column_rules or []:
+        (column, separator, rule) = item.partition("=")
+        if not separator:
+            raise ValueError("column rule '{}' should look like column=rule".format(item))
+        column = column.strip()
+        (kind, separator, argument) = rule.strip().partition(":")
+        rule = kind.lower() + separator + argument  # arguments such as date formats keep their case
+        make_comparator(rule, 0.001)  # raises ValueError for unknown rules
+        rules[int(column) if column.isdigit() else column] = rule
+    return rules
+
+
+def make_comparator(rule, threshold):
+    """
+    Build the comparator function of a rule
+    :param rule: rule text such as "abs:0.01", or None for the default comparison
+    :param threshold: numerical differences below this amount are considered identical when the rule has no tolerance
+    :return: function that takes left and right values and returns (difference value, same)
+    """
+    from .compare import value_difference  # compare imports this module
+    from .convert import make_date_parser
+
+    (kind, separator, argument) = (rule or "").partition(":")
+    parse_date = make_date_parser(argument if kind == "date" and separator else None)
+    if kind in ("", "abs"):
+        tolerance = float(argument) if separator else threshold
+        date_tolerance = timedelta(days=tolerance if separator else 0)  # dates are exact without an abs rule
+
+        def compare(left, right):
+            difference = value_difference(left, right, parse_date)
+            if isinstance(difference, str):
+                return difference, difference == "Same"
+            if isinstance(difference, timedelta):
+                return difference, abs(difference) <= date_tolerance
+            return difference, abs(difference) <= tolerance
+        return compare
+
+    if kind == "date":
+        def compare(left, right):
+            difference = value_difference(left, right, parse_date)
+            if isinstance(difference, str):
+                return difference, difference == "Same"
+            if isinstance(difference, timedelta):
+                return difference, not difference
+            return difference, abs(difference) <= threshold
+        return compare
+
+    if kind == "rel":
+        if not separator:
+            raise ValueError("relative rule '{}' should look like rel:0.001".format(rule))
+        tolerance = float(argument)
+
+        def compare(left, right):
+            difference = value_difference(left, right, parse_date)
+            if isinstance(difference, str):
+                return difference, difference == "Same"
+            if isinstance(difference, timedelta):
+                return difference, not difference
+            return difference, abs(difference) <= tolerance * max(abs(float(left)), abs(float(right)))
+        return compare
+
+    if kind == "ignore":
+        return lambda left, right: (IGNORED, True)
+
+    options = kind.split("+")
+    if any(o not in TEXT_OPTIONS for o in options):
+        raise ValueError("column rule '{}' is not abs:<number>, rel:<number>, date:<format>, ignore or a combination "
+                         "of {}".format(rule, "+".join(TEXT_OPTIONS)))
+    normalize = get_text_normalizer("nocase" in options, "trim" in options)
+
+    def compare(left, right):
+        difference = value_difference(normalize(left), normalize(right), parse_date)
+        if isinstance(difference, str):
+            return difference, difference == "Same"
+        if isinstance(difference, timedelta):
+            return difference, not difference
+        return difference, abs(difference) <= threshold
+    return compare
+
+
+def get_text_normalizer(ignore_case, ignore_space):
+    """
+    Build a function that normalizes text values.  Other values are returned unchanged.
+    :param ignore_case: if true, text is folded to lower case
+    :param ignore_space: if true, leading and trailing white space is removed and repeated white space is collapsed
+    :return: function that takes a value and returns the normalized value
+    """
+    if ignore_case and ignore_space:
+        return lambda v: re.sub(r"\s+", " ", v).strip().casefold() if isinstance(v, str) else v
+    if ignore_case:
+        return lambda v: v.casefold() if isinstance(v, str) else v
+    if ignore_space:
+        return lambda v: re.sub(r"\s+", " ", v).strip() if isinstance(v, str) else v
+    return lambda v: v
+
+
+def compile_rules(rules, header, threshold, column_count, has_header=True):
+    """
+    Compile the rules of a sheet into one comparator per column.  Columns without a rule use the default comparison
+    with the threshold.
+    :param rules: dictionary that maps a 1-based column index or a header name to a rule.  May be None.
+    :param header: list of header values of the sheet, used to find columns by name
+    :param threshold: numerical differences below this amount are considered identical
+    :param column_count: number of columns in the sheet
+    :param has_header: if true, rules may name columns by header
+    :return: list of comparator functions, one per column
+    """
+    comparators = [make_comparator(None, threshold) for _ in range(column_count)]  # each column finds its date format
+    names = [str(h) for h in header] if has_header else []
+    for (column, rule) in (rules or {}).items():
+        if isinstance(column, int):
+            index = column - 1
+        elif column in names:
+            index = names.index(column)
+        else:
+            raise ValueError("column {} in comparison rules was not found".format(column))
+        if 0 <= index < column_count:
+            comparators[index] = make_comparator(rule, threshold)
+    return comparators
@@ -0,0 +1,90 @@
+"""
+This module contains row sampling for quick approximate comparisons.
+
+A sample is deterministic, so running the same comparison twice compares the same rows.  Rows are either picked by a
+hash of their key columns, so the left and right files pick the same keys and sorted comparisons still line up, or by
+position at a fixed interval.  The summary of a sampled comparison estimates the difference rate of each column with a
+confidence interval.
+"""
+import zlib
+
+from .validators import is_number
+
+SAMPLE_METHODS = ("key", "fraction")
+HASH_RANGE = 2 ** 32  # crc32 values are in range(0, HASH_RANGE)
+
+
+def key_text(values):
+    """
+    Turn key values into text that is the same on both sides, e.g. for 1, 1.0 and "1"
+    :param values: list of key values
+    :return: text
+    """
+    return "\t".join(repr(float(v)) if is_number(v) else str(v) for v in values)
+
+
+def is_key_sampled(values, fraction):
+    """
+    Check if a row is in the sample based on a hash of its key values
+    :param values: list of key values
+    :param fraction: share of keys to sample, between 0 and 1
+    :return: True if the row is in the sample
+    """
+    return zlib.crc32(key_text(values).encode("utf-8")) < fraction * HASH_RANGE
+
+
+def is_position_sampled(position, fraction):
+    """
+    Check if a row is in the sample based on its position.  Picks one row in every 1 / fraction rows.
+    :param position: 0-based position of the row among the data rows
+    :param fraction: share of rows to sample, between 0 and 1
+    :return: True if the row is in the sample
+    """
+    return int((position + 1) * fraction) > int(position * fraction)
+
+
+def get_sample_method(fraction, method=None, sort_column=None):
+    """
+    Check the sampling options of a comparison and choose the sample method if none was given
+    :param fraction: share of rows to sample, between 0 and 1
+    :param method: "key", "fraction" or None.  If None, rows are sampled by key if there is a sort column, otherwise by
+                    position.
+    :param sort_column: numerical index of column, or list of such indices
+    :return: sample method
+    """
+    method = method or ("key" if sort_column is not None else "fraction")
+    if method not in SAMPLE_METHODS:
+        raise ValueError("sample method must be one of {}".format(SAMPLE_METHODS))
+    if not 0 < fraction <= 1:
+        raise ValueError("sample fraction must be greater than 0 and at most 1")
+    if method == "key" and sort_column is None:
+        raise ValueError("sampling by key needs a sort column")
+    return method
+
+
+def sample_sheet(sheet, fraction, method="key", sort_column=None, has_header=True):
+    """
+    Copy the sampled rows of a sheet to a new sheet with the same title.  The header row is always kept.
+    :param sheet: openpyxl worksheet object
+    :param fraction: share of rows to sample, between 0 and 1
+    :param method: "key" to sample by a hash of the sort columns, "fraction" to sample by position
+    :param sort_column: numerical index of column, or list of such indices.  Required when method is "key".
+    :param has_header: if true, the first row is the header
+    :return: new openpyxl worksheet object in a separate workbook
+    """
+    from .helper_excel import get_empty_workbook  # loads openpyxl, which the command line modules import lazily
+
+    get_sample_method(fraction, method, sort_column)
+    columns = sort_column if isinstance(sort_column, list) else [sort_column]
+    new_sheet = get_empty_workbook().create_sheet(sheet.title)
+    for (n, row) in enumerate(sheet.iter_rows(values_only=True)):
+        if has_header and n == 0:
+            new_sheet.append(row)
+            continue
+        if method == "key":
+            sampled = is_key_sampled([row[c - 1] if c <= len(row) else None for c in columns], fraction)
+        else:
+            sampled = is_position_sampled(n - 1 if has_header else n, fraction)
+        if sampled:
+            new_sheet.append(row)
+    return new_sheet
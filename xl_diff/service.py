@@ -0,0 +1,326 @@
+"""
+This module contains a long-lived comparison service, so schedulers that run many comparisons a day do not pay for
+interpreter start, imports and ODBC driver load on every run.
+
+The service listens on localhost (or a Unix socket) and accepts jobs as JSON: a job type and the keyword arguments of
+the library function that runs it.  Jobs run in threads of the service process, so imports stay warm, ODBC connections
+are reused from the driver manager's pool, and query results are shared between jobs through one ResultCache.  The log
+messages of a job are streamed back to the client as lines of JSON while it runs, followed by a last line with the
+result or the error.
+
+Requests:
+    POST /jobs       {"type": "compare", "args": {"left_path": ..., "right_path": ..., "output_path": ...}}
+    GET  /status     number of running jobs
+    POST /shutdown   stop the service
+
+Only the user who started the service may use it.  On start, the service writes a random token to a file only that
+user can read, and every request must send it in the X-Service-Token header.  Requests must also name localhost in
+the Host header (so a web page cannot reach the service through DNS rebinding), and POST requests must have the
+application/json content type (so a web page cannot send a job with a plain form).  Only the job arguments listed in
+JOB_ARGUMENTS are accepted: output files are never opened, and the service cache cannot be replaced.  A Unix socket
+is only accessible to the user who started the service.
+"""
+import hmac
+import json
+import logging
+import os
+import queue
+import secrets
+import socketserver
+import stat
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .compare import compare_files
+from .multiway import compare_files_multi
+from .result_cache import ResultCache
+from .rules import parse_rules
+from .sql_compare import run_sql_comparison
+from .sql_compare_file import process_file
+from .summary import write_summary_file
+
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+TOKEN_FILE = os.path.join(os.path.expanduser("~"), ".xl_diff_service_token")
+TOKEN_HEADER = "X-Service-Token"
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "[::1]")  # accepted in the Host header, with or without a port
+MAX_JOB_SIZE = 1024 * 1024  # bytes of JSON accepted for one job
+END_OF_JOB = object()
+
+
+def run_compare(args, cache):
+    if "rules" in args:
+        args["rules"] = parse_rules(args["rules"])
+    return compare_files(**args)
+
+
+def run_compare_multi(args, cache):
+    if "rules" in args:
+        args["rules"] = parse_rules(args["rules"])
+    return compare_files_multi(**args)
+
+
+def run_summary(args, cache):
+    return write_summary_file(**args)
+
+
+def run_sql_compare(args, cache):
+    if "rules" in args:
+        args["rules"] = parse_rules(args["rules"])
+    return run_sql_comparison(cache=cache, **args)
+
+
+def run_sql_compare_file(args, cache):
+    return process_file(cache=cache, allow_open=False, **args)
+
+
+JOB_TYPES = {"compare": run_compare, "compare_multi": run_compare_multi, "summary": run_summary,
+             "sql_compare": run_sql_compare, "sql_compare_file": run_sql_compare_file}
+JOB_ARGUMENTS = {  # keyword arguments a client may send for each job type
+    "compare": {"left_path", "right_path", "output_path", "threshold", "sort_column", "compare_type", "has_header",
+                "sheet_matching", "add_summary", "csv_schema", "memory_map", "sample_fraction", "sample_method",
+                "rules", "workers", "column_matching", "work_dir", "resume", "compact"},
+    "compare_multi": {"paths", "output_path", "labels", "threshold", "sort_column", "compare_type", "has_header",
+                      "sheet_matching", "add_summary", "csv_schema", "rules"},
+    "summary": {"input_path", "output_path", "sheets_per_comparison"},
+    "sql_compare": {"left_connection_string", "right_connection_string", "output_path", "query", "query_right",
+                    "left_file_path", "right_file_path", "threshold", "sort_column", "compare_type", "has_header",
+                    "sheet_matching", "add_summary", "multithreaded", "timeout", "pipelined", "pushdown", "reconcile",
+                    "hash_expression", "sample_fraction", "sample_method", "rules"},
+    "sql_compare_file": {"has_header_flag", "input_file", "multithreaded", "compare_only", "asynchronous", "timeout",
+                         "max_concurrent", "work_dir", "resume"},
+}
+
+
+class JobLogHandler(logging.Handler):
+    """
+    Logging handler that sends the messages logged by the thread of one job to a queue
+    """
+
+    def __init__(self, thread_id, messages):
+        """
+        :param thread_id: identifier of the thread that runs the job
+        :param messages: queue that receives the log messages
+        """
+        super().__init__(logging.DEBUG)
+        self.thread_id = thread_id
+        self.messages = messages
+
+    def emit(self, record):
+        if record.thread == self.thread_id:
+            self.messages.put({"level": record.levelname, "message": self.format(record)})
+
+
+def run_job(job, cache, messages):
+    """
+    Run one job and send its log messages and result to a queue.  This function runs in its own thread.
+    :param job: dictionary with the job type and the keyword arguments of the job
+    :param cache: ResultCache object shared by every job, or None
+    :param messages: queue that receives the log messages, then a dictionary with the result, then END_OF_JOB
+    :return: None
+    """
+    handler = JobLogHandler(threading.get_ident(), messages)
+    root = logging.getLogger()
+    root.addHandler(handler)
+    try:
+        job_type = job.get("type")
+        if job_type not in JOB_TYPES:
+            raise ValueError("unknown job type '{}'.  expected one of {}".format(job_type, sorted(JOB_TYPES)))
+        args = dict(job.get("args") or {})
+        not_allowed = sorted(set(args) - JOB_ARGUMENTS[job_type])
+        if not_allowed:
+            raise ValueError("arguments {} are not accepted for {} jobs".format(not_allowed, job_type))
+        result = JOB_TYPES[job_type](args, cache)
+        messages.put({"status": "ok", "result": result if isinstance(result, (str, int, float, bool)) else None})
+    except Exception as e:
+        logging.exception("job failed")
+        messages.put({"status": "error", "error": "{}: {}".format(type(e).__name__, e)})
+    finally:
+        root.removeHandler(handler)
+        messages.put(END_OF_JOB)
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of one client connection.  The response of a job is streamed, so it has no content length
+    and ends when the connection closes.
+    """
+
+    def do_GET(self):
+        if not self.is_allowed():
+            return
+        if self.path != "/status":
+            self.send_error(404)
+            return
+        self.send_json({"status": "ok", "pid": os.getpid(), "running_jobs": self.server.running_jobs})
+
+    def do_POST(self):
+        if not self.is_allowed():
+            return
+        content_type = self.headers.get("Content-Type") or ""
+        if content_type.split(";")[0].strip().lower() != "application/json":
+            self.send_error(415, "content type must be application/json")
+            return
+        if self.path == "/shutdown":
+            self.send_json({"status": "ok"})
+            threading.Thread(target=self.server.shutdown).start()  # shutdown waits for serve_forever to return
+            return
+        if self.path != "/jobs":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_JOB_SIZE:
+            self.send_error(413)
+            return
+        try:
+            job = json.loads(self.rfile.read(length))
+        except ValueError as e:
+            self.send_error(400, "job is not valid JSON: {}".format(e))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        messages = queue.Queue()
+        self.server.job_started()
+        try:
+            threading.Thread(target=run_job, args=(job, self.server.cache, messages), daemon=True).start()
+            while True:
+                message = messages.get()
+                if message is END_OF_JOB:
+                    break
+                self.wfile.write(json.dumps(message, default=str).encode("utf-8") + b"\n")
+                self.wfile.flush()
+        finally:
+            self.server.job_finished()
+
+    def is_allowed(self):
+        """
+        Check the Host header and the token of a request, and send an error if they are not accepted
+        :return: True if the request can be handled
+        """
+        host = (self.headers.get("Host") or "").strip().lower()
+        if host.startswith("["):
+            host = host[:host.find("]") + 1]  # IPv6 address, e.g. [::1]:8765
+        else:
+            host = host.split(":")[0]
+        if host not in LOCAL_HOSTS:
+            self.send_error(403, "host must be localhost")
+            return False
+        token = self.headers.get(TOKEN_HEADER) or ""
+        if not hmac.compare_digest(token.encode("utf-8"), self.server.token.encode("utf-8")):
+            self.send_error(403, "missing or wrong service token")
+            return False
+        return True
+
+    def send_json(self, value):
+        body = json.dumps(value).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix socket"
+
+    def log_message(self, format, *args):
+        logging.debug("service: " + format % args)
+
+
+class ServiceMixIn():
+    """
+    State shared by the request handlers of a service
+    """
+
+    def setup_service(self, cache, token):
+        self.cache = cache
+        self.token = token
+        self.running_jobs = 0
+        self.lock = threading.Lock()
+
+    def job_started(self):
+        with self.lock:
+            self.running_jobs += 1
+
+    def job_finished(self):
+        with self.lock:
+            self.running_jobs -= 1
+
+
+class TcpService(ServiceMixIn, ThreadingHTTPServer):
+    pass
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class UnixService(ServiceMixIn, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+else:
+    UnixService = None
+
+
+def write_token_file(token_file):
+    """
+    Create a random token and save it to a file that only the current user can read or write
+    :param token_file: path of the token file.  An existing file is overwritten.
+    :return: token
+    """
+    token = secrets.token_urlsafe(32)
+    descriptor = os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "w") as f:
+        os.chmod(token_file, 0o600)  # the mode of os.open only applies to new files
+        f.write(token)
+    return token
+
+
+def make_service(host=SERVICE_HOST, port=SERVICE_PORT, socket_path=None, cache_ttl=None, cache_dir=None,
+                 token_file=TOKEN_FILE):
+    """
+    Create a comparison service.  Call serve_forever on the result to handle requests.
+    :param host: address to listen on.  Only local clients should be able to reach it.
+    :param port: port to listen on.  Port 0 picks a free port, see server_address of the result.
+    :param socket_path: if supplied, listen on this Unix socket instead of a port
+    :param cache_ttl: if supplied, query results are cached for this many seconds and shared by every job
+    :param cache_dir: directory for cached results (optional)
+    :param token_file: file the token of the service is written to.  Clients read the token from it.
+    :return: server object
+    """
+    if socket_path is not None:
+        if UnixService is None:
+            raise ValueError("Unix sockets are not supported on this platform.  Use a port instead.")
+        if os.path.lexists(socket_path):
+            if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+                raise ValueError("'{}' exists and is not a socket".format(socket_path))
+            os.remove(socket_path)  # left behind by a service that was killed
+        umask = os.umask(0o177)  # the socket is created with mode 0600
+        try:
+            service = UnixService(socket_path, ServiceRequestHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(socket_path, 0o600)
+    else:
+        service = TcpService((host, port), ServiceRequestHandler)
+    service.setup_service(ResultCache(cache_ttl, spill_dir=cache_dir) if cache_ttl else None,
+                          write_token_file(token_file))
+    return service
+
+
+def serve(host=SERVICE_HOST, port=SERVICE_PORT, socket_path=None, cache_ttl=None, cache_dir=None,
+          token_file=TOKEN_FILE):
+    """
+    Run a comparison service until it is shut down
+    :return: None
+    """
+    service = make_service(host, port, socket_path, cache_ttl, cache_dir, token_file)
+    logging.info("comparison service listening on {}, token saved to '{}'".format(
+        socket_path or "{}:{}".format(*service.server_address), token_file))
+    try:
+        service.serve_forever()
+    finally:
+        service.server_close()
+        if service.cache is not None:
+            service.cache.clear()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+        if os.path.exists(token_file):
+            os.remove(token_file)
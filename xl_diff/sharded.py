@@ -0,0 +1,181 @@
+"""
+This module contains a multi-process comparison of a single large sheet.
+
+The aligned rows of the left and right sheets (after sorting or positional matching) are split into contiguous shards
+of rows.  The values of each side are stored once in a shared memory block of typed arrays (see shared_values), and
+each worker process reads the rows of its shard from the blocks instead of receiving a copy through a pipe.  Workers
+compare their rows with the comparators of the columns and count the differences of each column, using the same flag
+that picks the fill of the difference cell.  The main process writes the output rows and merges the partial
+counts of the shards in order, so the summary does not need to read the output sheet again.
+
+The output sheet is the same as the one written by compare_sheet.
+"""
+import logging
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+
+from .rules import compile_rules
+from .shared_values import SharedValues
+from .summary import SummaryNode, merge_summary_nodes, get_column_name, DELTA_NUMBER_FORMAT
+
+SHARDED_MIN_ROWS = 100000  # sheets with fewer rows are compared in this process
+SHARDS_PER_WORKER = 2  # more shards than workers keeps every worker busy when some shards are slower
+
+
+def get_aligned_rows(left_sheet, right_sheet, column_map=None):
+    """
+    Read the values of two sheets as rows of the same length.  The shorter sheet is padded with empty rows.
+    :param left_sheet: first sheet to compare (left)
+    :param right_sheet: second sheet to compare (right)
+    :param column_map: list of (left column, right column) pairs.  If supplied, rows only have the values of these
+                        columns, in map order.
+    :return: tuple of (left rows, right rows, number of columns)
+    """
+    max_col = max(left_sheet.max_column, right_sheet.max_column)
+    max_row = max(left_sheet.max_row, right_sheet.max_row)
+
+    def read(sheet, columns):
+        rows = [tuple(row) + (None,) * (max_col - len(row)) for row in sheet.iter_rows(values_only=True)]
+        if columns is not None:
+            rows = [tuple(row[c - 1] for c in columns) for row in rows]
+        width = max_col if columns is None else len(columns)
+        return rows + [(None,) * width] * (max_row - len(rows))
+
+    if column_map is None:
+        return read(left_sheet, None), read(right_sheet, None), max_col
+    return (read(left_sheet, [l for (l, r) in column_map]), read(right_sheet, [r for (l, r) in column_map]),
+            len(column_map))
+
+
+def split_shards(row_count, shard_count):
+    """
+    Split rows into contiguous ranges of about the same size
+    :param row_count: number of rows
+    :param shard_count: number of shards
+    :return: list of (start, end) tuples of 0-based row positions, end excluded
+    """
+    size = max(1, math.ceil(row_count / max(1, shard_count)))
+    return [(start, min(start + size, row_count)) for start in range(0, row_count, size)]
+
+
+def compare_rows(left_rows, right_rows, threshold, rules, header, has_header, column_count):
+    """
+    Compare aligned rows and count the differences of each column.  A value counts as a difference if its comparator
+    does not find it the same, which is also what colors its difference cell.
+    :param left_rows: iterable of left rows
+    :param right_rows: iterable of right rows
+    :param threshold: numerical differences below this amount are considered identical
+    :param rules: dictionary that maps a column (1-based index or header name) to a comparison rule
+    :param header: list of header values, used to find rules by column name
+    :param has_header: if true, rules can name columns by header
+    :param column_count: number of columns
+    :return: tuple of (list of rows of (difference value, same) tuples, list of difference counts per column)
+    """
+    comparators = compile_rules(rules, header, threshold, column_count, has_header)
+    results = []
+    counts = [0] * column_count
+    for (left_values, right_values) in zip(left_rows, right_rows):
+        row = [compare(l, r) for (compare, l, r) in zip(comparators, left_values, right_values)]
+        for (n, (difference, same)) in enumerate(row):
+            counts[n] += not same
+        results.append(row)
+    return results, counts
+
+
+def compare_shard(left_name, right_name, row_count, start, end, threshold, rules, header, has_header, column_count):
+    """
+    Compare the rows of one shard.  This function runs in a worker process.
+    :param left_name: name of the shared memory block with the left values
+    :param right_name: name of the shared memory block with the right values
+    :param row_count: number of rows in each block
+    :param start: 0-based position of the first row of the shard
+    :param end: 0-based position after the last row of the shard
+    :return: same as compare_rows
+    """
+    left = SharedValues.attach(left_name, row_count, column_count)
+    right = SharedValues.attach(right_name, row_count, column_count)
+    try:
+        return compare_rows(left.rows(start, end), right.rows(start, end), threshold, rules, header, has_header,
+                            column_count)
+    finally:
+        left.close()  # the main process unlinks the blocks
+        right.close()
+
+
+def compare_sheet_sharded(left_sheet, right_sheet, output_sheet, threshold, rules=None, has_header=True, workers=None,
+                          min_rows=SHARDED_MIN_ROWS, include_all=False, column_map=None, checkpoint=None,
+                          checkpoint_name="sheet"):
+    """
+    Compare two sheets in shards of rows using several processes.  Writes the same output sheet as compare_sheet.
+    :param left_sheet: first sheet to compare (left)
+    :param right_sheet: second sheet to compare (right)
+    :param output_sheet: resulting sheet object
+    :param threshold: numerical differences below this amount are considered identical
+    :param rules: dictionary that maps a column (1-based index or header name) to a comparison rule
+    :param has_header: if true, rules can name columns by the values of the first row of the left sheet
+    :param workers: number of worker processes.  Defaults to the number of cores.
+    :param min_rows: sheets with fewer rows are compared in this process
+    :param include_all: if True, the summary also has columns without differences
+    :param column_map: list of (left column, right column) pairs to compare.  If not supplied, columns are compared by
+                        position.
+    :param checkpoint: Checkpoint object.  If supplied, each shard is saved as soon as it is compared, and shards saved
+                        by an earlier run are loaded instead of compared.
+    :param checkpoint_name: name of the sheet in the checkpoint
+    :return: list of SummaryNode objects with the differences of each column of the whole sheet
+    """
+    from .compare import SAME_FILL, DIFFERENT_FILL  # compare imports this module
+
+    (left_rows, right_rows, column_count) = get_aligned_rows(left_sheet, right_sheet, column_map)
+    header = list(left_rows[0]) if left_rows else []
+    workers = workers or os.cpu_count() or 1
+    shards = split_shards(len(left_rows), workers * SHARDS_PER_WORKER)
+
+    shard_names = ["{} rows {}-{}".format(checkpoint_name, start, end) for (start, end) in shards]
+    results = [checkpoint.load(name) if checkpoint is not None else None for name in shard_names]
+    pending = [n for (n, result) in enumerate(results) if result is None]
+
+    def finish(n, result):
+        results[n] = result
+        if checkpoint is not None:
+            checkpoint.save(shard_names[n], result)
+
+    if workers == 1 or len(left_rows) < min_rows:
+        for n in pending:
+            (start, end) = shards[n]
+            finish(n, compare_rows(left_rows[start:end], right_rows[start:end], threshold, rules, header, has_header,
+                                   column_count))
+    elif pending:
+        logging.info("comparing {} rows in {} shards".format(len(left_rows), len(pending)))
+        left = SharedValues.create(left_rows, column_count)
+        try:
+            right = SharedValues.create(right_rows, column_count)
+            try:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = {executor.submit(compare_shard, left.name, right.name, len(left_rows), shards[n][0],
+                                               shards[n][1], threshold, rules, header, has_header, column_count): n
+                               for n in pending}
+                    for f in as_completed(futures):  # saved as each shard finishes, so a failed run keeps the rest
+                        finish(futures[f], f.result())
+            finally:
+                right.close()
+        finally:
+            left.close()
+
+    partial_nodes = []
+    for ((start, end), (rows, counts)) in zip(shards, results):
+        for (n, (left_values, right_values, row)) in enumerate(zip(left_rows[start:end], right_rows[start:end], rows),
+                                                                start=start + 1):
+            values = []
+            for (l, r, (difference, same)) in zip(left_values, right_values, row):
+                values.extend((l, r, difference))
+            output_sheet.append(values)
+            for (column, (difference, same)) in enumerate(row):
+                cell = output_sheet.cell(row=n, column=column * 3 + 3)
+                cell.fill = SAME_FILL if same else DIFFERENT_FILL
+                if isinstance(difference, timedelta):
+                    cell.number_format = DELTA_NUMBER_FORMAT
+        partial_nodes.extend(SummaryNode(output_sheet.title, get_column_name(header, c, has_header), counts[c],
+                                         end - start, None, float(c + 1)) for c in range(0, column_count))
+    return merge_summary_nodes(partial_nodes, include_all)
@@ -0,0 +1,152 @@
+"""
+This module contains the values of a list of rows stored in a shared memory block, so that worker processes can read
+them without receiving a copy through a pipe.
+
+The values are stored row by row.  Each value has a kind (empty, integer, number, text or other) in an array of bytes
+and an 8-byte slot in a typed array: the integer or number itself, or the offset of its bytes in the data area of the
+block.  Text is stored as UTF-8 and other values (e.g. dates and booleans) are pickled, each with a length prefix.
+Worker processes attach to the block by name and decode the values of a row only when they read it, so a worker does
+not hold a private copy of its rows.
+"""
+import pickle
+import struct
+from multiprocessing import shared_memory
+
+EMPTY = 0
+INTEGER = 1
+NUMBER = 2
+TEXT = 3
+OTHER = 4
+LENGTH = struct.Struct("<I")  # length prefix of text and pickled values in the data area
+SLOT_SIZE = 8
+INTEGER_RANGE = (-2 ** 63, 2 ** 63 - 1)  # integers outside the range of a slot are pickled
+
+
+def get_layout(row_count, width):
+    """
+    Get the positions of the parts of a block
+    :param row_count: number of rows
+    :param width: number of values per row
+    :return: tuple of (start of slots, start of data area) in bytes
+    """
+    size = row_count * width
+    slots_start = (size + SLOT_SIZE - 1) // SLOT_SIZE * SLOT_SIZE  # slots are aligned for the typed views
+    return slots_start, slots_start + size * SLOT_SIZE
+
+
+class SharedValues():
+    """
+    Values of rows of the same width, stored in a shared memory block
+    """
+
+    def __init__(self, memory, row_count, width, owner=False):
+        """
+        :param memory: SharedMemory object holding the values
+        :param row_count: number of rows
+        :param width: number of values per row
+        :param owner: if true, close also unlinks the block
+        """
+        self.memory = memory
+        self.name = memory.name
+        self.row_count = row_count
+        self.width = width
+        self.owner = owner
+        (slots_start, data_start) = get_layout(row_count, width)
+        self.kinds = memory.buf[:row_count * width]
+        self.slots = memory.buf[slots_start:data_start]
+        self.integers = self.slots.cast("q")
+        self.numbers = self.slots.cast("d")
+        self.data = memory.buf[data_start:]
+
+    @classmethod
+    def create(cls, rows, width):
+        """
+        Store rows in a new shared memory block
+        :param rows: list of row tuples, each with width values
+        :param width: number of values per row
+        :return: SharedValues object that owns the block
+        """
+        size = len(rows) * width
+        kinds = bytearray(size)
+        slots = memoryview(bytearray(size * SLOT_SIZE))
+        (integers, numbers) = (slots.cast("q"), slots.cast("d"))
+        data = bytearray()
+        for (r, row) in enumerate(rows):
+            for (n, value) in enumerate(row, start=r * width):
+                value_type = type(value)
+                if value is None:
+                    continue  # kind is EMPTY
+                if value_type is int and INTEGER_RANGE[0] <= value <= INTEGER_RANGE[1]:
+                    (kinds[n], integers[n]) = (INTEGER, value)
+                elif value_type is float:
+                    (kinds[n], numbers[n]) = (NUMBER, value)
+                else:
+                    if value_type is str:
+                        (kinds[n], content) = (TEXT, value.encode("utf-8", "surrogatepass"))
+                    else:
+                        (kinds[n], content) = (OTHER, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+                    integers[n] = len(data)
+                    data += LENGTH.pack(len(content))
+                    data += content
+
+        (slots_start, data_start) = get_layout(len(rows), width)
+        memory = shared_memory.SharedMemory(create=True, size=max(1, data_start + len(data)))
+        memory.buf[:size] = kinds
+        memory.buf[slots_start:data_start] = slots
+        memory.buf[data_start:data_start + len(data)] = data
+        for view in (integers, numbers, slots):
+            view.release()
+        return cls(memory, len(rows), width, owner=True)
+
+    @classmethod
+    def attach(cls, name, row_count, width):
+        """
+        Open a block created by another process
+        :param name: name of the shared memory block
+        :param row_count: number of rows
+        :param width: number of values per row
+        :return: SharedValues object
+        """
+        return cls(shared_memory.SharedMemory(name=name), row_count, width)
+
+    def value(self, n):
+        """
+        Decode one value
+        :param n: 0-based position of the value, row by row
+        :return: value
+        """
+        kind = self.kinds[n]
+        if kind == EMPTY:
+            return None
+        if kind == INTEGER:
+            return self.integers[n]
+        if kind == NUMBER:
+            return self.numbers[n]
+        offset = self.integers[n] + LENGTH.size
+        content = self.data[offset:offset + LENGTH.unpack_from(self.data, self.integers[n])[0]]
+        try:
+            return str(content, "utf-8", "surrogatepass") if kind == TEXT else pickle.loads(content)
+        finally:
+            content.release()
+
+    def rows(self, start=0, end=None):
+        """
+        Read a range of rows
+        :param start: 0-based position of the first row
+        :param end: 0-based position after the last row.  Defaults to the number of rows.
+        :return: generator of row tuples
+        """
+        for row in range(start, self.row_count if end is None else end):
+            first = row * self.width
+            yield tuple(self.value(n) for n in range(first, first + self.width))
+
+    def close(self):
+        """
+        Release the views of the block and close it.  The owner also removes the block.
+        :return: None
+        """
+        for view in (self.integers, self.numbers, self.slots, self.kinds, self.data):
+            view.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
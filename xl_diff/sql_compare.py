@@ -4,12 +4,54 @@ This module contains logic for comparing output from two sql queries run on two
 2020-09-10  RL  Created
 
 """
+import asyncio
 import logging
-from concurrent.futures._base import as_completed
+import threading
+from functools import partial
+from concurrent.futures import FIRST_EXCEPTION, wait
 from concurrent.futures.thread import ThreadPoolExecutor
 
 from .sql_to_xl import SqlToXl
 from .compare import compare_files
+from .sql_pipeline import compare_queries_pipelined
+from .sql_reconcile import get_reconciled_queries, DEFAULT_HASH_EXPRESSION, BUCKETS, LEAF_ROWS
+from .sql_text import strip_query, parse_connection_string
+
+DEFAULT_LEFT_FILE_PATH = r".\left.xlsx"
+DEFAULT_RIGHT_FILE_PATH = r".\right.xlsx"
+QUERY_WORKERS = 8  # number of queries that can run at the same time in the shared executor
+_query_executor = None
+_query_executor_lock = threading.Lock()
+
+
+def get_query_executor():
+    """
+    Get the thread pool shared by every comparison to run queries.  pyodbc releases the GIL while a query runs, so
+    threads are enough to run many queries at the same time.  The pool is created on first use.
+    :return: ThreadPoolExecutor object
+    """
+    global _query_executor
+    with _query_executor_lock:
+        if _query_executor is None:
+            _query_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="sql_query")
+        return _query_executor
+
+
+def build_difference_query(query, query_other, sort_column=None):
+    """
+    Build a query that returns the rows of query that are not in query_other (set difference with EXCEPT).  Rows are
+    compared on every column, so the database only returns rows that are missing or changed.
+    :param query: SQL query whose rows are returned
+    :param query_other: SQL query whose rows are removed
+    :param sort_column: numerical index of column, or list of such indices, used to order the result
+    :return: SQL query
+    """
+    difference = "SELECT * FROM ({}) query_rows EXCEPT SELECT * FROM ({}) other_rows".format(strip_query(query),
+                                                                                          strip_query(query_other))
+    if sort_column is None:
+        return difference
+    columns = sort_column if isinstance(sort_column, list) else [sort_column]
+    return "SELECT * FROM ({}) difference_rows ORDER BY {}".format(difference, ", ".join(str(c) for c in columns))
 
 
 class SqlCompare():
@@ -18,7 +60,8 @@ class SqlCompare():
     """
 
     def __init__(self, left_connection_string, right_connection_string, left_file_path=None,
-                 right_file_path=None, left_sheet=None, right_sheet=None, multithreaded=False):
+                 right_file_path=None, left_sheet=None, right_sheet=None, multithreaded=False, timeout=None,
+                 cache=None):
         """
         :param left_connection_string: connection string for left data connection (pyodbc)
         :param right_connection_string: connection string for right data connection (pyodbc)
@@ -27,37 +70,53 @@ class SqlCompare():
         :param left_sheet: name of sheet in left output file
         :param right_sheet: name of sheet in right output file
         :param multithreaded: if True, run left and right sql simultaneously
+        :param timeout: query timeout in seconds for each query (optional)
+        :param cache: ResultCache object.  If supplied, a query already run on the same connection is not run again.
         """
         self.left_connection_string = left_connection_string
         self.right_connection_string = right_connection_string
-        self.left_file_path = r".\left.xlsx" if not left_file_path else left_file_path  # set default value
-        self.right_file_path = r".\right.xlsx" if not right_file_path else right_file_path  # set default value
+        self.left_file_path = DEFAULT_LEFT_FILE_PATH if not left_file_path else left_file_path  # set default value
+        self.right_file_path = DEFAULT_RIGHT_FILE_PATH if not right_file_path else right_file_path  # set default value
         self.left_sheet = "Sheet1" if not left_sheet else left_sheet  # set default value
         self.right_sheet = "Sheet1" if not right_sheet else right_sheet  # set default value
         self.multi_threaded = multithreaded  # if True, use threading to run left and right query simultaneously
+        self.timeout = timeout
+        self.cache = cache
 
     def generate_files_multithreaded(self, query, query_right=None):
+        """
+        Generate XLSX files from query from both left and right data connections at the same time, using the shared
+        query executor.  If one query fails, the other query is cancelled, and both are waited for before the error is
+        raised, so no query is still writing its file when this function returns.
+        :param query: SQL query to run on left connection.  This query is also run on right connection if a query_right is not supplied
+        :param query_right: SQL query to run on right connection
+        :return: tuple with left file path and right file path
+        """
         query_to_run_left = query
         query_to_run_right = query
         if query_right:  # if only one query is supplied, run the same query on both connections
             query_to_run_right = query_right  # if a second query is supplied for the right side, set it here.
 
-        left_stx = SqlToXl(self.left_connection_string)
-        right_stx = SqlToXl(self.right_connection_string)
+        left_stx = SqlToXl(self.left_connection_string, self.cache)
+        right_stx = SqlToXl(self.right_connection_string, self.cache)
 
         futures = []
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            futures.append(
-                executor.submit(left_stx.save_sql, *[query_to_run_left, self.left_file_path, self.left_sheet]))
-            futures.append(
-                executor.submit(right_stx.save_sql, *[query_to_run_right, self.right_file_path, self.right_sheet]))
-
-        for f in as_completed(futures):
-            if f.exception():
-                logging.error("recived Exception from thread {}".format(f.exception()))
-                raise f.exception()
-            else:
-                logging.info("recived result from thread {}".format(f.result()))
+        executor = get_query_executor()
+        futures.append(executor.submit(left_stx.save_sql, *[query_to_run_left, self.left_file_path, self.left_sheet,
+                                                            self.timeout]))
+        futures.append(executor.submit(right_stx.save_sql, *[query_to_run_right, self.right_file_path,
+                                                             self.right_sheet, self.timeout]))
+
+        done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+        failed = [f for f in done if f.exception()]
+        if failed:
+            logging.error("recived Exception from thread {}".format(failed[0].exception()))
+            for stx in (left_stx, right_stx):
+                stx.cancel()  # no effect on a query that finished
+            wait(futures)
+            raise failed[0].exception()
+        for f in futures:
+            logging.info("recived result from thread {}".format(f.result()))
 
         return self.left_file_path, self.right_file_path
 
@@ -73,23 +132,23 @@ class SqlCompare():
 
         query_to_run = query
         logging.info("Running SQL on left connection")
-        left_sx = SqlToXl(self.left_connection_string)
+        left_sx = SqlToXl(self.left_connection_string, self.cache)
 
-        left_sx.save_sql(query, self.left_file_path, self.left_sheet)
+        left_sx.save_sql(query, self.left_file_path, self.left_sheet, self.timeout)
 
         if query_right:  # if only one query is supplied, run the same query on both connections
             query_to_run = query_right  # if a second query is supplied for the right side, set it here.
 
         logging.info("Running SQL on right connection")
-        right_sx = SqlToXl(self.right_connection_string)
-        right_sx.save_sql(query_to_run, self.right_file_path, self.right_sheet)
+        right_sx = SqlToXl(self.right_connection_string, self.cache)
+        right_sx.save_sql(query_to_run, self.right_file_path, self.right_sheet, self.timeout)
 
         logging.info("Finished running SQL on both connections")
         return self.left_file_path, self.right_file_path
 
     def compare_query_results(self, output_path, query, query_right=None, threshold=0.001, open_on_finish=False,
                               sort_column=None, compare_type="default", has_header=True, sheet_matching="name",
-                              add_summary=True):
+                              add_summary=True, sample_fraction=None, sample_method="key", rules=None):
         """
         Generate XLSX files from query on left and right connections, then compare the results.
         :param add_summary: if true, add a sheet with count of differences by column
@@ -102,18 +161,157 @@ class SqlCompare():
         :param output_path: path to output file
         :param query: SQL query for left connection.  Also used for right connection if query_right is not supplied
         :param query_right: SQL for right connection (optional)
+        :param sample_fraction: if supplied, only compare this share of the fetched rows (between 0 and 1) and
+                                estimate the difference rates in the summary
+        :param sample_method: "key" to sample rows by a hash of the sort columns or "fraction" to sample by position
+        :param rules: dictionary that maps a column (1-based index or header name) to a comparison rule
         :return: path to output file
         """
         left_path, right_path = self.generate_files_from_query(query, query_right)
         compare_files(left_path, right_path, output_path, threshold, open_on_finish, sort_column, compare_type,
+                      has_header, sheet_matching, add_summary, sample_fraction=sample_fraction,
+                      sample_method=sample_method, rules=rules)
+        return output_path
+
+    def is_same_server(self):
+        """
+        Check if the left and right connection strings point to the same server and database
+        :return: True if both connection strings have the same settings
+        """
+        return parse_connection_string(self.left_connection_string) == \
+            parse_connection_string(self.right_connection_string)
+
+    def compare_query_results_pushdown(self, output_path, query, query_right=None, threshold=0.001,
+                                       open_on_finish=False, sort_column=None, has_header=True,
+                                       sheet_matching="name", add_summary=True):
+        """
+        Compute the difference of the queries on the server and only fetch rows that differ.  Both connections must
+        point to the same server.  The left file gets the left rows that are not in the right result and the right file
+        gets the right rows that are not in the left result.  The files are then compared sorted by sort_column, so a
+        changed row lines up with its other version and a missing row shows up on one side only.
+        Rows are compared as sets, so a row repeated a different number of times on each side is not reported.
+        See compare_query_results for the parameters.  sort_column is required.
+        :return: path to output file
+        """
+        if not self.is_same_server():
+            raise ValueError("server-side comparison needs both connection strings to point to the same server")
+        if sort_column is None:
+            raise ValueError("server-side comparison needs a sort column to line up changed rows")
+
+        query_right = query_right or query
+        left_query = build_difference_query(query, query_right, sort_column)
+        right_query = build_difference_query(query_right, query, sort_column)
+        logging.info("running difference queries on the server")
+        left_path, right_path = self.generate_files_from_query(left_query, right_query)
+        compare_files(left_path, right_path, output_path, threshold, open_on_finish, sort_column, "sorted",
+                      has_header, sheet_matching, add_summary)
+        return output_path
+
+    def compare_query_results_reconciled(self, output_path, query, query_right=None, threshold=0.001,
+                                         open_on_finish=False, sort_column=None, has_header=True,
+                                         sheet_matching="name", add_summary=True,
+                                         hash_expression=DEFAULT_HASH_EXPRESSION, buckets=BUCKETS,
+                                         leaf_rows=LEAF_ROWS):
+        """
+        Compare queries on different servers by first comparing row counts and hashes of key ranges on each server.
+        Only the rows of key ranges whose hashes differ are fetched and compared, sorted by sort_column.
+        The first sort column must hold integers.  See compare_query_results for the other parameters.
+        :param hash_expression: aggregate SQL expression that hashes the rows of a bucket, e.g. the SQL Server default
+                                CHECKSUM_AGG(BINARY_CHECKSUM(*)).  It must give the same value on both servers for the
+                                same rows.
+        :param buckets: number of buckets each differing key range is split into
+        :param leaf_rows: key ranges with this many rows or fewer are fetched instead of split again
+        :return: path to output file
+        """
+        if sort_column is None:
+            raise ValueError("hash reconciliation needs a sort column to split rows into key ranges")
+
+        left_query, right_query = get_reconciled_queries(SqlToXl(self.left_connection_string, self.cache),
+                                                         SqlToXl(self.right_connection_string, self.cache), query,
+                                                         query_right or query, sort_column, buckets, leaf_rows,
+                                                         hash_expression)
+        left_path, right_path = self.generate_files_from_query(left_query, right_query)
+        compare_files(left_path, right_path, output_path, threshold, open_on_finish, sort_column, "sorted",
                       has_header, sheet_matching, add_summary)
         return output_path
 
+    def compare_query_results_pipelined(self, output_path, query, query_right=None, threshold=0.001,
+                                        sort_column=None, compare_type="default", add_summary=True):
+        """
+        Run both queries and compare the rows while they are fetched, instead of saving both files first.  Rows are
+        matched by key when compare_type is sorted, which needs an ORDER BY clause at the end of both queries.
+        Otherwise rows are matched by position.
+        The left and right results are only saved as sheets of the output file.
+        :param output_path: path to output file
+        :param query: SQL query for left connection.  Also used for right connection if query_right is not supplied
+        :param query_right: SQL for right connection (optional)
+        :param threshold: maximum acceptable differrnces of numerical values
+        :param sort_column: numerical index of column, or list of such indices, used to match rows
+        :param compare_type: sorted or default (unsorted)
+        :param add_summary: if true, add a sheet with count of differences by column
+        :return: path to output file
+        """
+        return compare_queries_pipelined(SqlToXl(self.left_connection_string), SqlToXl(self.right_connection_string),
+                                         output_path, query, query_right, threshold, sort_column, compare_type,
+                                         add_summary, timeout=self.timeout)
+
+    async def generate_files_async(self, query, query_right=None):
+        """
+        Run the left and right queries in the shared query executor and save the results.  Each query is awaited
+        with the timeout.  If one query fails or times out, or this coroutine is cancelled, the cursors of both
+        queries are cancelled as well: cancelling a task only stops waiting for its thread, and the query would keep
+        running on the server and hold a worker of the executor until it finished.
+        :param query: SQL query to run on left connection.  This query is also run on right connection if a query_right is not supplied
+        :param query_right: SQL query to run on right connection
+        :return: tuple with left file path and right file path
+        """
+        loop = asyncio.get_running_loop()
+        executor = get_query_executor()
+        left_stx = SqlToXl(self.left_connection_string, self.cache)
+        right_stx = SqlToXl(self.right_connection_string, self.cache)
+
+        tasks = [asyncio.ensure_future(asyncio.wait_for(
+                     loop.run_in_executor(executor, left_stx.save_sql, query, self.left_file_path, self.left_sheet,
+                                          self.timeout), self.timeout)),
+                 asyncio.ensure_future(asyncio.wait_for(
+                     loop.run_in_executor(executor, right_stx.save_sql, query_right or query, self.right_file_path,
+                                          self.right_sheet, self.timeout), self.timeout))]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception():
+                    logging.error("query failed: {!r}".format(task.exception()))
+                    raise task.exception()
+        except BaseException:  # also cancel the queries if this coroutine is cancelled
+            for (task, stx) in zip(tasks, (left_stx, right_stx)):
+                task.cancel()
+                stx.cancel()  # no effect on a query that finished
+            raise
+        return self.left_file_path, self.right_file_path
+
+    async def compare_query_results_async(self, output_path, query, query_right=None, threshold=0.001,
+                                          open_on_finish=False, sort_column=None, compare_type="default",
+                                          has_header=True, sheet_matching="name", add_summary=True, rules=None):
+        """
+        Asynchronous version of compare_query_results.  Queries run in the shared query executor and the comparison
+        runs in the default executor of the event loop, so other comparisons can run their queries meanwhile.
+        See compare_query_results for the parameters.
+        :return: path to output file
+        """
+        left_path, right_path = await self.generate_files_async(query, query_right)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, partial(compare_files, rules=rules), left_path, right_path, output_path,
+                                   threshold, open_on_finish, sort_column, compare_type, has_header, sheet_matching,
+                                   add_summary)
+        return output_path
+
 
 def run_sql_comparison(left_connection_string, right_connection_string, output_path, query, query_right=None,
                        left_file_path=None, right_file_path=None, threshold=0.001, open_on_finish=False,
                        sort_column=None, compare_type="default", has_header=True, sheet_matching="name",
-                       add_summary=True, multithreaded=False):
+                       add_summary=True, multithreaded=False, timeout=None, pipelined=False, pushdown=False,
+                       reconcile=False, hash_expression=DEFAULT_HASH_EXPRESSION, cache=None, sample_fraction=None,
+                       sample_method="key", rules=None):
     """
     Instantiate SqlCompare and call to the compare function
     :param left_connection_string: connection string for left data connection (pyodbc)
@@ -131,9 +329,34 @@ def run_sql_comparison(left_connection_string, right_connection_string, output_p
     :param query: SQL query for left connection.  Also used for right connection if query_right is not supplied
     :param query_right: SQL for right connection (optional)
     :param multithreaded: If True, run queries in parallel
+    :param timeout: query timeout in seconds for each query (optional)
+    :param pipelined: If True, compare rows while they are fetched.  Results are not saved to the left and right files.
+    :param pushdown: If True, compute the difference on the server and only fetch rows that differ.  Both connection
+                        strings must point to the same server and sort_column is required.
+    :param reconcile: If True, compare hashes of key ranges on each server and only fetch ranges that differ.  The
+                        first sort column must hold integers.
+    :param hash_expression: aggregate SQL expression used to hash key ranges when reconcile is True
+    :param cache: ResultCache object shared by several comparisons (optional)
+    :param sample_fraction: if supplied, only compare this share of the rows and estimate the difference rates.  Not
+                        supported with pipelined, pushdown or reconcile.
+    :param sample_method: "key" to sample rows by a hash of the sort columns or "fraction" to sample by position
+    :param rules: dictionary that maps a column (1-based index or header name) to a comparison rule
     :return:
     """
+    if sample_fraction and (pipelined or pushdown or reconcile):
+        raise ValueError("sampling is not supported with pipelined, pushdown or reconcile comparisons")
     sc = SqlCompare(left_connection_string, right_connection_string, left_file_path, right_file_path,
-                    multithreaded=multithreaded)
+                    multithreaded=multithreaded, timeout=timeout, cache=cache)
+    if reconcile:
+        return sc.compare_query_results_reconciled(output_path, query, query_right, threshold, open_on_finish,
+                                                   sort_column, has_header, sheet_matching, add_summary,
+                                                   hash_expression)
+    if pushdown:
+        return sc.compare_query_results_pushdown(output_path, query, query_right, threshold, open_on_finish,
+                                                 sort_column, has_header, sheet_matching, add_summary)
+    if pipelined:
+        return sc.compare_query_results_pipelined(output_path, query, query_right, threshold, sort_column,
+                                                  compare_type, add_summary)
     return sc.compare_query_results(output_path, query, query_right, threshold, open_on_finish, sort_column,
-                                    compare_type, has_header, sheet_matching, add_summary)
+                                    compare_type, has_header, sheet_matching, add_summary, sample_fraction,
+                                    sample_method, rules)
@@ -2,21 +2,55 @@
 This module will process multiple sql comparisons by parsing a file of arguments.  For each line in the file,
 a separate comparison will be run
 """
+import asyncio
 import csv
 import logging
-from distutils.util import strtobool
+import os
 
-from .sql_compare import run_sql_comparison
+from .sql_compare import run_sql_comparison, SqlCompare, DEFAULT_LEFT_FILE_PATH, DEFAULT_RIGHT_FILE_PATH
 from .compare import compare_files
+from .checkpoint import Checkpoint, get_run_key
+from .result_cache import ResultCache
+from .rules import parse_rules
 
+RULES_HEADER = "rules"  # header of the optional rules column of a job file
+JOB_COLUMNS = 14  # columns of a job file line before the optional columns
 
-def process_file(has_header_flag, input_file, multithreaded=False, compare_only=False):
+
+def strtobool(value):
+    """
+    Convert a true or false value of a job file to 1 or 0, like the strtobool function of distutils, which is slow to
+    import and no longer part of Python
+    :param value: text such as "True", "yes", "0"
+    :return: 1 or 0
+    """
+    value = value.strip().lower()
+    if value in ("y", "yes", "t", "true", "on", "1"):
+        return 1
+    if value in ("n", "no", "f", "false", "off", "0"):
+        return 0
+    raise ValueError("invalid truth value '{}'".format(value))
+
+
+def read_job_file(has_header_flag, input_file):
+    """
+    Parse each line of the job file into the arguments of run_sql_comparison.  Column rules are read from the column
+    after the first 14 whose header is "Rules".  If the file has no header, the 15th column is used if it holds rules
+    and ignored otherwise, as extra columns used to be.
+    :param has_header_flag: if true, skip the first line of the file
+    :param input_file: path to tab-delimited job file
+    :return: list of tuples of parsed values.  The last value is the dictionary of column rules.
+    """
+    jobs = []
     count = 0
+    rules_column = None if has_header_flag else 0  # position of the rules column among the extra columns
     with open(input_file) as f:
         s = csv.reader(f, delimiter='\t')
         for row in s:
             count += 1
             if has_header_flag and count == 1:
+                extra_headers = [h.strip().lower() for h in row[JOB_COLUMNS:]]
+                rules_column = extra_headers.index(RULES_HEADER) if RULES_HEADER in extra_headers else None
                 continue
             else:
                 logging.info(row)  # log the parameters
@@ -24,25 +58,181 @@ def process_file(has_header_flag, input_file, multithreaded=False, compare_only=
                 # parse row into variables
                 (left_connection_string, right_connection_string, output_path, query, query_right, left_file,
                  right_file, threshold, open_on_finish, sort_column, compare_type, has_header, sheet_matching,
-                 add_summary, *_) = row  # underscore with star to capture extra columns
+                 add_summary, *extra) = row  # star to capture optional and extra columns
 
                 sort_column_list = [int(x) for x in sort_column.split(',')]  # parse sort columns into list object
                 logging.info("sort columns {}".format(sort_column_list))
+                rules = {}
+                if rules_column is not None and rules_column < len(extra):
+                    try:
+                        rules = parse_rules(extra[rules_column])  # e.g. "Amount=abs:0.01;Name=nocase"
+                    except ValueError as e:
+                        if has_header_flag:
+                            raise  # the column is named Rules, so it must hold rules
+                        logging.warning("column 15 of line {} is not a list of rules and is ignored: {}".format(
+                            count, e))
 
                 # store variables as a tuple
                 parsed_values = (left_connection_string, right_connection_string, output_path, query, query_right,
                                  left_file, right_file, float(threshold), bool(strtobool(open_on_finish)),
                                  sort_column_list, compare_type, bool(strtobool(has_header)),
-                                 bool(strtobool(sheet_matching)), bool(strtobool(add_summary)))
+                                 bool(strtobool(sheet_matching)), bool(strtobool(add_summary)), rules)
 
                 logging.info("parsed values: {}".format(parsed_values))  # log tuple
-                # run the comparison
-                if compare_only:
-                    compare_parameters = (left_file, right_file, output_path, float(threshold),
-                                          bool(strtobool(open_on_finish)),sort_column_list,compare_type,
-                                          bool(strtobool(has_header)), bool(strtobool(sheet_matching)),
-                                          bool(strtobool(add_summary)))
-                    logging.info("Compare parameters {}".format(compare_parameters))
-                    compare_files(*compare_parameters)
-                else:
-                    run_sql_comparison(*parsed_values, multithreaded=multithreaded)  # unpack tuple as arguments
+                jobs.append(parsed_values)
+    return jobs
+
+
+def process_file(has_header_flag, input_file, multithreaded=False, compare_only=False, asynchronous=False,
+                 timeout=None, max_concurrent=4, cache_ttl=None, cache_dir=None, work_dir=None, resume=False,
+                 cache=None, allow_open=True):
+    """
+    Run a comparison for each line of the job file
+    :param has_header_flag: if true, skip the first line of the file
+    :param input_file: path to tab-delimited job file
+    :param multithreaded: if true, run left and right query of each line at the same time
+    :param compare_only: if true, do not run sql.  Only compare the files named in each line.
+    :param asynchronous: if true, run the lines concurrently.  Queries of later lines run while earlier lines are
+                        compared.
+    :param timeout: query timeout in seconds for each query (optional)
+    :param max_concurrent: maximum number of lines processed at the same time when asynchronous is true
+    :param cache_ttl: if supplied, query results are cached for this many seconds, so a query repeated on the same
+                        connection (e.g. the same left query on every line) only runs once
+    :param cache_dir: directory for cached results.  Results saved there by an earlier run are used until they expire.
+                        If not supplied, results are only cached while the file is processed.
+    :param work_dir: if supplied, each finished line is saved to a checkpoint in this directory.  With compare_only,
+                        the sheets of each comparison are saved too.  The checkpoint is removed when every line is done.
+    :param resume: if true, lines finished by an earlier run of the same job file are skipped
+    :param cache: ResultCache object shared with other runs (optional).  If supplied, cache_ttl and cache_dir are not
+                        used and the cache is kept after the file is processed.
+    :param allow_open: if false, output files are not opened, whatever the Open on Finish column of a line says
+    :return: None
+    """
+    jobs = read_job_file(has_header_flag, input_file)
+    if not allow_open:
+        jobs = [job[:8] + (False,) + job[9:] for job in jobs]  # open on finish is the 9th value
+    own_cache = cache is None
+    if own_cache:
+        cache = ResultCache(cache_ttl, spill_dir=cache_dir) if cache_ttl and not compare_only else None
+    checkpoint = None
+    if work_dir is not None:
+        checkpoint = Checkpoint(work_dir, get_run_key([input_file], (has_header_flag, compare_only)), resume)
+    try:
+        run_jobs(jobs, multithreaded, compare_only, asynchronous, timeout, max_concurrent, cache, checkpoint,
+                 work_dir, resume)
+    finally:
+        if own_cache and cache is not None:
+            cache.clear()  # removes temporary files, results in cache_dir are kept
+    if checkpoint is not None:
+        checkpoint.clear()
+
+
+def run_jobs(jobs, multithreaded=False, compare_only=False, asynchronous=False, timeout=None, max_concurrent=4,
+             cache=None, checkpoint=None, work_dir=None, resume=False):
+    """
+    Run a comparison for each parsed line of the job file.  See process_file for the parameters.
+    :param jobs: list of tuples of parsed values from read_job_file
+    :param cache: ResultCache object shared by every line (optional)
+    :param checkpoint: Checkpoint object.  Lines saved in it are skipped, and each finished line is saved.
+    :return: None
+    """
+    if checkpoint is not None:
+        done = {n for n in range(0, len(jobs)) if checkpoint.load(job_name(n, jobs[n])) is not None}
+        jobs = [(n, j) for (n, j) in enumerate(jobs) if n not in done]
+        logging.info("{} lines already done".format(len(done)))
+    else:
+        jobs = list(enumerate(jobs))
+
+    if asynchronous and not compare_only:
+        asyncio.run(process_jobs_async([j for (n, j) in jobs], timeout, max_concurrent, cache=cache,
+                                       checkpoint=checkpoint, job_numbers=[n for (n, j) in jobs]))
+        return
+
+    for (n, (*parsed_values, rules)) in jobs:
+        # run the comparison
+        if compare_only:
+            (left_connection_string, right_connection_string, output_path, query, query_right, left_file,
+             right_file, *compare_values) = parsed_values
+            compare_parameters = (left_file, right_file, output_path, *compare_values)
+            logging.info("Compare parameters {}".format(compare_parameters))
+            compare_files(*compare_parameters, rules=rules, work_dir=work_dir, resume=resume)
+        else:
+            run_sql_comparison(*parsed_values, multithreaded=multithreaded, timeout=timeout,
+                               cache=cache, rules=rules)  # unpack tuple as arguments
+        if checkpoint is not None:
+            checkpoint.save(job_name(n, (*parsed_values, rules)), parsed_values[2])  # output path
+
+
+def job_name(job_number, parsed_values):
+    """
+    Get the checkpoint name of a line of the job file.  A changed line does not match its old checkpoint.
+    :param job_number: 0-based position of the line in the job file
+    :param parsed_values: tuple of parsed values from read_job_file
+    :return: name
+    """
+    return "job {} {!r}".format(job_number, parsed_values)
+
+
+def check_job_files(jobs, job_numbers=None):
+    """
+    Check that no two jobs save query results to the same file.  Jobs that run at the same time would overwrite each
+    other's results, e.g. lines that leave the left and right file columns empty and use the default paths.
+    :param jobs: list of tuples of parsed values from read_job_file
+    :param job_numbers: position of each job in the job file
+    :return: None
+    """
+    job_numbers = job_numbers if job_numbers is not None else range(0, len(jobs))
+    owners = {}
+    for (n, (_, _, _, _, _, left_file, right_file, *_)) in zip(job_numbers, jobs):
+        for path in (left_file or DEFAULT_LEFT_FILE_PATH, right_file or DEFAULT_RIGHT_FILE_PATH):
+            key = os.path.normcase(os.path.abspath(path))
+            if key in owners:
+                raise ValueError("jobs {} and {} both save query results to '{}'.  Set a different left and right file "
+                                 "on each line to run the lines asynchronously".format(owners[key] + 1, n + 1, path))
+            owners[key] = n
+
+
+async def process_jobs_async(jobs, timeout=None, max_concurrent=4, fail_fast=False, cache=None, checkpoint=None,
+                             job_numbers=None):
+    """
+    Run the comparison for each job concurrently.  At most max_concurrent jobs run at the same time.  Every job runs
+    its queries in the shared query executor, so a slow query only holds up its own job.
+    :param jobs: list of tuples of parsed values from read_job_file
+    :param timeout: query timeout in seconds for each query (optional)
+    :param max_concurrent: maximum number of jobs processed at the same time
+    :param fail_fast: if true, cancel the remaining jobs after the first failure
+    :param cache: ResultCache object shared by every job (optional).  Jobs running the same query wait for the first
+                    one to finish and use its result.
+    :param checkpoint: Checkpoint object.  Each finished job is saved in it.
+    :param job_numbers: position of each job in the job file, used to name the jobs in the checkpoint
+    :return: list of output paths
+    """
+    check_job_files(jobs, job_numbers)
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def run_job(job_number, parsed_values):
+        (left_connection_string, right_connection_string, output_path, query, query_right, left_file, right_file,
+         *compare_values, rules) = parsed_values
+        async with semaphore:
+            sc = SqlCompare(left_connection_string, right_connection_string, left_file, right_file, timeout=timeout,
+                            cache=cache)
+            result = await sc.compare_query_results_async(output_path, query, query_right, *compare_values,
+                                                          rules=rules)
+        if checkpoint is not None:
+            checkpoint.save(job_name(job_number, parsed_values), output_path)
+        return result
+
+    job_numbers = job_numbers if job_numbers is not None else range(0, len(jobs))
+    tasks = [asyncio.ensure_future(run_job(n, j)) for (n, j) in zip(job_numbers, jobs)]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION if fail_fast else asyncio.ALL_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()  # no effect on finished jobs
+
+    errors = [t.exception() for t in tasks if not t.cancelled() and t.exception()]
+    for e in errors:
+        logging.error("comparison failed: {!r}".format(e))
+    if errors:
+        raise errors[0]
+    return [t.result() for t in tasks]
@@ -0,0 +1,190 @@
+"""
+This module contains a pipelined comparison of two sql queries.
+
+Each query runs in its own producer thread, which fetches rows in batches and puts them on a bounded queue.  The
+comparer consumes both queues at the same time and writes the left, right and comparison sheets while rows are still
+arriving, so the total time is close to the time of the slowest query instead of the sum of both queries, the file
+saves and the comparison.
+
+Rows are matched by position.  A sorted comparison needs an ORDER BY clause on the outer query of both queries: rows
+then arrive in key order and are matched with a merge join on the sort columns instead.  The database must order the
+keys the same way Python does (e.g. numbers, or text in a binary collation); a warning is logged when keys arrive out
+of order.
+"""
+import logging
+import queue
+import threading
+from itertools import zip_longest
+
+from .compare import value_difference, apply_style, SHEETS_PER_COMPARISON
+from .helper_excel import get_empty_workbook
+from .summary import create_summary_worksheet, get_workbook_nodes
+from .backends import save_workbook
+from .sql_text import has_order_by
+from .merge import merge_rows
+
+BATCH_SIZE = 1000  # rows fetched from a cursor at a time
+QUEUE_SIZE = 8  # batches buffered per query before the producer waits for the comparer
+_END = object()  # marks the end of a queue
+
+def put(batch_queue, item, stop):
+    """
+    Put an item on a bounded queue, waiting while it is full.  Gives up when the stop event is set.
+    :param batch_queue: bounded queue
+    :param item: item to put
+    :param stop: threading.Event set when the comparer stops reading
+    :return: True if the item was put on the queue
+    """
+    while not stop.is_set():
+        try:
+            batch_queue.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def produce(stx, query, batch_queue, stop, batch_size=BATCH_SIZE, timeout=None):
+    """
+    Fetch the results of the query in batches and put them on the queue.  Runs in a producer thread.  Errors are put
+    on the queue so the comparer can raise them.
+    :param stx: SqlToXl object for the connection
+    :param query: SQL query
+    :param batch_queue: bounded queue.  Receives the column names, then batches of rows, then _END
+    :param stop: threading.Event set when the comparer stops reading, e.g. after the other query failed
+    :param batch_size: number of rows fetched at a time
+    :param timeout: query timeout in seconds
+    :return: None
+    """
+    try:
+        for item in stx.iter_batches(query, batch_size, timeout):
+            if not put(batch_queue, item, stop):
+                return  # closing the generator closes the connection
+    except Exception as e:
+        logging.error("query failed: {!r}".format(e))
+        put(batch_queue, e, stop)
+    put(batch_queue, _END, stop)
+
+
+def consume(batch_queue):
+    """
+    Get items from the queue until the end marker.  Errors from the producer are raised.
+    :param batch_queue: queue filled by produce
+    :return: generator of items
+    """
+    while True:
+        item = batch_queue.get()
+        if item is _END:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def compare_queries_pipelined(left_stx, right_stx, output_path, query, query_right=None, threshold=0.001,
+                              sort_column=None, compare_type="default", add_summary=True, batch_size=BATCH_SIZE,
+                              queue_size=QUEUE_SIZE, timeout=None):
+    """
+    Run both queries and compare the rows while they are fetched.  Writes an output file with the same sheets as
+    compare_files: left values, right values, comparison and (optionally) summary.
+    :param left_stx: SqlToXl object for the left connection
+    :param right_stx: SqlToXl object for the right connection
+    :param output_path: path to output file
+    :param query: SQL for the left connection.  Also used for the right connection if query_right is not supplied
+    :param query_right: SQL for the right connection (optional)
+    :param threshold: maximum acceptable differrnces of numerical values
+    :param sort_column: numerical index of column, or list of such indices, used to match rows
+    :param compare_type: sorted or default (unsorted).  Sorted needs a sort column and an ORDER BY on both queries.
+    :param add_summary: if true, add a sheet with count of differences by column
+    :param batch_size: number of rows fetched at a time
+    :param queue_size: number of batches buffered per query
+    :param timeout: query timeout in seconds
+    :return: path to output file
+    """
+    query_right = query_right or query
+    merge = compare_type == "sorted"
+    if merge and sort_column is None:
+        raise ValueError("a sort column is needed if compare type is sorted")
+    if merge and not (has_order_by(query) and has_order_by(query_right)):
+        raise ValueError("a sorted pipelined comparison needs an ORDER BY on the sort columns at the end of both " +
+                         "queries, otherwise rows can not be matched by key")
+    logging.info("pipelined comparison, rows matched by {}".format("key" if merge else "position"))
+
+    left_queue = queue.Queue(maxsize=queue_size)
+    right_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    producers = [threading.Thread(target=produce, args=(left_stx, query, left_queue, stop, batch_size, timeout),
+                                  daemon=True),
+                 threading.Thread(target=produce, args=(right_stx, query_right, right_queue, stop, batch_size,
+                                                        timeout), daemon=True)]
+    for p in producers:
+        p.start()
+    try:
+        output_wb = compare_batches(left_queue, right_queue, threshold, sort_column if merge else None)
+    finally:
+        stop.set()  # lets a producer blocked on a full queue finish if the comparison failed
+        for p in producers:
+            p.join()
+
+    if add_summary:
+        workbook_nodes = get_workbook_nodes(SHEETS_PER_COMPARISON, output_wb)
+        output_wb = create_summary_worksheet(workbook_nodes, output_wb)
+    save_workbook(output_wb, output_path)
+    return output_path
+
+
+def compare_batches(left_queue, right_queue, threshold, sort_column=None):
+    """
+    Compare the rows from both queues as they arrive and write them to a new workbook
+    :param left_queue: queue filled by the left producer
+    :param right_queue: queue filled by the right producer
+    :param threshold: maximum acceptable differrnces of numerical values
+    :param sort_column: if not None, rows are matched with a merge join on these columns.  Otherwise by position.
+    :return: openpyxl workbook object with left, right and comparison sheets
+    """
+    output_wb = get_empty_workbook()
+    left_sheet = output_wb.create_sheet("left")
+    right_sheet = output_wb.create_sheet("right")
+    output_sheet = output_wb.create_sheet("comparison")
+
+    left_items = consume(left_queue)
+    right_items = consume(right_queue)
+    left_columns = next(left_items)
+    right_columns = next(right_items)
+    width = max(len(left_columns), len(right_columns))
+    left_rows = (row for batch in left_items for row in batch)
+    right_rows = (row for batch in right_items for row in batch)
+    pairs = merge_rows(left_rows, right_rows, sort_column) if sort_column is not None \
+        else zip_longest(left_rows, right_rows)
+
+    output_row = 0
+    for (left_values, right_values) in _with_header(left_columns, right_columns, pairs):
+        output_row += 1
+        left_values = list(left_values) + [None] * (width - len(left_values)) if left_values is not None \
+            else [None] * width
+        right_values = list(right_values) + [None] * (width - len(right_values)) if right_values is not None \
+            else [None] * width
+        left_sheet.append(left_values)
+        right_sheet.append(right_values)
+        for (n, (l, r)) in enumerate(zip(left_values, right_values)):
+            output_column = n * 3 + 1
+            output_sheet.cell(row=output_row, column=output_column).value = l
+            output_sheet.cell(row=output_row, column=output_column + 1).value = r
+            diff_cell = output_sheet.cell(row=output_row, column=output_column + 2)
+            diff_cell.value = value_difference(l, r)
+            apply_style(diff_cell, threshold)
+
+    logging.info("compared {} rows".format(output_row))
+    return output_wb
+
+
+def _with_header(left_columns, right_columns, pairs):
+    """
+    Put the column names in front of the row pairs, so the header is compared like the first row of a file
+    :param left_columns: left column names
+    :param right_columns: right column names
+    :param pairs: iterator of (left row, right row) tuples
+    :return: generator of (left row, right row) tuples
+    """
+    yield left_columns, right_columns
+    yield from pairs
@@ -0,0 +1,181 @@
+"""
+This module contains a chunk-hash reconciliation of two sql queries run on different servers.
+
+Instead of fetching both full results, each server returns a row count and an aggregated hash for buckets of key
+values.  Buckets whose count and hash agree on both sides hold the same rows and are skipped.  Buckets that differ are
+split into smaller buckets until they hold few rows, and only the rows of those buckets are fetched and compared.
+
+The key is the first sort column and must hold integers.  Its name is read from each query, so the key column can have
+another name in the right query.  Rows with a NULL key fall in no range, so they are always fetched and compared.  The hash is any aggregate expression that gives the same
+value for the same set of rows on both servers.  The default uses CHECKSUM_AGG and BINARY_CHECKSUM from SQL Server.
+"""
+import logging
+
+from .sql_text import strip_query, quote_identifier
+
+DEFAULT_HASH_EXPRESSION = "CHECKSUM_AGG(BINARY_CHECKSUM(*))"  # SQL Server
+BUCKETS = 16  # number of buckets a key range is split into
+LEAF_ROWS = 1000  # buckets with this many rows or fewer are fetched instead of split again
+
+
+def get_column_names(stx, query):
+    """
+    Get the column names of a query without fetching rows
+    :param stx: SqlToXl object for the connection
+    :param query: SQL query
+    :return: list of column names
+    """
+    batches = stx.iter_batches("SELECT * FROM ({}) key_rows WHERE 1 = 0".format(strip_query(query)))
+    columns = next(batches)
+    batches.close()
+    return columns
+
+
+def get_key_range(stx, query, key):
+    """
+    Get the smallest and largest key of a query
+    :param stx: SqlToXl object for the connection
+    :param query: SQL query
+    :param key: name of the key column
+    :return: tuple of (min, max).  Both are None if the query has no rows.
+    """
+    rows = stx.get_query_results("SELECT MIN({0}), MAX({0}) FROM ({1}) key_rows".format(quote_identifier(key),
+                                                                                       strip_query(query)))
+    return rows[0][0], rows[0][1]
+
+
+def split_range(low, high, buckets):
+    """
+    Split an inclusive range of integer keys into buckets of about the same size.  Bucket b holds the keys k where
+    (k - low) * buckets / (high - low + 1) is b, using integer division as the bucket query does.
+    :param low: smallest key
+    :param high: largest key
+    :param buckets: number of buckets
+    :return: list of (low, high) tuples, one per bucket index.  Empty buckets are (None, None).
+    """
+    size = high - low + 1
+    ranges = []
+    for b in range(0, buckets):
+        first = low + -(-b * size // buckets)  # ceiling division
+        last = low + -(-(b + 1) * size // buckets) - 1
+        ranges.append((first, last) if first <= last else (None, None))
+    return ranges
+
+
+def get_bucket_hashes(stx, query, key, low, high, buckets, hash_expression):
+    """
+    Get the row count and hash of each bucket of a key range
+    :param stx: SqlToXl object for the connection
+    :param query: SQL query
+    :param key: name of the key column
+    :param low: smallest key of the range
+    :param high: largest key of the range
+    :param buckets: number of buckets
+    :param hash_expression: aggregate expression used to hash the rows of a bucket
+    :return: dictionary that maps bucket index to (count, hash)
+    """
+    key = quote_identifier(key)
+    bucket = "(({} - {}) * {} / {})".format(key, low, buckets, high - low + 1)  # integer division
+    sql = ("SELECT {0} AS bucket, COUNT(*) AS row_count, {1} AS row_hash FROM ({2}) key_rows "
+           "WHERE {3} BETWEEN {4} AND {5} GROUP BY {0}").format(bucket, hash_expression, strip_query(query), key, low,
+                                                                 high)
+    return {int(row[0]): (row[1], row[2]) for row in stx.get_query_results(sql)}
+
+
+def find_different_ranges(left_stx, right_stx, query, query_right, key, low, high, buckets=BUCKETS,
+                          leaf_rows=LEAF_ROWS, hash_expression=DEFAULT_HASH_EXPRESSION, key_right=None):
+    """
+    Find the key ranges whose rows differ between the two queries, by comparing bucket hashes and narrowing down the
+    buckets that differ
+    :param left_stx: SqlToXl object for the left connection
+    :param right_stx: SqlToXl object for the right connection
+    :param query: left SQL query
+    :param query_right: right SQL query
+    :param key: name of the key column of the left query
+    :param low: smallest key of the range
+    :param high: largest key of the range
+    :param buckets: number of buckets a range is split into
+    :param leaf_rows: ranges with this many rows or fewer on both sides are not split again
+    :param hash_expression: aggregate expression used to hash the rows of a bucket
+    :param key_right: name of the key column of the right query.  Defaults to key.
+    :return: list of (low, high) tuples, in key order
+    """
+    different = []
+    to_check = [(low, high)]
+    while to_check:
+        (range_low, range_high) = to_check.pop(0)
+        left_hashes = get_bucket_hashes(left_stx, query, key, range_low, range_high, buckets, hash_expression)
+        right_hashes = get_bucket_hashes(right_stx, query_right, key_right or key, range_low, range_high, buckets,
+                                         hash_expression)
+        for (b, (first, last)) in enumerate(split_range(range_low, range_high, buckets)):
+            left_bucket = left_hashes.get(b)
+            right_bucket = right_hashes.get(b)
+            if first is None or left_bucket == right_bucket:
+                continue
+            rows = max(left_bucket[0] if left_bucket else 0, right_bucket[0] if right_bucket else 0)
+            if rows <= leaf_rows or first == last:
+                different.append((first, last))
+            else:
+                to_check.append((first, last))
+        logging.info("checked keys {} to {}, {} ranges to fetch".format(range_low, range_high, len(different)))
+    return merge_ranges(sorted(different))
+
+
+def merge_ranges(ranges):
+    """
+    Merge sorted ranges that touch or overlap
+    :param ranges: sorted list of (low, high) tuples
+    :return: list of (low, high) tuples
+    """
+    merged = []
+    for (low, high) in ranges:
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(high, merged[-1][1]))
+        else:
+            merged.append((low, high))
+    return merged
+
+
+def build_range_query(query, key, ranges):
+    """
+    Build a query that returns the rows of the key ranges and the rows with a NULL key, ordered by key
+    :param query: SQL query
+    :param key: name of the key column
+    :param ranges: list of (low, high) tuples
+    :return: SQL query
+    """
+    key = quote_identifier(key)
+    condition = " OR ".join(["{} BETWEEN {} AND {}".format(key, low, high) for (low, high) in ranges] +
+                            ["{} IS NULL".format(key)])  # NULL keys are in no bucket, so they are always fetched
+    return "SELECT * FROM ({}) key_rows WHERE {} ORDER BY {}".format(strip_query(query), condition, key)
+
+
+def get_reconciled_queries(left_stx, right_stx, query, query_right, sort_column, buckets=BUCKETS,
+                           leaf_rows=LEAF_ROWS, hash_expression=DEFAULT_HASH_EXPRESSION):
+    """
+    Find the key ranges that differ and build the queries that fetch only those rows
+    :param left_stx: SqlToXl object for the left connection
+    :param right_stx: SqlToXl object for the right connection
+    :param query: left SQL query
+    :param query_right: right SQL query
+    :param sort_column: numerical index of column, or list of such indices.  The first column is the bucket key.
+    :param buckets: number of buckets a range is split into
+    :param leaf_rows: ranges with this many rows or fewer on both sides are fetched instead of split again
+    :param hash_expression: aggregate expression used to hash the rows of a bucket
+    :return: tuple of (left query, right query)
+    """
+    key_index = sort_column[0] if isinstance(sort_column, list) else sort_column
+    key = get_column_names(left_stx, query)[key_index - 1]
+    key_right = get_column_names(right_stx, query_right)[key_index - 1]
+
+    bounds = [v for v in get_key_range(left_stx, query, key) + get_key_range(right_stx, query_right, key_right)
+              if v is not None]
+    if any(not float(v).is_integer() for v in bounds):
+        raise ValueError("key column {} must hold integers to be split into ranges".format(key))
+
+    ranges = []
+    if bounds:
+        ranges = find_different_ranges(left_stx, right_stx, query, query_right, key, int(min(bounds)),
+                                       int(max(bounds)), buckets, leaf_rows, hash_expression, key_right)
+    logging.info("key ranges with differences: {}".format(ranges))
+    return build_range_query(query, key, ranges), build_range_query(query_right, key_right, ranges)
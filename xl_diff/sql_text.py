@@ -0,0 +1,90 @@
+"""
+This module contains functions that inspect and rewrite the text of SQL queries and connection strings
+"""
+import re
+
+ORDER_BY = re.compile(r"\border\s+by\b", re.IGNORECASE)
+QUOTES = {"'": "'", '"': '"', "[": "]"}  # opening and closing characters of quoted text and identifiers
+
+
+def mask_nested_text(query):
+    """
+    Replace the text inside parentheses, quotes and comments with spaces, so only the clauses of the outer query are
+    left at their original positions
+    :param query: SQL query
+    :return: masked query, the same length as the query
+    """
+    masked = []
+    depth = 0
+    n = 0
+    while n < len(query):
+        c = query[n]
+        if c in QUOTES or query.startswith("--", n) or query.startswith("/*", n):
+            end_text = QUOTES.get(c) or ("\n" if c == "-" else "*/")
+            end = query.find(end_text, n + (1 if c in QUOTES else 2))
+            end = len(query) if end < 0 else end + len(end_text)
+            masked.append(" " * (end - n))
+            n = end
+            continue
+        if c == "(":
+            depth += 1
+        masked.append(c if depth == 0 else " ")
+        if c == ")" and depth > 0:
+            depth -= 1
+        n += 1
+    return "".join(masked)
+
+
+def find_order_by(query):
+    """
+    Find the ORDER BY clause of the outer query.  An ORDER BY in parentheses (e.g. OVER (...) or a subquery), quotes or
+    comments does not order the rows of the query and is skipped.
+    :param query: SQL query
+    :return: index of the clause in the query, or None if the outer query is not ordered
+    """
+    matches = list(ORDER_BY.finditer(mask_nested_text(query)))
+    return matches[-1].start() if matches else None
+
+
+def has_order_by(query):
+    """
+    Check if the outer query has an ORDER BY clause
+    :param query: SQL query
+    :return: True if the rows of the query are ordered
+    """
+    return find_order_by(query) is not None
+
+
+def strip_query(query):
+    """
+    Remove a trailing semicolon and ORDER BY clause so the query can be used as a subquery
+    :param query: SQL query
+    :return: SQL query without trailing semicolon and ORDER BY
+    """
+    query = query.strip().rstrip(";").strip()
+    position = find_order_by(query)
+    return query if position is None else query[:position].rstrip()
+
+
+def quote_identifier(name):
+    """
+    Quote a column name so it can be used in SQL even if it has spaces or is a reserved word.  Uses the double quotes
+    of standard SQL, which SQL Server accepts with QUOTED_IDENTIFIER on (the default of odbc connections).
+    :param name: column name
+    :return: quoted name
+    """
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+def parse_connection_string(connection_string):
+    """
+    Split a connection string into a dictionary of lower case keys and values
+    :param connection_string: odbc connection string, e.g. "Driver={...};Server=...;Database=..."
+    :return: dictionary of settings
+    """
+    settings = {}
+    for part in connection_string.split(";"):
+        key, separator, value = part.partition("=")
+        if separator:
+            settings[key.strip().lower()] = value.strip()
+    return settings
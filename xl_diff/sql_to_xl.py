@@ -2,7 +2,6 @@
 This module contains a class used to execute sql code and write the results to an excel XLSX file
 """
 import logging
-import pyodbc
 import datetime
 
 from .helper_excel import get_empty_workbook
@@ -11,68 +10,170 @@ from .helper_excel import get_empty_workbook
 class SqlToXl():
     """Use to connect to database, run sql, write results to Excel file"""
 
-    def __init__(self, connection_string):
+    def __init__(self, connection_string, cache=None):
         """
         initialize the object by storing the connection string
         :param connection_string:connection string
+        :param cache: ResultCache object shared with other objects.  If supplied, save_sql uses cached results.
         """
         self.connection_string = connection_string
+        self.cache = cache
+        self.cursor = None  # cursor of the query that is running, so that cancel can stop it from another thread
+        self.cancelled = False
 
-    def save_sql(self, sql, filename, sheetname="Sheet1"):
+    def connect(self):
+        """
+        Open a connection.  pyodbc is imported here, so comparisons of files do not load the odbc driver manager.
+        :return: pyodbc connection object
+        """
+        import pyodbc
+
+        return pyodbc.connect(self.connection_string)
+
+    def save_sql(self, sql, filename, sheetname="Sheet1", timeout=None):
         """
         Run the SQL on the specified connection and save the results in Excel.  File name and sheet names can be
         specified as arguments
         :param sql: SQL to run on the target database
         :param filename: Target Excel file name
         :param sheetname: Target sheet name in Excel file
+        :param timeout: query timeout in seconds.  The driver cancels the query when it takes longer.
         :return: None
         """
         print(self.connection_string)
-        with pyodbc.connect(self.connection_string) as cnxn:
-            rowid = 1
-            colid = 1
+        if self.cache is not None:
+            columns, rows = self.cache.get_or_run(self.connection_string, sql,
+                                                  lambda: self.fetch_results(sql, timeout))
+            self.write_results(columns, rows, filename, sheetname)
+            return
+
+        with self.connect() as cnxn:
+            if timeout:
+                cnxn.timeout = int(timeout)  # query timeout, enforced by the odbc driver
+            try:
+                cursor = self.execute(cnxn, sql)
+                self.write_results(self.get_columns(cursor), cursor, filename, sheetname)
+            finally:
+                self.cursor = None
+
+    def fetch_results(self, sql, timeout=None):
+        """
+        Run the SQL and fetch every row
+        :param sql: SQL to run on the target database
+        :param timeout: query timeout in seconds
+        :return: tuple of (column names, list of rows).  Each row is a list of values.
+        """
+        with self.connect() as cnxn:
+            if timeout:
+                cnxn.timeout = int(timeout)
             try:
-                sql_to_run = sql
-                logging.info(f"run sql: {sql_to_run}")  # log sql used
-
-                cursor = cnxn.cursor()
-                cursor.execute(sql_to_run)
-
-                if not cursor.description:  # if cursor description is None, query might be using a stored procedure
-                    noCount = """ SET NOCOUNT ON; """  # add SET NOCOUNT statement to sql executed
-                    sql_to_run = noCount + sql  # this will correct the issue pyodbc has with stored procedures
-                    cursor.execute(sql_to_run)  # rerun the sql with modification
-
-                wb = get_empty_workbook()  # had issues using active sheet, so instead we remove the default sheet
-                ws = wb.create_sheet("query_result")  # create new sheet
-                ws.title = sheetname
-
-                try:  # wrapping this in a try catch in case there are more issues
-                    columns = [column[0] for column in cursor.description]
-                except Exception as ex:
-                    logging.error("Couldn't get column names from cursor description.  Check the query syntax"
-                                  + " You may need to add SET NOCOUNT ON to your query "
-                                  + f" Error info {ex}")
-                    raise ex # reraise the exception
-
-                for col in columns:
+                cursor = self.execute(cnxn, sql)
+                return self.get_columns(cursor), [list(row) for row in cursor]
+            finally:
+                self.cursor = None
+
+    def get_columns(self, cursor):
+        """
+        Get the column names from the cursor description
+        :param cursor: cursor with the results of a query
+        :return: list of column names
+        """
+        try:  # wrapping this in a try catch in case there are more issues
+            return [column[0] for column in cursor.description]
+        except Exception as ex:
+            logging.error("Couldn't get column names from cursor description.  Check the query syntax"
+                          + " You may need to add SET NOCOUNT ON to your query "
+                          + f" Error info {ex}")
+            raise ex # reraise the exception
+
+    def write_results(self, columns, rows, filename, sheetname="Sheet1"):
+        """
+        Write column names and rows to a new Excel file
+        :param columns: list of column names
+        :param rows: iterable of rows, e.g. a cursor
+        :param filename: Target Excel file name
+        :param sheetname: Target sheet name in Excel file
+        :return: None
+        """
+        rowid = 1
+        colid = 1
+        try:
+            wb = get_empty_workbook()  # had issues using active sheet, so instead we remove the default sheet
+            ws = wb.create_sheet("query_result")  # create new sheet
+            ws.title = sheetname
+
+            for col in columns:
+                ws.cell(row=rowid, column=colid).value = col
+                colid += 1
+
+            for row in rows:
+                rowid += 1
+                colid = 1
+                for col in row:
                     ws.cell(row=rowid, column=colid).value = col
                     colid += 1
 
-                for row in cursor:
-                    rowid += 1
-                    colid = 1
-                    for col in row:
-                        ws.cell(row=rowid, column=colid).value = col
-                        colid += 1
-
-                logging.info(f"Saving {filename}")
-                wb.save(filename)
-                logging.info("Saved {} @ {}".format(filename, datetime.datetime.now()))
-            except Exception as e:
-                logging.error(f"An error occurred at while saving query results to executable. Error info {e}, "
-                              + f"Line of output: {rowid}, Column index {colid}")
-                raise (e)  # reraise error
+            logging.info(f"Saving {filename}")
+            wb.save(filename)
+            logging.info("Saved {} @ {}".format(filename, datetime.datetime.now()))
+        except Exception as e:
+            logging.error(f"An error occurred at while saving query results to executable. Error info {e}, "
+                          + f"Line of output: {rowid}, Column index {colid}")
+            raise (e)  # reraise error
+
+    def execute(self, cnxn, sql):
+        """
+        Execute the SQL on an open connection.  If the cursor has no description, the query might be using a stored
+        procedure, so it is run again with SET NOCOUNT ON.
+        :param cnxn: pyodbc connection
+        :param sql: SQL to run
+        :return: cursor with the results
+        """
+        sql_to_run = sql
+        logging.info(f"run sql: {sql_to_run}")  # log sql used
+
+        cursor = cnxn.cursor()
+        self.cursor = cursor
+        if self.cancelled:  # cancel was called before the query started
+            raise RuntimeError("query was cancelled: {}".format(sql))
+        cursor.execute(sql_to_run)
+
+        if not cursor.description:  # if cursor description is None, query might be using a stored procedure
+            noCount = """ SET NOCOUNT ON; """  # add SET NOCOUNT statement to sql executed
+            sql_to_run = noCount + sql  # this will correct the issue pyodbc has with stored procedures
+            cursor.execute(sql_to_run)  # rerun the sql with modification
+        return cursor
+
+    def cancel(self):
+        """
+        Cancel the query that is running, or that is about to run.  Can be called from another thread.  pyodbc asks the
+        driver to stop the query on the server, and the thread running it gets an error.
+        :return: None
+        """
+        self.cancelled = True
+        cursor = self.cursor
+        if cursor is not None:
+            cursor.cancel()
+
+    def iter_batches(self, sql, batch_size=1000, timeout=None):
+        """
+        Run the SQL and return the results in batches as they are fetched.  The first item is the list of column
+        names.  Every following item is a list of up to batch_size rows, each row a list of values.
+        :param sql: SQL to run
+        :param batch_size: number of rows fetched at a time
+        :param timeout: query timeout in seconds
+        :return: generator of column names, then batches of rows
+        """
+        with self.connect() as cnxn:
+            if timeout:
+                cnxn.timeout = int(timeout)
+            cursor = self.execute(cnxn, sql)
+            yield [column[0] for column in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield [list(row) for row in rows]
 
     def get_query_results(self, query):
         """
@@ -81,7 +182,7 @@ class SqlToXl():
         :return: list of lists.  Each inner list is a row returned from the SQL query
         """
         lines = []
-        with pyodbc.connect(self.connection_string) as cnxn:
+        with self.connect() as cnxn:
             cursor = cnxn.cursor()
             cursor.execute(query)
 
@@ -2,7 +2,9 @@
 This module is intended to summarize the output of a comparison.  It can be called independently of the comparison
 module on completed excel comparisons or as part of the comparison function call itself.
 """
+import math
 from collections import namedtuple
+from datetime import timedelta
 
 import openpyxl as xl
 from openpyxl.styles import PatternFill
@@ -10,6 +12,11 @@ from openpyxl.utils import get_column_letter
 
 from .validators import is_number
 from .helper_excel import get_empty_workbook
+from .rules import compile_rules
+
+CONFIDENCE_Z = 1.96  # z value of a 95% confidence interval
+STATUS_NUMBER_FORMAT = '"Different";"Different";"Same"'  # compact status cells: 1 shows as Different, 0 as Same
+DELTA_NUMBER_FORMAT = '0.00####" days"'  # time between dates.  excel shows negative times as ####, so days are used
 
 
 class SummaryNode(namedtuple('SummaryNode', ["sheet_name", "column_with_differences", "number_of_differences",
@@ -20,7 +27,7 @@ class SummaryNode(namedtuple('SummaryNode', ["sheet_name", "column_with_differen
 
 
 def summarize_differences(sheet, starting_column, columns_per_comparison, threshold=0.001, has_header=True,
-                          diff_offset=2, starting_row=1):
+                          diff_offset=2, starting_row=1, include_all=False, comparators=None):
     """
     Return a list of nodes containing columns with differences
     :param sheet: openpyxl worksheet object
@@ -31,6 +38,10 @@ def summarize_differences(sheet, starting_column, columns_per_comparison, thresh
                         if False, use the Excel letter of the source sheet column accounting for sheets_per_comparison
     :param diff_offset: the difference column is this many columns away from the "left" value (default is 2)
     :param starting_row: one-based index of first row to check (default is 1)
+    :param include_all: if True, also return nodes for columns without differences
+    :param comparators: list of comparator functions from compile_rules, one per compared column.  If supplied, the
+                        left and right values are compared again with the rule of their column instead of checking the
+                        difference value against the threshold.
     :return: list of named tuples
     """
     # these could be parameters but i made them variables
@@ -42,31 +53,97 @@ def summarize_differences(sheet, starting_column, columns_per_comparison, thresh
     for col in range(starting_column, max_col + 1, columns_per_comparison):
         difference_count = 0
         number_of_rows = 0
-        for row in range(starting_row, max_row + 1):
-            number_of_rows += 1
-            item = sheet.cell(row=row, column=col + diff_offset)
-            if item.value == "Different":
-                difference_count += 1
-            elif is_number(item.value):
-                if float(item.value) > threshold:
+        if comparators is not None:
+            compare = comparators[(col - starting_column) // columns_per_comparison]
+            for row in range(starting_row, max_row + 1):
+                number_of_rows += 1
+                (difference, same) = compare(sheet.cell(row=row, column=col).value,
+                                             sheet.cell(row=row, column=col + 1).value)
+                if not same:
+                    difference_count += 1
+        else:
+            for row in range(starting_row, max_row + 1):
+                number_of_rows += 1
+                item = sheet.cell(row=row, column=col + diff_offset)
+                if is_number(item.value) and item.number_format in (STATUS_NUMBER_FORMAT, DELTA_NUMBER_FORMAT):
+                    difference_count += item.value != 0  # compact status or time between dates, read from a file
+                elif counts_as_difference(item.value, threshold):
                     difference_count += 1
-        if difference_count > 0:
-            percent_different_numeric = round(difference_count / number_of_rows, 4) if number_of_rows > 0 else 0
-            percent_different = "{:.2%}".format(percent_different_numeric)
+        if difference_count > 0 or include_all:
             original_sheet_column = (((col - 1)  # convert one-based index to zero-based
                                       / columns_per_comparison)  # divide column index by # of cols per value
                                      + 1)  # convert back to one-based index to get the original column index
             if has_header:
-                s = SummaryNode(sheet.title, sheet.cell(row=1, column=col).value, difference_count, number_of_rows,
-                                percent_different, original_sheet_column)
+                s = make_summary_node(sheet.title, sheet.cell(row=1, column=col).value, difference_count,
+                                      number_of_rows, original_sheet_column)
             else:
 
-                s = SummaryNode(sheet.title, get_column_letter(original_sheet_column), difference_count, number_of_rows,
-                                percent_different, original_sheet_column)
+                s = make_summary_node(sheet.title, get_column_letter(int(original_sheet_column)), difference_count,
+                                      number_of_rows, original_sheet_column)
             summary_nodes.append(s)
     return summary_nodes
 
 
+def counts_as_difference(value, threshold):
+    """
+    Check if a difference value of a comparison sheet counts as a difference
+    :param value: difference value: "Same", "Different", a number or a timedelta
+    :param threshold: maximum numerical difference allowed.  Dates only count as the same if they are equal.
+    :return: True if different
+    """
+    if value == "Different":
+        return True
+    if isinstance(value, timedelta):
+        return value != timedelta(0)
+    return is_number(value) and abs(float(value)) > threshold
+
+
+def get_column_name(header, index, has_header=True):
+    """
+    Get the name of a column for the summary: its header value, or its column letter if the sheet has no header
+    :param header: list of values of the first row
+    :param index: 0-based column index
+    :param has_header: if true, the first row holds the column names
+    :return: header value or column letter
+    """
+    if not has_header:
+        return get_column_letter(index + 1)
+    return header[index] if index < len(header) else None
+
+
+def make_summary_node(sheet_name, column_name, difference_count, number_of_rows, column_index):
+    """
+    Create a SummaryNode and format its percent of differences
+    :param sheet_name: title of the comparison sheet
+    :param column_name: header value or column letter
+    :param difference_count: number of differences in the column
+    :param number_of_rows: number of rows checked
+    :param column_index: 1-based index of the column in the source sheet
+    :return: SummaryNode object
+    """
+    percent_different_numeric = round(difference_count / number_of_rows, 4) if number_of_rows > 0 else 0
+    percent_different = "{:.2%}".format(percent_different_numeric)
+    return SummaryNode(sheet_name, column_name, difference_count, number_of_rows, percent_different, column_index)
+
+
+def merge_summary_nodes(partial_nodes, include_all=False):
+    """
+    Merge partial counts of the same columns, e.g. from shards of rows of a sheet.  Nodes keep the order in which their
+    column first appears.
+    :param partial_nodes: list of SummaryNode objects.  Only the counts are used.
+    :param include_all: if True, also return nodes for columns without differences
+    :return: list of SummaryNode objects, one per sheet and column
+    """
+    merged = {}
+    for n in partial_nodes:
+        key = (n.sheet_name, n.column_index)
+        (name, differences, rows) = merged.get(key, (n.column_with_differences, 0, 0))
+        merged[key] = (name, differences + n.number_of_differences, rows + n.number_of_rows)
+    return [make_summary_node(sheet_name, name, differences, rows, column_index)
+            for ((sheet_name, column_index), (name, differences, rows)) in merged.items()
+            if differences > 0 or include_all]
+
+
 def write_summary_file(input_path, output_path, sheets_per_comparison=3):
     """
     Create summary file based on comparison file.
@@ -101,34 +178,80 @@ def get_nodes_for_workbook_path(file_path, sheets_per_comparison, starting_colum
 
 
 def get_workbook_nodes(sheets_per_comparison, input_wb, starting_column=1, columns_per_comparison=3, threshold=0.001,
-                       has_header=True):
+                       has_header=True, include_all=False, rules=None):
     """
     Search comparison worksheets for differences
     :param sheets_per_comparison: number of columns used for each value comparison
     :param input_wb: openpyxl workbook object
+    :param include_all: if True, also return nodes for columns without differences
+    :param rules: dictionary that maps a column (1-based index or header name) to a comparison rule.  If supplied,
+                    differences are counted with the rule of each column.
     :return: list of tuples with summary information
     """
     workbook_nodes = []  # list of SummaryNode objects
 
     for i in range(sheets_per_comparison - 1, len(input_wb.worksheets), sheets_per_comparison):  # i is sheet index
         sheet = input_wb.worksheets[i]  # get comparison worksheet (at index i)
-        sheet_nodes = summarize_differences(sheet, starting_column, columns_per_comparison, threshold,
-                                            has_header)  # get list of nodes for the sheet
+        sheet_nodes = get_sheet_nodes(sheet, starting_column, columns_per_comparison, threshold, has_header,
+                                      include_all, rules)  # get list of nodes for the sheet
         workbook_nodes.extend(sheet_nodes)  # append sheet nodes to the end of list for the workbook
 
     return workbook_nodes
 
 
-def create_summary_worksheet(nodes: list, output_wb: xl.Workbook):
+def get_sheet_nodes(sheet, starting_column=1, columns_per_comparison=3, threshold=0.001, has_header=True,
+                    include_all=False, rules=None):
+    """
+    Search one comparison worksheet for differences
+    :param sheet: comparison worksheet object
+    :param include_all: if True, also return nodes for columns without differences
+    :param rules: dictionary that maps a column (1-based index or header name) to a comparison rule.  If supplied,
+                    differences are counted with the rule of each column.
+    :return: list of SummaryNode objects
+    """
+    comparators = None
+    if rules:
+        header = [sheet.cell(row=1, column=col).value
+                  for col in range(starting_column, sheet.max_column + 1, columns_per_comparison)]
+        comparators = compile_rules(rules, header, threshold, len(header), has_header)
+    return summarize_differences(sheet, starting_column, columns_per_comparison, threshold, has_header,
+                                 include_all=include_all, comparators=comparators)
+
+
+def wilson_interval(differences, rows, z=CONFIDENCE_Z):
+    """
+    Get the Wilson score interval of a difference rate measured on a sample of rows
+    :param differences: number of sampled rows with differences
+    :param rows: number of sampled rows
+    :param z: z value of the confidence level (1.96 for 95%)
+    :return: tuple of (low, high) rates.  (0, 1) if no rows were sampled.
+    """
+    if rows <= 0:
+        return 0.0, 1.0
+    rate = differences / rows
+    denominator = 1 + z ** 2 / rows
+    center = (rate + z ** 2 / (2 * rows)) / denominator
+    margin = z * math.sqrt(rate * (1 - rate) / rows + z ** 2 / (4 * rows ** 2)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def create_summary_worksheet(nodes: list, output_wb: xl.Workbook, estimate=False, header_rows=0,
+                             unmatched_columns=None):
     """
     Build a workbook object with data from summary nodes
     :param nodes: list of SummaryValue tuples
+    :param estimate: if True, the rows were sampled.  Add the estimated difference rate of each column with a 95%
+                    confidence interval.
+    :param header_rows: number of header rows counted in the total rows, which are left out of the estimate
+    :param unmatched_columns: list of UnmatchedColumn tuples.  If not empty, they are listed below the nodes.
     :return: workbook object
     """
     summary_sheet = output_wb.create_sheet("summary")
     # write headers
     row = 1
     headers = ["Sheet Name", "Column Name", "Number of Differences", "Total Rows", "Percent Different", "Column Index"]
+    if estimate:
+        headers += ["Estimated Rate", "95% CI Low", "95% CI High"]
     for i in range(1, len(headers) + 1):
         format_header(summary_sheet.cell(row=row, column=i), headers[i - 1])
 
@@ -138,9 +261,25 @@ def create_summary_worksheet(nodes: list, output_wb: xl.Workbook):
             row += 1
             node_values = [n.sheet_name, n.column_with_differences, n.number_of_differences, n.number_of_rows,
                            n.match_percent, n.column_index]
+            if estimate:
+                sampled_rows = max(n.number_of_rows - header_rows, 0)
+                differences = min(n.number_of_differences, sampled_rows)
+                rate = differences / sampled_rows if sampled_rows > 0 else 0
+                node_values += ["{:.2%}".format(v) for v in (rate, *wilson_interval(differences, sampled_rows))]
             for i in range(1, len(node_values) + 1):
                 summary_sheet.cell(row=row, column=i).value = node_values[i - 1]
 
+    # write columns only found on one side in a separate table
+    if unmatched_columns:
+        row += 2
+        unmatched_headers = ["Sheet Name", "Unmatched Column", "Only In", "Column Index"]
+        for i in range(1, len(unmatched_headers) + 1):
+            format_header(summary_sheet.cell(row=row, column=i), unmatched_headers[i - 1])
+        for u in unmatched_columns:
+            row += 1
+            for (i, value) in enumerate([u.sheet_name, u.column_name, u.side, u.column_index], start=1):
+                summary_sheet.cell(row=row, column=i).value = value
+
     # autosize columns
     for c in range(1, summary_sheet.max_column + 1):
         summary_sheet.column_dimensions[get_column_letter(c)].width = 30
@@ -3,9 +3,7 @@ This module contains simple functions used to check the type of values or evalua
 """
 import os
 
-from dateutil.parser import parse
-
-from .convert import convert_csv_to_excel
+from .backends import get_reader
 
 
 def is_number(my_value):
@@ -27,6 +25,8 @@ def is_date(my_value):
     :param my_value: value to check
     :return: true if date, false if not
     """
+    from dateutil.parser import parse  # slow to import, so only imported when a value is checked
+
     try:
         parse(my_value)
         return True
@@ -47,12 +47,9 @@ def is_extension(file_path, extension):
 
 def is_file_extension_valid(file_path):
     """
-    check if file has .csv file extension.  If file is invalid, throw an error.
+    check if a reader backend is registered for the file extension.  If file is invalid, throw an error.
     :param file_path: file to check
     :return: file path if valud.
     """
-    if is_extension(file_path, '.csv'):
-        file_path = convert_csv_to_excel(file_path)
-    elif not is_extension(file_path, ".xlsx"):
-        raise ValueError("file extension for {} is not xlsx or csv.  file cannot be processed.".format(file_path))
+    get_reader(file_path)  # raises ValueError if no reader is registered for the extension
     return file_path
@@ -0,0 +1,245 @@
+"""
+This module contains a watch mode that compares two files again whenever one of them changes.
+
+While a report is being developed, the same comparison is run after every small change to one of the files.  A watch
+session keeps the parsed workbooks, the rows of every sheet and the compared rows of the last run in memory.  When a
+file changes, only that file is loaded again.  Sheets whose rows did not change keep their results.  In a changed
+sheet, the rows are aligned again (by position, key or content) and each aligned pair of rows is looked up by its
+values: pairs seen in the last run reuse their differences, and only new pairs are compared.  The difference counts
+of the summary are updated with the pairs that were added and removed, then the output file is written again.
+
+The output has the same layout as the output of compare_files.
+"""
+import logging
+import time
+import zipfile
+from collections import Counter
+from datetime import timedelta
+from itertools import zip_longest
+
+from .backends import load_workbook, save_workbook
+from .checkpoint import file_signature
+from .sharded import compare_rows
+from .summary import get_column_name, make_summary_node, create_summary_worksheet, DELTA_NUMBER_FORMAT
+from .validators import is_file_extension_valid
+
+WATCH_INTERVAL = 1.0  # seconds between checks of the input files
+
+
+class WatchedSheet():
+    """
+    Rows and compared row pairs of one sheet pair
+    """
+
+    def __init__(self, left_name, right_name, output_name):
+        self.left_name = left_name
+        self.right_name = right_name
+        self.output_name = output_name
+        self.left_rows = None
+        self.right_rows = None
+        self.header = None
+        self.pairs = []  # aligned (left row, right row) tuples, in output order
+        self.results = {}  # (left row, right row) -> (row of (difference, same) tuples, difference flag per column)
+        self.pair_counts = Counter()
+        self.counts = []  # differences per column
+
+
+class WatchSession():
+    """
+    Comparison of two files that is updated when the files change
+    """
+
+    def __init__(self, left_path, right_path, output_path, threshold=0.001, sort_column=None, compare_type="default",
+                 has_header=True, sheet_matching="name", rules=None, csv_schema=None):
+        """
+        :param left_path: first file to compare.  Results show on left.
+        :param right_path: second file to compare.  Results show on right
+        :param output_path: output file, written after every change
+        :param threshold: maximum acceptable differences of numerical values
+        :param sort_column: numerical index of column, or list of such indices, used to sort rows
+        :param compare_type: sorted, aligned or default (rows compared by position)
+        :param has_header: if true, first row is excluded from sort
+        :param sheet_matching: if "name", sheets with the same name will be compared.  Otherwise, order is used.
+        :param rules: dictionary that maps a column (1-based index or header name) to a comparison rule
+        :param csv_schema: dictionary that maps a csv column to a type name
+        """
+        if compare_type == "sorted" and sort_column is None:
+            raise ValueError("a sort column is needed if compare type is sorted")
+        self.paths = {"left": is_file_extension_valid(left_path), "right": is_file_extension_valid(right_path)}
+        self.output_path = output_path
+        self.threshold = threshold
+        self.sort_column = sort_column
+        self.compare_type = compare_type
+        self.has_header = has_header
+        self.sheet_matching = sheet_matching
+        self.rules = rules
+        self.csv_schema = csv_schema
+        self.signatures = {}
+        self.workbooks = {}
+        self.sheets = {}  # (left sheet name, right sheet name) -> WatchedSheet
+
+    def refresh(self):
+        """
+        Compare the files again if either of them changed since the last call, and write the output file
+        :return: number of row pairs that were compared, or None if neither file changed
+        """
+        changed = [side for (side, path) in self.paths.items() if file_signature(path) != self.signatures.get(side)]
+        if not changed:
+            return None
+        for side in changed:
+            logging.info("loading {} file '{}'".format(side, self.paths[side]))
+            signature = file_signature(self.paths[side])  # taken before loading, so a later save is seen as a change
+            self.workbooks[side] = load_workbook(self.paths[side], schema=self.csv_schema, has_header=self.has_header)
+            self.signatures[side] = signature  # only after a successful load, so a failed load is tried again
+
+        left_names = self.workbooks["left"].sheetnames
+        right_names = self.workbooks["right"].sheetnames
+        if self.sheet_matching == "name":
+            sheet_pairs = [(name, name) for name in left_names if name in right_names]
+        else:
+            sheet_pairs = list(zip(left_names, right_names))
+        if not sheet_pairs:
+            raise ValueError("No sheets were found for processing.  Check sheet_matching parameter is set correctly " +
+                             "(e.g. name or order)")
+
+        compared = 0
+        sheets = {}
+        for (i, j) in sheet_pairs:
+            output_name = i if self.sheet_matching == "name" or i == j else "{} v {}".format(i, j)
+            sheet = self.sheets.get((i, j)) or WatchedSheet(i, j, output_name)
+            compared += self.update_sheet(sheet)
+            sheets[(i, j)] = sheet
+        self.sheets = sheets  # sheets that are no longer compared are dropped
+
+        self.write_output()
+        logging.info("compared {} changed row pairs in {} sheets".format(compared, len(sheets)))
+        return compared
+
+    def update_sheet(self, sheet):
+        """
+        Read the rows of a sheet pair again and compare the row pairs that were not compared before
+        :param sheet: WatchedSheet object
+        :return: number of row pairs that were compared
+        """
+        from .compare import sort_values  # compare imports most modules, so it is only loaded when a sheet changes
+        from .alignment import align_rows
+
+        left_sheet = self.workbooks["left"][sheet.left_name]
+        right_sheet = self.workbooks["right"][sheet.right_name]
+        width = max(left_sheet.max_column, right_sheet.max_column)
+        left_rows = read_rows(left_sheet, width)
+        right_rows = read_rows(right_sheet, width)
+        if left_rows == sheet.left_rows and right_rows == sheet.right_rows:
+            return 0  # e.g. another sheet of the file changed
+
+        header = list(left_rows[0]) if left_rows else []
+        if header != sheet.header:  # rules can name columns by header, so earlier results may not apply
+            sheet.results = {}
+            sheet.pair_counts = Counter()
+            sheet.counts = [0] * width
+        empty = (None,) * width
+        if self.compare_type in ("sorted", "aligned"):
+            if self.compare_type == "sorted":
+                row_map = sort_values(left_sheet, right_sheet, self.sort_column, self.has_header, row_map=True)
+            else:
+                row_map = align_rows(left_sheet, right_sheet, self.has_header, row_map=True)
+            pairs = [(left_rows[0], right_rows[0])] if self.has_header and left_rows and right_rows else []
+            pairs.extend((left_rows[l - 1] if l else empty, right_rows[r - 1] if r else empty)
+                         for (l, r) in zip(row_map.left_rows, row_map.right_rows))
+        else:
+            pairs = list(zip_longest(left_rows, right_rows, fillvalue=empty))
+
+        new_pairs = [p for p in dict.fromkeys(pairs) if p not in sheet.results]
+        if new_pairs:
+            (rows, _) = compare_rows([l for (l, r) in new_pairs], [r for (l, r) in new_pairs], self.threshold,
+                                     self.rules, header, self.has_header, width)
+            for (pair, row) in zip(new_pairs, rows):
+                flags = [not same for (difference, same) in row]  # same as the counts of compare_sheet_sharded
+                sheet.results[pair] = (row, flags)
+
+        # update the counts with the pairs that were added and removed since the last run
+        pair_counts = Counter(pairs)
+        counts = sheet.counts + [0] * (width - len(sheet.counts))
+        for pair in set(pair_counts) | set(sheet.pair_counts):
+            change = pair_counts[pair] - sheet.pair_counts[pair]
+            if change:
+                for (n, flag) in enumerate(sheet.results[pair][1]):
+                    counts[n] += change * flag
+
+        sheet.results = {pair: sheet.results[pair] for pair in pair_counts}  # forget pairs that are gone
+        sheet.pair_counts = pair_counts
+        sheet.counts = counts[:width]
+        (sheet.left_rows, sheet.right_rows, sheet.header, sheet.pairs) = (left_rows, right_rows, header, pairs)
+        logging.info("sheet {}: compared {} of {} row pairs".format(sheet.output_name, len(new_pairs), len(pairs)))
+        return len(new_pairs)
+
+    def write_output(self):
+        """
+        Write the output file from the compared rows and counts of every sheet
+        :return: None
+        """
+        from .compare import SAME_FILL, DIFFERENT_FILL  # compare imports most modules
+        from .helper_excel import get_empty_workbook
+
+        output_wb = get_empty_workbook()
+        nodes = []
+        for sheet in self.sheets.values():
+            left_sheet = output_wb.create_sheet("left_" + sheet.left_name)
+            right_sheet = output_wb.create_sheet("right_" + sheet.right_name)
+            output_sheet = output_wb.create_sheet(sheet.output_name)
+            for (row_number, (left_values, right_values)) in enumerate(sheet.pairs, start=1):
+                left_sheet.append(left_values)
+                right_sheet.append(right_values)
+                row = sheet.results[(left_values, right_values)][0]
+                values = []
+                for (l, r, (difference, same)) in zip(left_values, right_values, row):
+                    values.extend((l, r, difference))
+                output_sheet.append(values)
+                for (column, (difference, same)) in enumerate(row):
+                    cell = output_sheet.cell(row=row_number, column=column * 3 + 3)
+                    cell.fill = SAME_FILL if same else DIFFERENT_FILL
+                    if isinstance(difference, timedelta):
+                        cell.number_format = DELTA_NUMBER_FORMAT
+            nodes.extend(make_summary_node(sheet.output_name, get_column_name(sheet.header, c, self.has_header),
+                                           count, len(sheet.pairs), float(c + 1))
+                         for (c, count) in enumerate(sheet.counts) if count > 0)
+        create_summary_worksheet(nodes, output_wb, header_rows=1 if self.has_header else 0)
+        save_workbook(output_wb, self.output_path)
+
+
+def read_rows(sheet, width):
+    """
+    Read the values of a sheet as tuples of the same length
+    :param sheet: worksheet object
+    :param width: number of columns
+    :return: list of row tuples
+    """
+    return [tuple(row) + (None,) * (width - len(row)) for row in sheet.iter_rows(values_only=True)]
+
+
+def watch_files(left_path, right_path, output_path, threshold=0.001, sort_column=None, compare_type="default",
+                has_header=True, sheet_matching="name", rules=None, csv_schema=None, interval=WATCH_INTERVAL,
+                max_runs=None):
+    """
+    Compare two files, then compare them again each time one of them changes, until interrupted
+    :param interval: seconds between checks of the input files
+    :param max_runs: if supplied, stop after this many comparisons
+    :return: None
+    """
+    from openpyxl.utils.exceptions import InvalidFileException
+
+    session = WatchSession(left_path, right_path, output_path, threshold, sort_column, compare_type, has_header,
+                           sheet_matching, rules, csv_schema)
+    runs = 0
+    logging.info("watching '{}' and '{}'.  Press Ctrl+C to stop.".format(left_path, right_path))
+    try:
+        while max_runs is None or runs < max_runs:
+            try:
+                if session.refresh() is not None:
+                    runs += 1
+            except (OSError, ValueError, zipfile.BadZipFile, InvalidFileException) as e:  # e.g. a file being saved
+                logging.error("comparison failed, waiting for the next change: {}".format(e))
+            if max_runs is None or runs < max_runs:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        logging.info("stopped watching")